@@ -0,0 +1,364 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from jec4prompt.utils.heartbeat import find_stragglers, read_heartbeat
+
+
+def update_state(state):
+    add_batch_parser(state.subparsers)
+    state.valfuncs["batch"] = validate_args
+    state.commands["batch"] = run
+
+
+def add_batch_parser(subparsers):
+    batch_parser = subparsers.add_parser(
+        "batch",
+        help="Run the steps of a command \
+            (e.g. skim) in a local process pool instead of condor",
+    )
+    batch_parser.add_argument(
+        "--nsteps", type=int, help="Number of steps input files are grouped into."
+    )
+    batch_parser.add_argument(
+        "--plan",
+        type=str,
+        help="Path to a step plan .json file \
+            produced by plan_skim (sets the number of steps)",
+    )
+    batch_parser.add_argument(
+        "--steps",
+        type=str,
+        help="Comma separated list of steps to \
+            run (default: all)",
+    )
+    batch_parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of steps run at the same time",
+    )
+    batch_parser.add_argument(
+        "--retries",
+        type=int,
+        default=2,
+        help="Number of times a failed step is retried",
+    )
+    batch_parser.add_argument(
+        "--state_file",
+        type=str,
+        default="batch_state.json",
+        help="Path to the .json file \
+            tracking the status of the steps. Finished steps are not rerun.",
+    )
+    batch_parser.add_argument(
+        "--log_dir",
+        type=str,
+        default="batch_logs",
+        help="Directory for the output of each step",
+    )
+    batch_parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Rerun all steps, ignoring the state file",
+    )
+    batch_parser.add_argument(
+        "--heartbeat_dir",
+        type=str,
+        help="Directory for the heartbeats \
+            of the steps (passed to skim as --heartbeat)",
+    )
+    batch_parser.add_argument(
+        "--straggler_factor",
+        type=float,
+        help="Stop steps whose event rate is \
+            below this fraction of the median rate and resubmit their files as \
+            smaller steps. Requires --heartbeat_dir.",
+    )
+    batch_parser.add_argument(
+        "--straggler_grace",
+        type=float,
+        default=300.0,
+        help="Seconds a step runs before it \
+            can be considered a straggler",
+    )
+    batch_parser.add_argument(
+        "--resplit",
+        type=int,
+        default=2,
+        help="Number of steps the files of a \
+            straggler are split into",
+    )
+    batch_parser.add_argument(
+        "--merge",
+        type=str,
+        help="Merge the outputs of the completed \
+            steps into this file with hadd. Requires --heartbeat_dir.",
+    )
+    batch_parser.add_argument(
+        "command",
+        nargs=argparse.REMAINDER,
+        help="Command to run for each step, \
+            e.g. -- skim --filepaths files.txt --out out ...",
+    )
+
+
+def validate_args(args):
+    if args.command and args.command[0] == "--":
+        args.command = args.command[1:]
+    if len(args.command) == 0:
+        raise ValueError("No command given")
+    if (args.nsteps is None) == (args.plan is None):
+        raise ValueError("Exactly one of nsteps and plan should be given")
+    if args.concurrency < 1:
+        raise ValueError("concurrency should be at least 1")
+    if args.retries < 0:
+        raise ValueError("retries should be non-negative")
+    if (args.straggler_factor or args.merge) and not args.heartbeat_dir:
+        raise ValueError("straggler_factor and merge require heartbeat_dir")
+    if args.straggler_factor:
+        if args.plan:
+            raise ValueError("straggler_factor can not be used with plan")
+        if option_value(args.command, "--out") is None:
+            raise ValueError("straggler_factor requires --out in the command")
+    if args.resplit < 1:
+        raise ValueError("resplit should be at least 1")
+
+
+def read_batch_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_batch_state(path, batch_state):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(batch_state, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+
+def option_value(command, option):
+    for i, arg in enumerate(command):
+        if arg == option and i + 1 < len(command):
+            return command[i + 1]
+        if arg.startswith(f"{option}="):
+            return arg.split("=", 1)[1]
+    return None
+
+
+def strip_inputs(command):
+    """
+    The command without its --filelist and --filepaths options.
+    """
+    stripped = []
+    skip = False
+    for arg in command:
+        if skip:
+            skip = False
+        elif arg in ("--filelist", "--filepaths", "-fp"):
+            skip = True
+        elif not arg.startswith(("--filelist=", "--filepaths=")):
+            stripped.append(arg)
+    return stripped
+
+
+def heartbeat_path(args, job):
+    return os.path.join(args.heartbeat_dir, f"step_{job}.json")
+
+
+def step_command(args, step, nsteps):
+    command = [sys.executable, "-m", "jec4prompt.main", *args.command]
+    if args.plan:
+        return command + ["--plan", args.plan, "--step", str(step)]
+    return command + ["--nsteps", str(nsteps), "--step", str(step)]
+
+
+def resplit_commands(args, job, files):
+    """
+    Commands processing the files of a stopped step as smaller steps, with
+    their outputs in a resplit_<step> subdirectory of the output path.
+    """
+    os.makedirs(args.log_dir, exist_ok=True)
+    filepaths = os.path.join(args.log_dir, f"step_{job}_files.txt")
+    with open(filepaths, "w") as f:
+        f.write("\n".join(files) + "\n")
+
+    out = os.path.join(option_value(args.command, "--out"), f"resplit_{job}")
+    command = [sys.executable, "-m", "jec4prompt.main", *strip_inputs(args.command)]
+    command += ["--filepaths", filepaths, "--out", out]
+    nsteps = min(args.resplit, len(files))
+    return {
+        f"{job}.{i}": command + ["--nsteps", str(nsteps), "--step", str(i)]
+        for i in range(nsteps)
+    }
+
+
+def run_step(args, job, command, processes, stopped):
+    """
+    Run a single step, retrying it on failure unless it was stopped as a
+    straggler. Returns the step, the return code of the last attempt, the
+    number of attempts and the time it took.
+    """
+    os.makedirs(args.log_dir, exist_ok=True)
+    if args.heartbeat_dir:
+        command = command + ["--heartbeat", heartbeat_path(args, job)]
+    start = time.time()
+    for attempt in range(1, args.retries + 2):
+        if args.heartbeat_dir and os.path.exists(heartbeat_path(args, job)):
+            os.remove(heartbeat_path(args, job))
+        log_path = os.path.join(args.log_dir, f"step_{job}.log")
+        with open(log_path, "w" if attempt == 1 else "a") as log:
+            processes[job] = subprocess.Popen(
+                command, stdout=log, stderr=subprocess.STDOUT
+            )
+            returncode = processes[job].wait()
+            del processes[job]
+        if returncode == 0 or job in stopped:
+            break
+    return job, returncode, attempt, time.time() - start
+
+
+def stop_stragglers(args, jobs, processes, stopped, logger):
+    """
+    Terminate the running steps falling behind the median event rate.
+    Steps that are themselves resplit from a straggler are not stopped.
+    """
+    heartbeats = {}
+    for job in jobs:
+        heartbeat = read_heartbeat(heartbeat_path(args, job))
+        if heartbeat is not None:
+            heartbeats[job] = heartbeat
+
+    for job in find_stragglers(heartbeats, args.straggler_factor, args.straggler_grace):
+        process = processes.get(job)
+        if job in stopped or "." in job or process is None:
+            continue
+        heartbeat = heartbeats[job]
+        logger.warning(
+            f"Step {job} is a straggler ({heartbeat['events_per_s']:.0f} events/s "
+            f"reading {heartbeat['file']}), resubmitting its files"
+        )
+        stopped.add(job)
+        process.terminate()
+
+
+def merge_outputs(args, jobs, batch_state, logger):
+    outputs = []
+    for job in jobs:
+        if batch_state[job]["status"] != "done":
+            continue
+        heartbeat = read_heartbeat(heartbeat_path(args, job))
+        if heartbeat is not None and heartbeat["status"] == "done":
+            outputs.append(heartbeat["output"])
+    logger.info(f"Merging {len(outputs)} outputs into {args.merge}")
+    subprocess.run(["hadd", "-f", args.merge, *outputs], check=True)
+
+
+def run(state):
+    args = state.args
+    logger = state.logger
+
+    if args.plan:
+        with open(args.plan) as f:
+            nsteps = json.load(f)["nsteps"]
+    else:
+        nsteps = args.nsteps
+
+    steps = list(range(nsteps))
+    if args.steps:
+        steps = [int(s) for s in args.steps.split(",")]
+
+    batch_state = {} if args.restart else read_batch_state(args.state_file)
+    commands = {str(s): step_command(args, s, nsteps) for s in steps}
+    # Steps resplit in an earlier run are replaced by their resplit steps
+    for job, job_state in list(batch_state.items()):
+        if "command" in job_state:
+            commands[job] = job_state["command"]
+    todo = [
+        job
+        for job in commands
+        if batch_state.get(job, {}).get("status") not in ("done", "resplit")
+    ]
+    logger.info(
+        f"Running {len(todo)}/{len(commands)} steps with concurrency "
+        f"{args.concurrency}"
+    )
+    for job in todo:
+        batch_state[job] = {**batch_state.get(job, {}), "status": "pending"}
+    write_batch_state(args.state_file, batch_state)
+
+    if args.heartbeat_dir:
+        os.makedirs(args.heartbeat_dir, exist_ok=True)
+
+    start = time.time()
+    step_time = 0.0
+    failed = []
+    processes = {}
+    stopped = set()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {
+            executor.submit(run_step, args, job, commands[job], processes, stopped)
+            for job in todo
+        }
+        while len(futures) > 0:
+            done, futures = wait(futures, timeout=10, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, returncode, attempts, elapsed = future.result()
+                step_time += elapsed
+                status = "done" if returncode == 0 else "failed"
+                heartbeat = None
+                if returncode != 0 and job in stopped:
+                    heartbeat = read_heartbeat(heartbeat_path(args, job))
+                    status = "resplit"
+                if status == "resplit" and heartbeat is None:
+                    # Without a heartbeat the files of the step are unknown,
+                    # so it is rerun as a whole on the next batch run
+                    logger.warning(f"No heartbeat of stopped step {job}")
+                    status = "failed"
+                if status == "failed":
+                    failed.append(job)
+                batch_state[job] = {
+                    **batch_state[job],
+                    "status": status,
+                    "attempts": attempts,
+                    "returncode": returncode,
+                    "elapsed": elapsed,
+                }
+                logger.info(
+                    f"Step {job} {status} after {attempts} attempt(s) in "
+                    f"{elapsed:.1f} s"
+                )
+
+                if status == "resplit":
+                    for new_job, command in resplit_commands(
+                        args, job, heartbeat["files"]
+                    ).items():
+                        commands[new_job] = command
+                        todo.append(new_job)
+                        batch_state[new_job] = {"status": "pending", "command": command}
+                        futures.add(
+                            executor.submit(
+                                run_step, args, new_job, command, processes, stopped
+                            )
+                        )
+                write_batch_state(args.state_file, batch_state)
+
+            if args.straggler_factor:
+                stop_stragglers(args, commands, processes, stopped, logger)
+
+    elapsed = time.time() - start
+    logger.info(
+        f"Ran {len(todo)} steps in {elapsed:.1f} s "
+        f"({len(todo) / max(elapsed, 1e-9) * 3600:.1f} steps/h, "
+        f"speed-up {step_time / max(elapsed, 1e-9):.2f}x over sequential)"
+    )
+    if len(failed) > 0:
+        raise RuntimeError(f"Steps {sorted(failed)} failed, see {args.log_dir}")
+
+    if args.merge:
+        merge_outputs(args, commands, batch_state, logger)
@@ -1,5 +1,8 @@
+import bisect
+import hashlib
 import json
 import os
+import shutil
 
 
 def update_state(state):
@@ -23,12 +26,99 @@ def add_find_json_parser(subparsers):
         "--run_range", required=True, type=str, help="Run number"
     )
     find_json_parser.add_argument("--out", required=False, type=str, help="Output file")
+    find_json_parser.add_argument(
+        "--catalog",
+        type=str,
+        help="Path to a catalog .json file storing \
+            the run coverage of each JSON file. Entries are rebuilt only when \
+            the JSON file changes.",
+    )
+    find_json_parser.add_argument(
+        "--link",
+        action="store_true",
+        help="Symlink the selected JSON file \
+            instead of copying it",
+    )
 
 
 def validate_args(args):
     pass
 
 
+def json_entry(json_file):
+    """
+    Catalog entry of a golden JSON file: hash, run coverage and number of
+    lumisections.
+    """
+    with open(json_file, "rb") as f:
+        content = f.read()
+    data = json.loads(content)
+    runs = [int(r) for r in data.keys()]
+    stat = os.stat(json_file)
+
+    return {
+        "path": json_file,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "sha256": hashlib.sha256(content).hexdigest(),
+        "min_run": min(runs),
+        "max_run": max(runs),
+        "n_runs": len(runs),
+        "n_lumisections": sum(
+            last - first + 1 for ranges in data.values() for first, last in ranges
+        ),
+    }
+
+
+def update_catalog(json_files, catalog_path=None):
+    """
+    Catalog entries of the given JSON files, sorted by max_run. Only files
+    that are new or changed (size or mtime) since the catalog was written
+    are parsed.
+    """
+    catalog = {}
+    if catalog_path is not None and os.path.exists(catalog_path):
+        with open(catalog_path) as f:
+            catalog = {entry["path"]: entry for entry in json.load(f)}
+
+    changed = False
+    for json_file in json_files:
+        stat = os.stat(json_file)
+        entry = catalog.get(json_file)
+        if (
+            entry is None
+            or entry["size"] != stat.st_size
+            or entry["mtime"] != stat.st_mtime_ns
+        ):
+            catalog[json_file] = json_entry(json_file)
+            changed = True
+
+    if catalog_path is not None and changed:
+        with open(f"{catalog_path}.tmp", "w") as f:
+            json.dump(list(catalog.values()), f, indent=1)
+        os.replace(f"{catalog_path}.tmp", catalog_path)
+
+    return sorted((catalog[j] for j in set(json_files)), key=lambda e: e["max_run"])
+
+
+def select_json(entries, run_range):
+    """
+    Select the newest JSON file containing the whole run range or, if there
+    is none, the newest one containing the last run of the range. The
+    entries must be sorted by max_run.
+    """
+    first = bisect.bisect_left([e["max_run"] for e in entries], run_range[1])
+    candidates = entries[first:][::-1]
+
+    for entry in candidates:
+        if entry["min_run"] <= run_range[0]:
+            return entry
+    for entry in candidates:
+        if entry["min_run"] <= run_range[1]:
+            return entry
+    return None
+
+
 def run(state):
     args = state.args
     json_files = [s.strip() for s in args.json_files.split(",")]
@@ -43,45 +133,24 @@ def run(state):
 
     state.logger.info(f"json_files: {json_files}")
 
-    newest_run = 0
-    newest_json = ""
-    partial = True
-    for json_file in json_files:
-        with open(json_file) as f:
-            data = json.load(f)
-            runs = [int(r) for r in data.keys()]
-
-            min_run = min(runs)
-            max_run = max(runs)
+    entries = update_catalog(json_files, args.catalog)
+    entry = select_json(entries, run_range)
 
-            if (
-                run_range[0] >= min_run
-                and run_range[1] <= max_run
-                and max_run > newest_run
-            ):
-                newest_run = max_run
-                newest_json = json_file
-
-                # JSON file containing the whole run range found.
-                # Set partial to False in order to prevent JSON file update
-                # on partially matching ranges.
-                partial = False
-            elif (
-                run_range[1] >= min_run
-                and run_range[1] <= max_run
-                and max_run > newest_run
-                and partial
+    newest_run = 0
+    if entry is not None:
+        newest_json = entry["path"]
+        newest_run = entry["max_run"]
+        if output_file == "":
+            output_file = newest_json.split("/")[-1]
+        if os.path.abspath(newest_json) != os.path.abspath(output_file):
+            if os.path.islink(output_file) or (
+                args.link and os.path.isfile(output_file)
             ):
-                # If no JSON file containing the whole run range is found,
-                # use JSON file containing the latest run of the given range.
-                newest_run = max_run
-                newest_json = json_file
-
-    if newest_json != "" and output_file != "":
-        os.system(f"cp -r {newest_json} {output_file}")
-    elif newest_json != "":
-        output_file = newest_json.split("/")[-1]
-        os.system(f"cp -r {newest_json} {output_file}")
+                os.remove(output_file)
+            if args.link:
+                os.symlink(os.path.abspath(newest_json), output_file)
+            else:
+                shutil.copy(newest_json, output_file)
 
     state.logger.info(f"Newest JSON file: {output_file}")
     state.logger.info(f"Newest run: {newest_run}")
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
+import json
 import os
-from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 
 def update_state(state):
@@ -45,40 +46,110 @@ def add_find_newest_parser(subparsers):
         help="Depth of files to search for \
             in the directory tree (default: None)",
     )
+    find_newest_parser.add_argument(
+        "--workers",
+        type=int,
+        default=16,
+        help="Number of directories scanned \
+            concurrently",
+    )
+    find_newest_parser.add_argument(
+        "--index",
+        type=str,
+        help="Path to a .json index of the \
+            directory tree. Only directories whose mtime changed since the \
+            last scan are listed again.",
+    )
 
 
 def validate_args(args):
-    pass
-
-
-def find_newest_files(root_dir, starts_with, ends_with, max_depth=None):
-    newest_files = defaultdict(lambda: {"path": None, "mtime": 0})
-
-    # Walk through the directory tree
-    for dirpath, _, filenames in os.walk(root_dir):
-        # Calculate the current directory depth relative to root_dir
-        current_depth = dirpath[len(root_dir.split(os.path.sep)[0]) :].count(
-            os.path.sep
-        )
-
-        # Check if we exceed the maximum allowed depth
-        if max_depth is not None and current_depth > max_depth:
-            # Skip processing files in directories beyond max_depth
-            continue
-
-        for filename in filenames:
-            # and filename.endswith(ends_with):
-            if filename.startswith(starts_with):
-                file_path = os.path.join(dirpath, filename)
-                mtime = os.path.getmtime(file_path)
-
-                # Check if this file is the newest in its directory
-                if mtime > newest_files[dirpath]["mtime"]:
-                    newest_files[dirpath]["path"] = file_path
-                    newest_files[dirpath]["mtime"] = mtime
+    if args.workers < 1:
+        raise ValueError("Number of workers must be at least 1")
+
+
+def read_index(index_path, starts_with):
+    if index_path is None or not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        index = json.load(f)
+    # The file listings depend on the prefix
+    if index.get("starts_with") != starts_with:
+        return {}
+    return index["dirs"]
+
+
+def write_index(index_path, starts_with, dirs):
+    with open(f"{index_path}.tmp", "w") as f:
+        json.dump({"starts_with": starts_with, "dirs": dirs}, f)
+    os.replace(f"{index_path}.tmp", index_path)
+
+
+def scan_directory(path, starts_with, index):
+    """
+    List the subdirectories and the files starting with starts_with (with
+    their mtimes) of a directory. The listing in the index is reused if the
+    mtime of the directory has not changed.
+    """
+    try:
+        dir_mtime = os.stat(path).st_mtime_ns
+        cached = index.get(path)
+        if cached is not None and cached["mtime"] == dir_mtime:
+            return cached
+
+        subdirs = []
+        files = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # Like os.walk, do not follow symlinks to directories
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.startswith(starts_with):
+                    files.append([entry.name, entry.stat().st_mtime])
+    except OSError:
+        return {"mtime": None, "subdirs": [], "files": []}
+
+    return {"mtime": dir_mtime, "subdirs": subdirs, "files": files}
+
+
+def find_newest_files(
+    root_dir, starts_with, ends_with, max_depth=None, workers=16, index_path=None
+):
+    """
+    Find the newest file starting with starts_with in each directory under
+    root_dir, down to max_depth levels below it. Directories are scanned
+    concurrently and not descended into beyond max_depth.
+    """
+    index = read_index(index_path, starts_with)
+    scanned = {}
+    newest_files = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {
+            executor.submit(scan_directory, root_dir, starts_with, index): (root_dir, 0)
+        }
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dirpath, depth = pending.pop(future)
+                listing = future.result()
+                scanned[dirpath] = listing
+
+                if len(listing["files"]) > 0:
+                    filename, _ = max(listing["files"], key=lambda f: f[1])
+                    newest_files[dirpath] = os.path.join(dirpath, filename)
+
+                if max_depth is None or depth < max_depth:
+                    for subdir in listing["subdirs"]:
+                        future = executor.submit(
+                            scan_directory, subdir, starts_with, index
+                        )
+                        pending[future] = (subdir, depth + 1)
+
+    if index_path is not None:
+        write_index(index_path, starts_with, scanned)
 
     # Return a list of newest file paths
-    return [entry["path"] for entry in newest_files.values()]
+    return [newest_files[dirpath] for dirpath in sorted(newest_files)]
 
 
 def run(state):
@@ -95,9 +166,11 @@ def run(state):
         starts_with = args.starts_with
     if args.ends_with:
         ends_with = args.ends_with
-    if args.max_depth:
+    if args.max_depth is not None:
         max_depth = args.max_depth
-    newest_files = find_newest_files(root_directory, starts_with, ends_with, max_depth)
+    newest_files = find_newest_files(
+        root_directory, starts_with, ends_with, max_depth, args.workers, args.index
+    )
     if not args.spaces:
         # Print the list comma-separated
         print(",".join(newest_files))
@@ -1,5 +1,21 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import ROOT
-from jec4prompt.utils.processing_utils import file_read_lines
+from jec4prompt.utils.backend_utils import (
+    add_backend_args,
+    close_backend,
+    make_rdataframe,
+    scaling_benchmark,
+    validate_backend_args,
+)
+from jec4prompt.utils.file_cache import add_cache_args, open_cache, validate_cache_args
+from jec4prompt.utils.processing_utils import (
+    file_key,
+    file_read_lines,
+    read_json_cache,
+    write_json_cache,
+)
 
 
 def update_state(state):
@@ -51,16 +67,134 @@ def add_find_range_parser(subparsers):
     find_range_parser.add_argument(
         "--progress_bar", action="store_true", help="Show progress bar"
     )
+    find_range_parser.add_argument(
+        "--method",
+        type=str,
+        default="metadata",
+        choices=["metadata", "scan"],
+        help="metadata: read the run range \
+            from the run branch of skims or the Runs tree of NanoAOD. \
+            scan: loop over all events of the Events tree (slow).",
+    )
+    find_range_parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of files opened in \
+            parallel with the metadata method",
+    )
+    find_range_parser.add_argument(
+        "--cache",
+        type=str,
+        help="Path to a .json file caching the \
+            run range of each file (keyed by path, size and mtime)",
+    )
+    add_backend_args(find_range_parser)
+    add_cache_args(find_range_parser)
+    find_range_parser.add_argument(
+        "--benchmark",
+        type=int,
+        help="Time the scan method on local Dask \
+            clusters of 1, 2, 4, ... up to the given number of workers",
+    )
 
 
 def validate_args(args):
-    pass
+    if args.workers < 1:
+        raise ValueError("Number of workers must be at least 1")
+    validate_backend_args(args)
+    validate_cache_args(args)
+    if args.backend != "local" and args.method != "scan":
+        raise ValueError("--backend applies only to --method scan")
+    if args.cache_dir and args.method != "scan":
+        raise ValueError("--cache_dir applies only to --method scan")
+    if args.benchmark is not None and args.benchmark < 1:
+        raise ValueError("benchmark should be at least 1 worker")
 
 
 def find_run_range(rdf):
     return int(rdf.Min("run").GetValue()), int(rdf.Max("run").GetValue())
 
 
+def scan_run_range(files, args, client=None):
+    """
+    Find the run range of the files by looping over their events on the
+    backend selected by args.
+    """
+    rdf, handle = make_rdataframe("Events", files, args, client)
+    if args.progress_bar and args.backend == "local":
+        ROOT.RDF.Experimental.AddProgressBar(rdf)
+
+    run_range = find_run_range(rdf)
+    if client is None:
+        close_backend(handle)
+    return run_range
+
+
+def file_run_range(file):
+    """
+    Run range of a single file without an event loop. Skims (with the
+    min_run column added by skim) can be filtered by run, so their range is
+    read from the run branch of Events alone; their Runs tree and min_run
+    and max_run columns hold the unfiltered and the requested ranges.
+    Unskimmed NanoAOD uses its Runs tree. Returns an empty tuple for a skim
+    without events and None if neither applies.
+    """
+    tfile = ROOT.TFile.Open(file)
+    if not tfile or tfile.IsZombie():
+        raise OSError(f"Could not open {file}")
+
+    run_range = None
+    runs = tfile.Get("Runs")
+    events = tfile.Get("Events")
+    if events and events.GetBranch("min_run"):
+        run_range = ()
+        if events.GetEntries() > 0:
+            run_range = (int(events.GetMinimum("run")), int(events.GetMaximum("run")))
+    elif runs and runs.GetEntries() > 0:
+        run_range = (int(runs.GetMinimum("run")), int(runs.GetMaximum("run")))
+    tfile.Close()
+
+    return run_range
+
+
+def find_run_range_metadata(files, workers=8, cache_path=None, logger=None):
+    """
+    Find the run range of the files from metadata, opening up to workers
+    files concurrently. Run ranges are cached per file if cache_path is set.
+    """
+    cache = read_json_cache(cache_path)
+    keys = {file: file_key(file) for file in files}
+    missing = [file for file in files if keys[file] not in cache]
+
+    if len(missing) > 0:
+        # Let the file opening and reading run outside of the GIL
+        ROOT.EnableThreadSafety()
+        for method in (ROOT.TFile.Open, ROOT.TTree.GetMinimum, ROOT.TTree.GetMaximum):
+            method.__release_gil__ = True
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for file, run_range in zip(missing, executor.map(file_run_range, missing)):
+                if run_range is None:
+                    raise ValueError(
+                        f"{file} is neither a skim nor NanoAOD with a Runs tree, "
+                        "use --method scan"
+                    )
+                cache[keys[file]] = run_range
+
+    if cache_path is not None:
+        write_json_cache(cache_path, cache)
+    if logger is not None:
+        logger.info(
+            f"Run ranges of {len(files) - len(missing)}/{len(files)} files "
+            "read from the cache"
+        )
+
+    ranges = [cache[keys[file]] for file in files if len(cache[keys[file]]) > 0]
+    if len(ranges) == 0:
+        raise ValueError("No events in the files")
+    return min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+
 def run(state):
     args = state.args
     # Shut up ROOT
@@ -69,6 +203,7 @@ def run(state):
     if args.nThreads:
         ROOT.EnableImplicitMT(args.nThreads)
 
+    files = []
     # Split the file list and trigger list if they are given as a string
     if args.filelist:
         files = args.filelist.split(",")
@@ -79,18 +214,33 @@ def run(state):
     else:
         raise ValueError("No file list provided")
 
-    chain = ROOT.TChain("Events")
-    for file in files:
-        if args.is_local:
-            chain.Add(file)
-        else:
-            chain.Add(f"root://cms-xrd-global.cern.ch/{file}")
+    if not args.is_local:
+        files = [f"root://cms-xrd-global.cern.ch/{file}" for file in files]
 
-    rdf = ROOT.RDataFrame(chain)
-    if args.progress_bar:
-        ROOT.RDF.Experimental.AddProgressBar(rdf)
+    if args.benchmark:
+        args.backend = "dask"
+        scaling_benchmark(scan_run_range, files, args, args.benchmark, state.logger)
+        return
+
+    start = time.time()
+    if args.method == "metadata":
+        # Only the small Runs tree is read, copying whole files is not worth it
+        min_run, max_run = find_run_range_metadata(
+            files, args.workers, args.cache, state.logger
+        )
+    else:
+        file_cache = None if args.is_local else open_cache(args, state.logger)
+        if file_cache is not None:
+            files = file_cache.resolve(files)
+        min_run, max_run = scan_run_range(files, args)
+        if file_cache is not None:
+            file_cache.close()
+    elapsed = time.time() - start
+    state.logger.info(
+        f"Found run range of {len(files)} files in {elapsed:.2f} s "
+        f"({len(files) / max(elapsed, 1e-9):.1f} files/s)"
+    )
 
-    min_run, max_run = find_run_range(rdf)
     if args.for_brilcalc:
         print(f"--begin {min_run} --end {max_run}")
     else:
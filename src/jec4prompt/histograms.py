@@ -2,10 +2,18 @@ import argparse
 import configparser
 import json
 import os
+import time
 
 import ROOT
 
 # import tomllib
+from jec4prompt.utils.backend_utils import (
+    add_backend_args,
+    close_backend,
+    make_rdataframe,
+    validate_backend_args,
+)
+from jec4prompt.utils.file_cache import add_cache_args, open_cache, validate_cache_args
 from jec4prompt.utils.processing_utils import file_read_lines, get_bins, read_config_file
 
 
@@ -97,6 +105,8 @@ def add_hist_parser(subparsers):
         help="Output path \
             (output file name included)",
     )
+    add_backend_args(hist_parser)
+    add_cache_args(hist_parser)
 
 
 def validate_args(args):
@@ -104,6 +114,8 @@ def validate_args(args):
         raise argparse.ArgumentError(
             None, "--channel argument is required when --triggerfile is provided"
         )
+    validate_backend_args(args)
+    validate_cache_args(args)
 
 
 def create_histogram(rdf, hist_config, bins, triggers):
@@ -206,19 +218,66 @@ def create_histogram(rdf, hist_config, bins, triggers):
             hist_config["z_val"],
             "weight",
         )
+    elif hist_config["type"] == "ProfileMoments2D":
+        return create_moments_profile(rdf, hist_config, bins)
     else:
         raise ValueError(f"Unknown histogram type: {hist_config['type']}")
 
 
+def create_moments_profile(rdf, hist_config, bins):
+    """
+    Book a profile-with-moments histogram: a Profile2D of z_val in bins of
+    (x_val, y_val) holding the sum of weights, the weighted sum and the weighted
+    sum of squares per cell, and one weighted Histo2D per higher moment up to
+    the order given by the optional "moments" key (sum of weight * z_val^k).
+    """
+    results = [
+        rdf.Profile2D(
+            (
+                hist_config["name"],
+                hist_config["title"],
+                bins[hist_config["x_bins"]]["n"],
+                bins[hist_config["x_bins"]]["bins"],
+                bins[hist_config["y_bins"]]["n"],
+                bins[hist_config["y_bins"]]["bins"],
+            ),
+            hist_config["x_val"],
+            hist_config["y_val"],
+            hist_config["z_val"],
+            "weight",
+        )
+    ]
+
+    n_moments = int(hist_config.get("moments", 2))
+    for k in range(3, n_moments + 1):
+        moment_col = f"{hist_config['name']}_moment{k}_temp"
+        results.append(
+            rdf.Define(
+                moment_col, f"weight * pow({hist_config['z_val']}, {k})"
+            ).Histo2D(
+                (
+                    f"{hist_config['name']}_moment{k}",
+                    hist_config["title"],
+                    bins[hist_config["x_bins"]]["n"],
+                    bins[hist_config["x_bins"]]["bins"],
+                    bins[hist_config["y_bins"]]["n"],
+                    bins[hist_config["y_bins"]]["bins"],
+                ),
+                hist_config["x_val"],
+                hist_config["y_val"],
+                moment_col,
+            )
+        )
+
+    return results
+
+
 def make_histograms(args, logger):
     bins = get_bins()
 
     if args.nThreads:
         ROOT.EnableImplicitMT(args.nThreads)
 
-    events_chain = ROOT.TChain("Events")
-    runs_chain = ROOT.TChain("Runs")
-
     # Split the file list and trigger list if they are given as a string
     if args.filelist:
         filelist = [s.strip() for s in args.filelist.split(",")]
@@ -238,17 +297,16 @@ def make_histograms(args, logger):
         triggers[trigger] = triggers[trigger]["cut"]
 
     # Load the files
-    for file in filelist:
-        if not args.is_local:
-            events_chain.Add(f"{args.redirector}{file}")
-            runs_chain.Add(f"{args.redirector}{file}")
-        else:
-            events_chain.Add(file)
-            runs_chain.Add(file)
+    if not args.is_local:
+        filelist = [f"{args.redirector}{file}" for file in filelist]
+        cache = open_cache(args, logger)
+        if cache is not None:
+            filelist = cache.resolve(filelist)
+            cache.close()
 
-    events_rdf = ROOT.RDataFrame(events_chain)
+    events_rdf, backend = make_rdataframe("Events", filelist, args)
 
-    if args.progress_bar:
+    if args.progress_bar and args.backend == "local":
         ROOT.RDF.Experimental.AddProgressBar(events_rdf)
 
     region_configs = {}
@@ -281,12 +339,20 @@ def make_histograms(args, logger):
         for hist in hist_config:
             if hist.lower() == "default":
                 continue
-            all_hists.append(
-                create_histogram(events_rdf, hist_config[hist], bins, triggers)
-            )
+            booked = create_histogram(events_rdf, hist_config[hist], bins, triggers)
+            if isinstance(booked, list):
+                all_hists.extend(booked)
+            else:
+                all_hists.append(booked)
 
+    start = time.time()
     for hist in all_hists:
         histograms[hist.GetName()] = hist.GetValue()
+    close_backend(backend)
+    logger.info(
+        f"Filled {len(histograms)} histograms from {len(filelist)} files "
+        f"with the {args.backend} backend in {time.time() - start:.1f} s"
+    )
 
     return histograms
 
@@ -333,11 +399,20 @@ def run(state):
         config = read_config_file(args.config)
         for arg, value in config["GENERAL"].items():
             # Do a type conversion for the option
-            if arg == "is_local" or arg == "nThreads" or arg == "progress_bar":
+            if arg in (
+                "is_local",
+                "nThreads",
+                "progress_bar",
+                "npartitions",
+                "dask_workers",
+                "prefetch_workers",
+            ):
                 if value == "":
                     setattr(args, arg, 0)
                 else:
                     setattr(args, arg, int(value))
+            elif arg == "cache_size":
+                setattr(args, arg, float(value))
             else:
                 setattr(args, arg, value)
 
@@ -1,17 +1,25 @@
 import argparse
+import importlib
 import logging
 from pathlib import Path
 
-import jec4prompt.find_json as find_json
-import jec4prompt.find_newest as find_newest
-import jec4prompt.find_range as find_range
-import jec4prompt.histograms as histograms
-import jec4prompt.produce_ratio as produce_ratio
-import jec4prompt.produce_responses as produce_responses
-import jec4prompt.produce_time_evolution as produce_time_evolution
-import jec4prompt.produce_vetomaps as produce_vetomaps
-import jec4prompt.skim as skim
-from jec4prompt.plotting import produce_plots
+# Module of each subcommand. Only the module of the command being run is
+# imported, so that commands without ROOT (produce_plots --backend mpl) and
+# the worker processes they spawn start without loading it.
+command_modules = {
+    "skim": "jec4prompt.skim",
+    "hist": "jec4prompt.histograms",
+    "find_json": "jec4prompt.find_json",
+    "find_newest": "jec4prompt.find_newest",
+    "find_range": "jec4prompt.find_range",
+    "produce_ratio": "jec4prompt.produce_ratio",
+    "produce_responses": "jec4prompt.produce_responses",
+    "produce_time_evolution": "jec4prompt.produce_time_evolution",
+    "produce_plots": "jec4prompt.plotting.produce_plots",
+    "produce_vetomaps": "jec4prompt.produce_vetomaps",
+    "plan_skim": "jec4prompt.plan_skim",
+    "batch": "jec4prompt.batch",
+}
 
 
 class ProcessingState:
@@ -55,16 +63,15 @@ class ProcessingState:
 
     def init_state(self):
         self.logger.info("Initializing state")
-        skim.update_state(self)
-        histograms.update_state(self)
-        find_json.update_state(self)
-        find_newest.update_state(self)
-        find_range.update_state(self)
-        produce_ratio.update_state(self)
-        produce_responses.update_state(self)
-        produce_time_evolution.update_state(self)
-        produce_plots.update_state(self)
-        produce_vetomaps.update_state(self)
+        # The command is the first positional argument after the options
+        peek = argparse.ArgumentParser(add_help=False)
+        for option in ("--log", "--tag", "--redirector"):
+            peek.add_argument(option)
+        peek.add_argument("command", nargs="?")
+        command = peek.parse_known_args()[0].command
+        commands = [command] if command in command_modules else command_modules
+        for name in commands:
+            importlib.import_module(command_modules[name]).update_state(self)
 
         self.args = self.parser.parse_args()
         self.logger.info(f"Parsed arguments: {self.args}")
@@ -0,0 +1,210 @@
+import heapq
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import ROOT
+from jec4prompt.utils.processing_utils import (
+    file_key,
+    file_read_lines,
+    read_json_cache,
+    write_json_cache,
+)
+
+
+def update_state(state):
+    add_plan_skim_parser(state.subparsers)
+    state.valfuncs["plan_skim"] = validate_args
+    state.commands["plan_skim"] = run
+
+
+def add_plan_skim_parser(subparsers):
+    plan_parser = subparsers.add_parser(
+        "plan_skim",
+        help="Plan balanced skim steps \
+            for given input files",
+    )
+    plan_files = plan_parser.add_mutually_exclusive_group(required=True)
+    plan_files.add_argument(
+        "--filelist", type=str, help="Comma separated list of root files"
+    )
+    plan_files.add_argument(
+        "-fp",
+        "--filepaths",
+        type=str,
+        help="Comma separated list of \
+            text files containing input files (one input file per line).",
+    )
+    plan_parser.add_argument(
+        "--nsteps", type=int, required=True, help="Number of steps to plan."
+    )
+    plan_parser.add_argument(
+        "--out", type=str, required=True, help="Path to the output plan .json file"
+    )
+    plan_parser.add_argument(
+        "--balance",
+        type=str,
+        default="entries",
+        choices=["entries", "bytes"],
+        help="Balance the steps by number of \
+            events or by file size",
+    )
+    plan_parser.add_argument(
+        "--max_entries",
+        type=int,
+        help="Split files with more entries \
+            than this into entry ranges",
+    )
+    plan_parser.add_argument(
+        "--is_local",
+        action="store_true",
+        help="Run locally. If not set will \
+            prepend the redirector to the file names",
+    )
+    plan_parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of files opened in parallel",
+    )
+    plan_parser.add_argument(
+        "--cache",
+        type=str,
+        help="Path to a .json file caching the \
+            size and number of entries of each file",
+    )
+
+
+def validate_args(args):
+    if args.nsteps < 1:
+        raise ValueError("nsteps should be at least 1")
+    if args.max_entries is not None and args.max_entries < 1:
+        raise ValueError("max_entries should be at least 1")
+    if args.workers < 1:
+        raise ValueError("Number of workers must be at least 1")
+
+
+def file_info(file):
+    """
+    Size in bytes and number of Events entries of a file.
+    """
+    tfile = ROOT.TFile.Open(file)
+    if not tfile or tfile.IsZombie():
+        raise OSError(f"Could not open {file}")
+    events = tfile.Get("Events")
+    info = {"bytes": tfile.GetSize(), "entries": events.GetEntries() if events else 0}
+    tfile.Close()
+    return info
+
+
+def collect_file_info(files, workers=8, cache_path=None, redirector=""):
+    """
+    Sizes and entry counts of the files, read concurrently and cached per
+    file if cache_path is set.
+    """
+    cache = read_json_cache(cache_path)
+    keys = {file: file_key(f"{redirector}{file}") for file in files}
+    missing = [file for file in files if keys[file] not in cache]
+
+    if len(missing) > 0:
+        # Let the file opening run outside of the GIL
+        ROOT.EnableThreadSafety()
+        ROOT.TFile.Open.__release_gil__ = True
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            infos = executor.map(file_info, [f"{redirector}{f}" for f in missing])
+            for file, info in zip(missing, infos):
+                cache[keys[file]] = info
+
+    if cache_path is not None:
+        write_json_cache(cache_path, cache)
+
+    return {file: cache[keys[file]] for file in files}
+
+
+def plan_steps(infos, nsteps, balance="entries", max_entries=None):
+    """
+    Assign files (or entry ranges of large files) to steps by greedy
+    bin-packing, largest item first, on entries or bytes. Returns the steps
+    as lists of {"file", "first", "last"} items and the load of each step.
+    """
+    items = []
+    for file, info in infos.items():
+        entries = info["entries"]
+        n_chunks = 1
+        if max_entries is not None and entries > max_entries:
+            n_chunks = math.ceil(entries / max_entries)
+        for k in range(n_chunks):
+            first = entries * k // n_chunks
+            last = entries * (k + 1) // n_chunks
+            weight = info[balance] * (last - first) / entries if entries > 0 else 0
+            item = {"file": file}
+            if n_chunks > 1:
+                item["first"] = first
+                item["last"] = last
+            items.append((weight, len(items), item))
+
+    steps: List[list] = [[] for _ in range(nsteps)]
+    loads = [(0.0, i) for i in range(nsteps)]
+    for weight, _, item in sorted(items, key=lambda x: (-x[0], x[1])):
+        load, i = heapq.heappop(loads)
+        steps[i].append(item)
+        heapq.heappush(loads, (load + weight, i))
+
+    step_loads = [0.0] * nsteps
+    for load, i in loads:
+        step_loads[i] = load
+
+    return steps, step_loads
+
+
+def load_spread(loads):
+    mean = sum(loads) / len(loads)
+    return max(loads) / mean if mean > 0 else 1.0
+
+
+def run(state):
+    args = state.args
+    logger = state.logger
+    # shut up ROOT
+    ROOT.gErrorIgnoreLevel = ROOT.kWarning
+
+    files: List[str] = []
+    if args.filepaths:
+        paths = [p.strip() for p in args.filepaths.split(",")]
+        for path in paths:
+            files.extend(file_read_lines(path))
+    else:
+        files = [s.strip() for s in args.filelist.split(",")]
+
+    start = time.time()
+    redirector = "" if args.is_local else state.args.redirector
+    infos = collect_file_info(files, args.workers, args.cache, redirector)
+    logger.info(f"Collected info of {len(files)} files in {time.time() - start:.1f} s")
+
+    steps, loads = plan_steps(infos, args.nsteps, args.balance, args.max_entries)
+
+    # Compare with the default files[i::n] split
+    default_loads = [
+        sum(infos[file][args.balance] for file in files[i :: args.nsteps])
+        for i in range(args.nsteps)
+    ]
+    logger.info(
+        f"Expected slowest/average step ({args.balance}): "
+        f"{load_spread(loads):.2f} (files[i::n] split: "
+        f"{load_spread(default_loads):.2f})"
+    )
+
+    with open(args.out, "w") as f:
+        json.dump(
+            {
+                "nsteps": args.nsteps,
+                "balance": args.balance,
+                "loads": loads,
+                "steps": steps,
+            },
+            f,
+            indent=1,
+        )
+    print(args.out)
@@ -0,0 +1,402 @@
+"""
+matplotlib/mplhep plotting backend. Histograms are read with uproot, so this
+module does not import ROOT and starts quickly in worker processes.
+"""
+
+import hashlib
+import json
+import pathlib
+import re
+import time
+
+import matplotlib.pyplot as plt
+import mplhep as hep
+import numpy as np
+import uproot
+from jec4prompt.utils.plotting_utils import (
+    config_items,
+    read_manifest,
+    read_plot_config,
+    subfolder_name,
+)
+
+# ROOT marker styles and colors used in the plot configs
+root_markers = {
+    1: ".",
+    2: "+",
+    3: "*",
+    4: "o",
+    5: "x",
+    20: "o",
+    21: "s",
+    22: "^",
+    23: "v",
+    24: "o",
+    25: "s",
+    26: "^",
+    29: "*",
+    33: "D",
+    34: "P",
+}
+root_open_markers = {4, 24, 25, 26, 27, 28, 30, 32}
+root_colors = {
+    0: "white",
+    1: "black",
+    2: "red",
+    3: "green",
+    4: "blue",
+    5: "yellow",
+    6: "magenta",
+    7: "cyan",
+    8: "darkgreen",
+    9: "purple",
+}
+
+
+class Plot:
+    """
+    Bin edges, contents and errors of a 1D or 2D histogram (or projection)
+    together with its titles.
+    """
+
+    def __init__(self, name, title, edges, values, errors, axis_titles):
+        self.name = name
+        self.title = title
+        self.edges = edges
+        self.values = values
+        self.errors = errors
+        self.axis_titles = axis_titles
+
+    @property
+    def ndim(self):
+        return len(self.edges)
+
+
+def root_label(label: str) -> str:
+    """
+    Convert a ROOT TLatex label to matplotlib mathtext.
+    """
+    if not any(c in label for c in "#_^{"):
+        return label
+    label = re.sub(r"#([a-zA-Z]+)", r"\\\1", label)
+    return "$" + label.replace(" ", r"\ ") + "$"
+
+
+def profile_moments(h):
+    """
+    Per-bin sums (with flow) of a TProfile/TProfile2D indexed as [x(, y)].
+    """
+    shape = tuple(len(h.axis(i).edges()) + 1 for i in range(len(h.axes)))
+    sums = []
+    for member in ["fBinEntries", "fArray", "fSumw2", "fBinSumw2"]:
+        values = np.asarray(h.member(member), dtype=np.float64)
+        if len(values) == 0:
+            values = np.asarray(h.member("fBinEntries"), dtype=np.float64)
+        sums.append(values.reshape(shape[::-1]).T)
+    return sums
+
+
+def profile_values(sumw, sumwy, sumwy2, sumw2):
+    """
+    Mean and error of the mean of profile bins, as for the default TProfile
+    error option.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(sumw != 0, sumwy / sumw, 0.0)
+        var = np.clip(np.where(sumw != 0, sumwy2 / sumw - mean * mean, 0.0), 0, None)
+        neff = np.where(sumw2 != 0, sumw * sumw / sumw2, 0.0)
+        error = np.where(neff > 0, np.sqrt(var / neff), 0.0)
+    return mean, error
+
+
+def read_plot(h, projection=""):
+    """
+    Read an uproot histogram into a Plot, projecting it on the given axis
+    (including under- and overflow of the other axes, as ROOT does).
+    """
+    classname = h.classname
+    ndim = len(h.axes)
+    axis_titles = [h.axis(i).member("fTitle") for i in range(ndim)]
+    axes = [h.axis(i).edges() for i in range(ndim)]
+
+    keep = list(range(ndim))
+    if projection in ("x", "y", "z") and ndim > 1:
+        keep = [{"x": 0, "y": 1, "z": 2}[projection]]
+    summed = tuple(i for i in range(ndim) if i not in keep)
+    inner = tuple(slice(1, -1) for _ in keep)
+
+    if classname.startswith("TProfile"):
+        sums = [s.sum(axis=summed) if summed else s for s in profile_moments(h)]
+        values, errors = profile_values(*sums)
+        values, errors = values[inner], errors[inner]
+    else:
+        values = h.values(flow=True)
+        variances = h.variances(flow=True)
+        if summed:
+            values = values.sum(axis=summed)
+            variances = variances.sum(axis=summed)
+        values, errors = values[inner], np.sqrt(np.abs(variances[inner]))
+
+    if projection in ("x", "y", "z") and ndim > 1:
+        axis_titles = [axis_titles[keep[0]], ""]
+    return Plot(
+        h.member("fName"),
+        h.member("fTitle"),
+        [axes[i] for i in keep],
+        values,
+        errors,
+        axis_titles,
+    )
+
+
+def plot_hash(plots, config_section=None):
+    """
+    Hash of the bin contents and errors of the histograms of a plot and of
+    its (normalized) config section.
+    """
+    digest = hashlib.sha256(b"mpl")
+    if config_section is not None:
+        digest.update(json.dumps(config_items(config_section)).encode())
+    for plot in plots:
+        digest.update(json.dumps([plot.name, plot.title, plot.axis_titles]).encode())
+        for edges in plot.edges:
+            digest.update(np.asarray(edges, dtype=np.float64).tobytes())
+        digest.update(np.asarray(plot.values, dtype=np.float64).tobytes())
+        digest.update(np.asarray(plot.errors, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def plot_unchanged(plot_path, plots, config_section, manifest, hashes):
+    if hashes is None:
+        return False
+    hashes[plot_path] = plot_hash(plots, config_section)
+    return (
+        manifest is not None
+        and manifest.get(plot_path) == hashes[plot_path]
+        and pathlib.Path(plot_path).exists()
+    )
+
+
+def index_hists(file):
+    """
+    Index the histograms of each trigger by all three name forms accepted in
+    the plot config: hist, method/hist and system/method/hist.
+    """
+    index = {}
+    for path, classname in file.classnames(cycle=False).items():
+        parts = path.split("/")
+        if len(parts) != 4 or not classname.startswith(("TH", "TProfile")):
+            continue
+        trigger_name, system_name, method_name, hist_name = parts
+        paths, lookup = index.setdefault(trigger_name, ([], {}))
+        names = (
+            hist_name,
+            f"{method_name}/{hist_name}",
+            f"{system_name}/{method_name}/{hist_name}",
+        )
+        for name in names:
+            lookup.setdefault(name, []).append(len(paths))
+        paths.append(path)
+
+    return index
+
+
+def find_hists(index, trigger, hists_config):
+    paths, lookup = index.get(trigger, ([], {}))
+    positions = sorted({p for name in hists_config for p in lookup.get(name, [])})
+    return [paths[p] for p in positions]
+
+
+def draw(plots, output, xlim=None, ylim=None, logx=False, logy=False, **style):
+    """
+    Draw 1D plots as error bars or a 2D plot as a color map in CMS style and
+    save the figure.
+    """
+    hep.style.use("CMS")
+    fig, ax = plt.subplots(figsize=(10, 10))
+
+    markers = style.get("markers") or []
+    colors = style.get("colors") or []
+    entries = style.get("legend") or []
+    for i, plot in enumerate(plots):
+        if plot.ndim == 2:
+            hep.hist2dplot(plot.values, *plot.edges, ax=ax)
+            break
+        marker = root_markers.get(int(markers[i]), "o") if markers else "o"
+        color = root_colors.get(int(colors[i])) if colors else None
+        hep.histplot(
+            plot.values,
+            plot.edges[0],
+            yerr=plot.errors,
+            histtype="errorbar",
+            marker=marker,
+            color=color,
+            mfc="none" if markers and int(markers[i]) in root_open_markers else None,
+            label=root_label(entries[i]) if i < len(entries) else None,
+            ax=ax,
+        )
+
+    ax.set_xlabel(root_label(style.get("xtitle", "")))
+    ax.set_ylabel(root_label(style.get("ytitle", "")))
+    if logx:
+        ax.set_xscale("log")
+    if logy:
+        ax.set_yscale("log")
+    if xlim is not None:
+        ax.set_xlim(*xlim)
+    if ylim is not None:
+        ax.set_ylim(*ylim)
+    # ROOT label sizes are fractions of the pad height
+    for axis, key in ((ax.xaxis, "xlabelsize"), (ax.yaxis, "ylabelsize")):
+        if style.get(key):
+            axis.set_tick_params(labelsize=style[key] * fig.get_figheight() * 72)
+    if entries:
+        x1, y1, x2, y2 = style["legend_pos"]
+        ax.legend(
+            bbox_to_anchor=(x1, y1, x2 - x1, y2 - y1),
+            bbox_transform=fig.transFigure,
+            loc="center",
+        )
+
+    hep.cms.label("Preliminary", data=True, com=style.get("energy", "13.6"), ax=ax)
+    fig.savefig(output)
+    plt.close(fig)
+
+
+def produce_plots_all(file, output_path, manifest=None, hashes=None):
+    subfolder = subfolder_name(file.file.file_path)
+    n_plots = 0
+    for trigger, (paths, _) in index_hists(file).items():
+        for path in paths:
+            h = file[path]
+            # ignore 3D histograms and profiles for now
+            if len(h.axes) > 2:
+                continue
+
+            plot = read_plot(h)
+            plot_path = f"{output_path}/{subfolder}/{path}.pdf"
+            if plot_unchanged(plot_path, [plot], None, manifest, hashes):
+                continue
+            pathlib.Path(plot_path).parent.mkdir(exist_ok=True, parents=True)
+
+            if plot.ndim == 1:
+                ylim = (np.min(plot.values), 1.05 * np.max(plot.values))
+            else:
+                ylim = (plot.edges[1][0], plot.edges[1][-1])
+            draw(
+                [plot],
+                plot_path,
+                xlim=(plot.edges[0][0], plot.edges[0][-1]),
+                ylim=ylim if ylim[0] < ylim[1] else None,
+                xtitle=plot.axis_titles[0],
+                ytitle=plot.axis_titles[1] if plot.ndim == 2 else "",
+            )
+            n_plots += 1
+
+    return n_plots
+
+
+def produce_plots_from_config(
+    file, output_path, config, plots, index=None, manifest=None, hashes=None
+):
+    subfolder = subfolder_name(file.file.file_path)
+    if index is None:
+        index = index_hists(file)
+
+    n_plots = 0
+    for plot_name in plots:
+        section = config[plot_name]
+        if section["triggers"] == "":
+            triggers = list(index)
+        else:
+            triggers = [s.strip() for s in section["triggers"].split(",")]
+
+        hists_config = [s.strip() for s in section["hists"].split(",")]
+
+        for trigger in triggers:
+            collected_plots = [
+                read_plot(file[path], section["projection"])
+                for path in find_hists(index, trigger, hists_config)
+            ]
+            if len(collected_plots) == 0:
+                continue
+
+            if len({p.ndim for p in collected_plots}) > 1:
+                print(
+                    f"Skipping plotting of [{plot_name}], histogram list given in the config file contains both 1D and 2D histograms"
+                )
+                continue
+
+            plot_path = f"{output_path}/{subfolder}/{trigger}/{plot_name}.pdf"
+            if plot_unchanged(plot_path, collected_plots, section, manifest, hashes):
+                continue
+            pathlib.Path(plot_path).parent.mkdir(exist_ok=True, parents=True)
+
+            xlim = (
+                min(p.edges[0][0] for p in collected_plots),
+                max(p.edges[0][-1] for p in collected_plots),
+            )
+            if collected_plots[0].ndim == 1:
+                ylim = (
+                    min(np.min(p.values) for p in collected_plots),
+                    1.05 * max(np.max(p.values) for p in collected_plots),
+                )
+            else:
+                ylim = (
+                    min(p.edges[1][0] for p in collected_plots),
+                    max(p.edges[1][-1] for p in collected_plots),
+                )
+            if section["xlim"] != "":
+                xlim = tuple(map(float, section["xlim"].split(" ")))
+            if section["ylim"] != "":
+                ylim = tuple(map(float, section["ylim"].split(" ")))
+
+            titles = collected_plots[0].axis_titles
+            style = {
+                "xtitle": section["xtitle"] or titles[0],
+                "ytitle": section["ytitle"] or (titles[1] if len(titles) > 1 else ""),
+                "energy": section["energy"] or "13.6",
+            }
+            for key in ("xlabelsize", "ylabelsize"):
+                if section[key] != "":
+                    style[key] = float(section[key])
+            if section["markers"] != "":
+                style["markers"] = [s.strip() for s in section["markers"].split(",")]
+                style["colors"] = [s.strip() for s in section["colors"].split(",")]
+            if section["legend"] != "" and section["legendPos"] != "":
+                style["legend"] = [s.strip() for s in section["legend"].split("@")]
+                style["legend_pos"] = [
+                    float(s.strip()) for s in section["legendPos"].split(",")
+                ]
+
+            draw(
+                collected_plots,
+                plot_path,
+                xlim=xlim,
+                ylim=ylim if ylim[0] < ylim[1] else None,
+                logx=int(section["logx"]) == 1,
+                logy=int(section["logy"]) == 1,
+                **style,
+            )
+            n_plots += 1
+
+    return n_plots
+
+
+def render_plots(file, output_path, config_file, plots, produce_all, force=False):
+    """
+    Same as produce_plots_root.render_plots, using uproot and mplhep.
+    """
+    start = time.time()
+
+    config = read_plot_config(config_file)
+    manifest = None if force else read_manifest(output_path)
+    hashes = {}
+    with uproot.open(file) as root_file:
+        n_plots = produce_plots_from_config(
+            root_file, output_path, config, plots, manifest=manifest, hashes=hashes
+        )
+        if produce_all:
+            n_plots += produce_plots_all(root_file, output_path, manifest, hashes)
+
+    return file, n_plots, hashes, time.time() - start
@@ -0,0 +1,482 @@
+"""
+PyROOT and cmsstyle plotting backend of produce_plots.
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+import time
+
+import cmsstyle as CMS
+import numpy as np
+import ROOT
+from jec4prompt.utils.plotting_utils import (
+    config_items,
+    read_manifest,
+    read_plot_config,
+    subfolder_name,
+)
+
+
+def produce_plots_all(file, output_path, manifest=None, hashes=None):
+    subfolder = subfolder_name(file.GetName())
+    n_plots = 0
+    for trigger_key in file.GetListOfKeys():
+        trigger_name = trigger_key.GetName()
+        systems = file.Get(trigger_name)
+        for system_key in systems.GetListOfKeys():
+            system_name = system_key.GetName()
+            methods = systems.Get(system_name)
+            for method_key in methods.GetListOfKeys():
+                method_name = method_key.GetName()
+
+                pathlib.Path(
+                    "{}/{}/{}/{}/{}".format(
+                        output_path,
+                        subfolder,
+                        trigger_name,
+                        system_name,
+                        method_name,
+                    )
+                ).mkdir(exist_ok=True, parents=True)
+
+                hists = methods.Get(method_name)
+                for hist_key in hists.GetListOfKeys():
+                    hist_name = hist_key.GetName()
+                    hist = hists.Get(hist_name)
+
+                    # ignore 3D histograms and profiles for now
+                    if hist.InheritsFrom("TH3D") or hist.InheritsFrom("TProfile3D"):
+                        continue
+
+                    plot_path = "{}/{}/{}/{}/{}/{}.pdf".format(
+                        output_path,
+                        subfolder,
+                        trigger_name,
+                        system_name,
+                        method_name,
+                        hist_name,
+                    )
+                    if plot_unchanged(plot_path, [hist], None, manifest, hashes):
+                        hist.Delete()
+                        continue
+
+                    xtitle = hist.GetXaxis().GetTitle()
+                    ytitle = hist.GetYaxis().GetTitle()
+
+                    b_min, b_max = (hist.GetMinimumBin(), hist.GetMaximumBin())
+                    x_min, x_max = (
+                        hist.GetXaxis().GetXmin(),
+                        hist.GetXaxis().GetXmax(),
+                    )
+                    y_min, y_max = (
+                        hist.GetBinContent(b_min),
+                        hist.GetBinContent(b_max),
+                    )
+                    y_max = 1.05 * y_max
+                    iPos = 33
+
+                    # Move CMS logo/text out of frame so it does not get covered by the plot
+                    if hist.InheritsFrom("TH2D") or hist.InheritsFrom("TProfile2D"):
+                        x_min, x_max = (
+                            hist.GetXaxis().GetXmin(),
+                            hist.GetXaxis().GetXmax(),
+                        )
+                        y_min, y_max = (
+                            hist.GetYaxis().GetXmin(),
+                            hist.GetYaxis().GetXmax(),
+                        )
+                        iPos = 0
+
+                    CMS.SetExtraText("Preliminary")
+                    CMS.SetEnergy("13.6")
+                    CMS.SetLumi("")
+                    canv = CMS.cmsCanvas(
+                        "",
+                        x_min,
+                        x_max,
+                        y_min,
+                        y_max,
+                        xtitle,
+                        ytitle,
+                        square=True,
+                        extraSpace=0.0,
+                        iPos=iPos,
+                    )
+
+                    CMS.GetcmsCanvasHist(canv).GetYaxis().SetTitleOffset(1.5)
+                    CMS.GetcmsCanvasHist(canv).GetXaxis().SetTitleOffset(0.9)
+
+                    marker = hist.GetMarkerStyle()
+                    msize = hist.GetMarkerSize()
+                    mcolor = hist.GetMarkerColor()
+                    lstyle = hist.GetLineStyle()
+                    lwidth = hist.GetLineWidth()
+                    lcolor = hist.GetLineColor()
+                    fstyle = hist.GetFillStyle()
+                    fcolor = hist.GetFillColor()
+                    CMS.cmsDraw(
+                        hist,
+                        "",
+                        marker,
+                        msize,
+                        mcolor,
+                        lstyle,
+                        lwidth,
+                        lcolor,
+                        fstyle,
+                        fcolor,
+                    )
+
+                    CMS.SaveCanvas(canv, plot_path)
+                    release_plot(canv, [hist])
+                    n_plots += 1
+
+    return n_plots
+
+
+def plot_hash(hists, config_section=None):
+    """
+    Hash of the bin contents and errors of the histograms of a plot and of
+    its (normalized) config section.
+    """
+    digest = hashlib.sha256()
+    if config_section is not None:
+        digest.update(json.dumps(config_items(config_section)).encode())
+
+    for hist in hists:
+        axes = [hist.GetXaxis(), hist.GetYaxis(), hist.GetZaxis()]
+        digest.update(
+            json.dumps(
+                [hist.ClassName(), hist.GetName(), hist.GetTitle()]
+                + [[a.GetTitle(), a.GetNbins(), a.GetXmin(), a.GetXmax()] for a in axes]
+            ).encode()
+        )
+        n_cells = hist.GetNcells()
+        values = np.array(
+            [[hist.GetBinContent(i), hist.GetBinError(i)] for i in range(n_cells)]
+        )
+        digest.update(values.tobytes())
+
+    return digest.hexdigest()
+
+
+def plot_unchanged(plot_path, hists, config_section, manifest, hashes):
+    """
+    Record the hash of a plot in hashes. Returns True if the plot exists and
+    its hash matches the one in the manifest, i.e. it does not need to be
+    rendered again.
+    """
+    if hashes is None:
+        return False
+    hashes[plot_path] = plot_hash(hists, config_section)
+    return (
+        manifest is not None
+        and manifest.get(plot_path) == hashes[plot_path]
+        and os.path.exists(plot_path)
+    )
+
+
+def release_plot(canv, hists):
+    """
+    Close the canvas and delete the histograms of a saved plot to keep the
+    memory use bounded.
+    """
+    canv.Close()
+    for hist in hists:
+        hist.Delete()
+
+
+def index_hists(file):
+    """
+    Scan the trigger/system/method/histogram key tree of a file once. For each
+    trigger, the histogram paths are indexed by all three name forms accepted
+    in the plot config: hist, method/hist and system/method/hist.
+    """
+    index = {}
+    for trigger_key in file.GetListOfKeys():
+        trigger_name = trigger_key.GetName()
+        systems = file.Get(trigger_name)
+        paths = []
+        lookup = {}
+        for system_key in systems.GetListOfKeys():
+            system_name = system_key.GetName()
+            methods = systems.Get(system_name)
+            for method_key in methods.GetListOfKeys():
+                method_name = method_key.GetName()
+                hists = methods.Get(method_name)
+                for hist_key in hists.GetListOfKeys():
+                    hist_name = hist_key.GetName()
+                    names = (
+                        hist_name,
+                        f"{method_name}/{hist_name}",
+                        f"{system_name}/{method_name}/{hist_name}",
+                    )
+                    for name in names:
+                        lookup.setdefault(name, []).append(len(paths))
+                    paths.append(f"{trigger_name}/{names[2]}")
+        index[trigger_name] = (paths, lookup)
+
+    return index
+
+
+def find_hists(index, trigger, hists_config):
+    """
+    Paths of the histograms of a trigger matching any of the names in
+    hists_config, in the order they appear in the file.
+    """
+    paths, lookup = index.get(trigger, ([], {}))
+    positions = sorted({p for name in hists_config for p in lookup.get(name, [])})
+    return [paths[p] for p in positions]
+
+
+def produce_plots_from_config(
+    file, output_path, config, plots, index=None, manifest=None, hashes=None
+):
+    subfolder = subfolder_name(file.GetName())
+    if index is None:
+        start = time.time()
+        index = index_hists(file)
+        print(
+            "Indexed {} histograms of {} (took {:.3} s)".format(
+                sum(len(paths) for paths, _ in index.values()),
+                file.GetName(),
+                time.time() - start,
+            )
+        )
+    n_plots = 0
+    for plot_name in plots:
+        if config[plot_name]["triggers"] == "":
+            triggers = list(index)
+        else:
+            triggers = [s.strip() for s in config[plot_name]["triggers"].split(",")]
+
+        hists_config = [s.strip() for s in config[plot_name]["hists"].split(",")]
+
+        for trigger in triggers:
+            collected_plots = []
+            for path in find_hists(index, trigger, hists_config):
+                if config[plot_name]["projection"] == "x":
+                    collected_plots.append(file.Get(path).ProjectionX())
+                elif config[plot_name]["projection"] == "y":
+                    collected_plots.append(file.Get(path).ProjectionY())
+                elif config[plot_name]["projection"] == "z":
+                    collected_plots.append(file.Get(path).ProjectionZ())
+                else:
+                    collected_plots.append(file.Get(path))
+
+            if len(collected_plots) == 0:
+                continue
+
+            plot_path = "{}/{}/{}/{}.pdf".format(
+                output_path, subfolder, trigger, plot_name
+            )
+            if plot_unchanged(
+                plot_path, collected_plots, config[plot_name], manifest, hashes
+            ):
+                for plot in collected_plots:
+                    plot.Delete()
+                continue
+
+            all_1D = all(
+                p.InheritsFrom("TH1D") or p.InheritsFrom("TProfile1D")
+                for p in collected_plots
+            )
+            all_2D = all(
+                p.InheritsFrom("TH2D") or p.InheritsFrom("TProfile2D")
+                for p in collected_plots
+            )
+
+            if not (all_1D or all_2D):
+                print(
+                    f"Skipping plotting of [{plot_name}], histogram list given in the config file contains both 1D and 2D histograms"
+                )
+
+            pathlib.Path("{}/{}/{}".format(output_path, subfolder, trigger)).mkdir(
+                exist_ok=True, parents=True
+            )
+
+            xtitle = collected_plots[0].GetXaxis().GetTitle()
+            ytitle = collected_plots[0].GetYaxis().GetTitle()
+
+            x_min, x_max = (
+                min([p.GetXaxis().GetXmin() for p in collected_plots]),
+                max([p.GetXaxis().GetXmax() for p in collected_plots]),
+            )
+            y_min, y_max = (
+                min([p.GetYaxis().GetXmin() for p in collected_plots]),
+                max([p.GetYaxis().GetXmax() for p in collected_plots]),
+            )
+
+            if all_1D:
+                x_min, x_max = (
+                    min([p.GetXaxis().GetXmin() for p in collected_plots]),
+                    max([p.GetXaxis().GetXmax() for p in collected_plots]),
+                )
+                y_min, y_max = (
+                    min([p.GetBinContent(p.GetMinimumBin()) for p in collected_plots]),
+                    max([p.GetBinContent(p.GetMaximumBin()) for p in collected_plots]),
+                )
+                y_max = 1.05 * y_max
+
+            iPos = 33
+            if all_2D:
+                iPos = 0
+
+            extraSpace = 0.0
+
+            CMS.SetExtraText("Preliminary")
+            CMS.SetEnergy("13.6")
+            if config[plot_name]["energy"] != "":
+                CMS.SetEnergy(config[plot_name]["energy"])
+
+            CMS.SetLumi("")
+            logx = int(config[plot_name]["logx"])
+            logy = int(config[plot_name]["logy"])
+
+            if config[plot_name]["xlim"] != "":
+                x_min, x_max = tuple(map(float, config[plot_name]["xlim"].split(" ")))
+
+            if config[plot_name]["ylim"] != "":
+                y_min, y_max = tuple(map(float, config[plot_name]["ylim"].split(" ")))
+
+            if config[plot_name]["xtitle"] != "":
+                xtitle = config[plot_name]["xtitle"]
+
+            if config[plot_name]["ytitle"] != "":
+                ytitle = config[plot_name]["ytitle"]
+
+            if config[plot_name]["iPos"] != "":
+                iPos = int(config[plot_name]["iPos"])
+
+            if config[plot_name]["extraSpace"] != "":
+                extraSpace = float(config[plot_name]["extraSpace"])
+
+            canv = CMS.cmsCanvas(
+                "",
+                x_min,
+                x_max,
+                y_min,
+                y_max,
+                xtitle,
+                ytitle,
+                square=True,
+                extraSpace=extraSpace,
+                iPos=iPos,
+            )
+            if logx == 1:
+                canv.SetLogx()
+            if logy == 1:
+                canv.SetLogy()
+
+            if config[plot_name]["xlabelsize"] != "":
+                xlabelsize = float(config[plot_name]["xlabelsize"])
+                CMS.GetcmsCanvasHist(canv).GetXaxis().SetLabelSize(xlabelsize)
+
+            if config[plot_name]["ylabelsize"] != "":
+                ylabelsize = float(config[plot_name]["ylabelsize"])
+                CMS.GetcmsCanvasHist(canv).GetYaxis().SetLabelSize(ylabelsize)
+
+            if config[plot_name]["xtitlesize"] != "":
+                xtitlesize = float(config[plot_name]["xtitlesize"])
+                CMS.GetcmsCanvasHist(canv).GetXaxis().SetTitleSize(xtitlesize)
+
+            if config[plot_name]["ytitlesize"] != "":
+                ytitlesize = float(config[plot_name]["ytitlesize"])
+                CMS.GetcmsCanvasHist(canv).GetYaxis().SetTitleSize(ytitlesize)
+
+            if config[plot_name]["xtitleoffset"] != "":
+                xtitleoffset = float(config[plot_name]["xtitleoffset"])
+                CMS.GetcmsCanvasHist(canv).GetXaxis().SetTitleOffset(xtitleoffset)
+
+            if config[plot_name]["ytitleoffset"] != "":
+                ytitleoffset = float(config[plot_name]["ytitleoffset"])
+                CMS.GetcmsCanvasHist(canv).GetYaxis().SetTitleOffset(ytitleoffset)
+
+            markers = []
+            if config[plot_name]["markers"] != "":
+                markers = [s.strip() for s in config[plot_name]["markers"].split(",")]
+
+            colors = []
+            if config[plot_name]["markers"] != "":
+                colors = [s.strip() for s in config[plot_name]["colors"].split(",")]
+
+            leg = None
+            entries = []
+            if (
+                config[plot_name]["legend"] != ""
+                and config[plot_name]["legendPos"] != ""
+            ):
+                entries = [s.strip() for s in config[plot_name]["legend"].split("@")]
+                pos = [
+                    float(s.strip()) for s in config[plot_name]["legendPos"].split(",")
+                ]
+                leg = CMS.cmsLeg(pos[0], pos[1], pos[2], pos[3])
+
+            for i, plot in enumerate(collected_plots):
+
+                if leg is not None and len(entries) > 0:
+                    leg.AddEntry(plot, entries[i])
+
+                if len(markers) > 0:
+                    marker = int(markers[i])
+                    fstyle = int(markers[i])
+                else:
+                    marker = plot.GetMarkerStyle()
+                    fstyle = plot.GetFillStyle()
+
+                if len(colors) > 0:
+                    mcolor = int(colors[i])
+                    lcolor = int(colors[i])
+                    fcolor = int(colors[i])
+                else:
+                    mcolor = plot.GetMarkerColor()
+                    lcolor = plot.GetLineColor()
+                    fcolor = plot.GetFillColor()
+
+                lstyle = plot.GetLineStyle()
+                msize = plot.GetMarkerSize()
+                lwidth = plot.GetLineWidth()
+                CMS.cmsDraw(
+                    plot,
+                    "",
+                    marker=marker,
+                    msize=msize,
+                    mcolor=mcolor,
+                    lstyle=lstyle,
+                    lwidth=lwidth,
+                    lcolor=lcolor,
+                    fstyle=fstyle,
+                    fcolor=fcolor,
+                )
+
+            CMS.SaveCanvas(canv, plot_path)
+            release_plot(canv, collected_plots)
+            n_plots += 1
+
+    return n_plots
+
+
+def render_plots(file, output_path, config_file, plots, produce_all, force=False):
+    """
+    Render the given plot sections (and all plots if produce_all is set) of
+    a single file, skipping plots that are unchanged according to the
+    manifest unless force is set. Returns the file, the number of rendered
+    plots, the plot hashes and the time it took.
+    """
+    ROOT.gROOT.SetBatch(True)
+    start = time.time()
+
+    config = read_plot_config(config_file)
+    manifest = None if force else read_manifest(output_path)
+    hashes = {}
+    root_file = ROOT.TFile.Open(file)
+    n_plots = produce_plots_from_config(
+        root_file, output_path, config, plots, manifest=manifest, hashes=hashes
+    )
+    if produce_all:
+        n_plots += produce_plots_all(root_file, output_path, manifest, hashes)
+    root_file.Close()
+
+    return file, n_plots, hashes, time.time() - start
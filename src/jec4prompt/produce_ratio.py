@@ -1,7 +1,9 @@
+import hashlib
 import json
+import os
 
 import ROOT
-from jec4prompt.utils.processing_utils import get_bins, read_config_file
+from jec4prompt.utils.processing_utils import file_key, get_bins, read_config_file
 
 
 def update_state(state):
@@ -71,56 +73,41 @@ def add_produce_ratio_parser(subparsers):
         help="Produce ratios for \
             groups containing given number of runs",
     )
+    ratio_parser.add_argument(
+        "--mc_cache",
+        type=str,
+        help="Directory for cached MC denominators. \
+            Denominators are reused as long as the MC files, trigger cuts, \
+            histogram config and binning stay the same.",
+    )
 
 
 def validate_args(args):
     pass
 
 
-def produce_ratio(rdf_numerator, h_denominator, hist_config, bins, i=None):
+def book_numerator(rdf_numerator, hist_config, bins):
     name = hist_config["name"]
     title = hist_config["title"]
+    x_bins = hist_config["x_bins"]
+    x_val = hist_config["x_val"]
+    cut = hist_config.get("cut")
+    if cut:
+        rdf_numerator = rdf_numerator.Filter(cut)
     if hist_config["type"] == "Histo1D":
-        x_bins = hist_config["x_bins"]
-        x_val = hist_config["x_val"]
-        cut = hist_config.get("cut")
-        if cut:
-            hn = rdf_numerator.Filter(cut).Histo1D(
-                (f"data_{name}", title, bins[x_bins]["n"], bins[x_bins]["bins"]),
-                x_val,
-                "weight",
-            )
-        else:
-            hn = rdf_numerator.Histo1D(
-                (f"data_{name}", title, bins[x_bins]["n"], bins[x_bins]["bins"]),
-                x_val,
-                "weight",
-            )
-        h_ratio = hn.Clone(f"ratio_{name}")
-        h_ratio.Divide(h_denominator)
-        return [hn, h_ratio]
+        return rdf_numerator.Histo1D(
+            (f"data_{name}", title, bins[x_bins]["n"], bins[x_bins]["bins"]),
+            x_val,
+            "weight",
+        )
     elif hist_config["type"] == "Profile1D":
-        x_bins = hist_config["x_bins"]
-        x_val = hist_config["x_val"]
         y_val = hist_config["y_val"]
-        cut = hist_config.get("cut")
-        if cut:
-            hn = rdf_numerator.Filter(cut).Profile1D(
-                (f"data_{name}", title, bins[x_bins]["n"], bins[x_bins]["bins"]),
-                x_val,
-                y_val,
-                "weight",
-            )
-        else:
-            hn = rdf_numerator.Profile1D(
-                (f"data_{name}", title, bins[x_bins]["n"], bins[x_bins]["bins"]),
-                x_val,
-                y_val,
-                "weight",
-            )
-        h_ratio = hn.Clone(f"ratio_{name}")
-        h_ratio.Divide(h_denominator)
-        return [hn, h_ratio]
+        return rdf_numerator.Profile1D(
+            (f"data_{name}", title, bins[x_bins]["n"], bins[x_bins]["bins"]),
+            x_val,
+            y_val,
+            "weight",
+        )
     else:
         raise ValueError(
             f"Histogram type {hist_config['type']} not supported by produce_ratio. \
@@ -128,6 +115,117 @@ def produce_ratio(rdf_numerator, h_denominator, hist_config, bins, i=None):
         )
 
 
+def produce_ratio(rdf_numerator, h_denominator, hist_config, bins, i=None):
+    hn = book_numerator(rdf_numerator, hist_config, bins)
+    return [hn, ratio_from_numerator(hn, h_denominator, hist_config)]
+
+
+def ratio_from_numerator(hn, h_denominator, hist_config):
+    h_ratio = hn.Clone(f"ratio_{hist_config['name']}")
+    h_ratio.Divide(h_denominator)
+    return h_ratio
+
+
+def mc_cache_key(mc_files, triggers, hist_config, bins):
+    """
+    Key of a cached MC denominator: MC file set (by file_key), trigger names
+    and cuts, histogram config section and binning.
+    """
+    key = {
+        "mc_files": sorted(file_key(file) for file in mc_files),
+        "triggers": sorted(triggers.items()),
+        "hist_config": sorted(dict(hist_config).items()),
+        "bins": [float(b) for b in bins[hist_config["x_bins"]]["bins"]],
+    }
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()[:16]
+
+
+def mc_cache_path(cache_dir, hist_config, key):
+    return os.path.join(cache_dir, f"mc_{hist_config['name']}_{key}.root")
+
+
+def read_mc_cache(path):
+    if not os.path.exists(path):
+        return None
+    file = ROOT.TFile.Open(path, "READ")
+    h = file.Get(file.GetListOfKeys()[0].GetName())
+    h.SetDirectory(0)
+    file.Close()
+    return h
+
+
+def write_mc_cache(path, h):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}.root"
+    file = ROOT.TFile.Open(tmp_path, "RECREATE")
+    h.Write()
+    file.Close()
+    os.replace(tmp_path, path)
+
+
+def book_denominator(rdf_mc, hist_config, bins):
+    name = hist_config["name"]
+    title = hist_config["title"]
+    x_bins = hist_config["x_bins"]
+    x_val = hist_config["x_val"]
+    y_val = hist_config["y_val"]
+    cut = hist_config.get("cut")
+    if cut:
+        rdf_mc = rdf_mc.Filter(cut)
+    return rdf_mc.Profile1D(
+        (f"mc_{name}", title, bins[x_bins]["n"], bins[x_bins]["bins"]),
+        x_val,
+        y_val,
+        "weight",
+    )
+
+
+def plan_groups(data_files, groups_of=None):
+    """
+    Tag each data file with the index of the group it belongs to and return
+    the files of each group.
+    """
+    if groups_of:
+        group_index = {file: j // groups_of for j, file in enumerate(data_files)}
+    else:
+        group_index = {file: 0 for file in data_files}
+
+    groups = [[] for _ in range(max(group_index.values(), default=-1) + 1)]
+    for file, i in group_index.items():
+        groups[i].append(file)
+
+    return groups
+
+
+def book_group(group, triggers, hist_config, bins, progress_bar=False):
+    """
+    Book the run range and the numerator histograms of a data group, so
+    that all of them are filled in the same event loop.
+    """
+    chain_data = ROOT.TChain("Events")
+    for file in group:
+        chain_data.Add(file)
+
+    rdf_data = ROOT.RDataFrame(chain_data)
+    if progress_bar:
+        ROOT.RDF.Experimental.AddProgressBar(rdf_data)
+
+    if len(triggers) > 0:
+        trg_filter = " || ".join(triggers)
+        rdf_data = rdf_data.Filter(trg_filter)
+
+    booked = {
+        "chain": chain_data,
+        "min_run": rdf_data.Min("min_run"),
+        "max_run": rdf_data.Max("max_run"),
+        "hists": {},
+    }
+    for hist in hist_config:
+        booked["hists"][hist] = book_numerator(rdf_data, hist_config[hist], bins)
+
+    return booked
+
+
 def run(state):
     args = state.args
     # Shut up ROOT
@@ -158,81 +256,47 @@ def run(state):
         rdf_mc = rdf_mc.Filter(trg_filter)
 
     data_files = [s.strip() for s in args.data_files.split(",")]
-    if args.groups_of:
-        if args.groups_of > len(data_files):
-            groups = [data_files]
-        else:
-            n = args.groups_of
-            groups = [
-                data_files[n * i : n * i + n]
-                for i in range(int((len(data_files) + n - 1) / n))
-            ]
-    else:
-        groups = [data_files]
+    groups = plan_groups(data_files, args.groups_of)
 
     bins = get_bins()
     hist_config = dict(read_config_file(args.hist_config))
     del hist_config["DEFAULT"]
 
+    # Create MC histograms here early so they do not need to be
+    # generated multiple times for each group. Cached denominators are
+    # reused, the rest are booked to be filled in the same event loop as data.
     hm = {}
+    mc_booked = {}
+    mc_cache = {}
     for hist in hist_config:
-        # Create MC histogram here early so it does not need to be
-        # generated multiple times in produce_cumulative
-        name = hist_config[hist]["name"]
-        title = hist_config[hist]["title"]
-        x_bins = hist_config[hist]["x_bins"]
-        x_val = hist_config[hist]["x_val"]
-        y_val = hist_config[hist]["y_val"]
-        cut = hist_config[hist].get("cut")
-        if cut:
-            h = rdf_mc.Filter(cut).Profile1D(
-                (f"mc_{name}", title, bins[x_bins]["n"], bins[x_bins]["bins"]),
-                x_val,
-                y_val,
-                "weight",
-            )
-        else:
-            h = rdf_mc.Profile1D(
-                (f"mc_{name}", title, bins[x_bins]["n"], bins[x_bins]["bins"]),
-                x_val,
-                y_val,
-                "weight",
-            )
-        hm[hist] = h.ProjectionX()
-
-    lm = {}
-    for hist in hist_config:
-        x_val = hist_config[hist]["x_val"]
-        y_val = hist_config[hist]["y_val"]
-        cut = hist_config[hist].get("cut")
-        if cut:
-            lm[hist] = rdf_mc.Filter(cut).Stats(y_val, "weight")
-        else:
-            lm[hist] = rdf_mc.Stats(y_val, "weight")
-
-    for i, group in enumerate(groups):
-        chain_data = ROOT.TChain("Events")
-        chain_runs = ROOT.TChain("Runs")
+        if args.mc_cache:
+            key = mc_cache_key(mc_files, triggers, hist_config[hist], bins)
+            mc_cache[hist] = mc_cache_path(args.mc_cache, hist_config[hist], key)
+            hm[hist] = read_mc_cache(mc_cache[hist])
+            if hm[hist] is not None:
+                print(f"{hist}: using cached MC denominator {mc_cache[hist]}")
+                continue
+        mc_booked[hist] = book_denominator(rdf_mc, hist_config[hist], bins)
 
-        lds = []
-        for j, file in enumerate(group):
-            chain_data.Add(file)
-            chain_runs.Add(file)
-            rdf = ROOT.RDataFrame("Events", file)
+    booked_groups = [
+        book_group(group, triggers, hist_config, bins, args.progress_bar)
+        for group in groups
+    ]
+    handles = list(mc_booked.values())
+    for booked in booked_groups:
+        handles.append(booked["min_run"])
+        handles.append(booked["max_run"])
+        handles.extend(booked["hists"].values())
+    ROOT.RDF.RunGraphs(handles)
 
-        rdf_data = ROOT.RDataFrame(chain_data)
-        rdf_runs = ROOT.RDataFrame(chain_runs)
-
-        if args.progress_bar:
-            ROOT.RDF.Experimental.AddProgressBar(rdf_runs)
-            ROOT.RDF.Experimental.AddProgressBar(rdf_data)
-
-        if len(triggers) > 0:
-            trg_filter = " || ".join(triggers)
-            rdf_data = rdf_data.Filter(trg_filter)
+    for hist, h in mc_booked.items():
+        hm[hist] = h.ProjectionX()
+        if args.mc_cache:
+            write_mc_cache(mc_cache[hist], hm[hist])
 
-        min_run = int(rdf_data.Min("min_run").GetValue())
-        max_run = int(rdf_data.Max("max_run").GetValue())
+    for i, booked in enumerate(booked_groups):
+        min_run = int(booked["min_run"].GetValue())
+        max_run = int(booked["max_run"].GetValue())
         print(f"Group run range: [{min_run}, {max_run}]")
         if args.data_tag:
             output_path = f"{args.out}/J4PRatio_runs{min_run}to{max_run}_{args.data_tag}_vs_{args.mc_tag}.root"
@@ -243,7 +307,8 @@ def run(state):
 
         hists_out = []
         for hist in hist_config:
-            [hn, h] = produce_ratio(rdf_data, hm[hist], hist_config[hist], bins)
+            hn = booked["hists"][hist].GetValue()
+            h = ratio_from_numerator(hn, hm[hist], hist_config[hist])
             hists_out.append(hm[hist])
             hists_out.append(hn)
             hists_out.append(h)
@@ -1,8 +1,23 @@
 import json
-from typing import List
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Optional, Tuple
 
+import numpy as np
 import ROOT
-from jec4prompt.utils.processing_utils import file_read_lines, get_bins, read_config_file
+from jec4prompt.utils.histogram_utils import (
+    axis_centers,
+    axis_edges,
+    profile_from_sums,
+    th3_to_numpy,
+)
+from jec4prompt.utils.processing_utils import (
+    file_read_lines,
+    get_bins,
+    read_config_file,
+)
 
 response_histos = (
     ("multijet", "MPF", "MPF_multijet_PtRecoilVsEtaVsResponse"),
@@ -71,24 +86,225 @@ def add_produce_responses_parser(subparsers):
         help="Path to the .json file containing \
             triggers.",
     )
+    responses_parser.add_argument(
+        "-ch", "--channel", type=str, help="Channel associated with the triggers."
+    )
     responses_parser.add_argument("--out", type=str, default="", help="Output path")
+    responses_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of files processed \
+            concurrently in separate processes",
+    )
+    responses_parser.add_argument(
+        "--sidecar",
+        action="store_true",
+        help="Write the derived objects to \
+            <input>_derived.root (in --out if given) instead of updating the input",
+    )
     responses_parser.add_argument(
         "--config", type=str, default="", help="Path to config file"
     )
+    responses_parser.add_argument(
+        "--response_engine",
+        type=str,
+        default="root",
+        choices=["root", "numpy"],
+        help="Projection engine for the \
+            responses: ROOT projections and profiles per histogram, or a \
+            vectorized numpy pass over all eta windows at once",
+    )
+    responses_parser.add_argument(
+        "--eta_windows",
+        type=str,
+        default="-2.5:2.5",
+        help="Comma separated list of \
+            eta windows (min:max) for the projected responses",
+    )
+    responses_parser.add_argument(
+        "--fit_engine",
+        type=str,
+        default="root",
+        choices=["root", "batch"],
+        help="Fitting engine for the resolutions: per-bin ROOT fits \
+            or vectorized numpy fits of all bins at once",
+    )
+    responses_parser.add_argument(
+        "--compare_fits",
+        action="store_true",
+        help="Fit the resolutions with both \
+            engines and report the agreement of the batch fits with ROOT",
+    )
 
 
 def validate_args(args):
-    pass
+    if args.workers < 1:
+        raise ValueError("workers should be at least 1")
+    for eta_window in args.eta_windows.split(","):
+        if len(eta_window.split(":")) != 2:
+            raise ValueError(f"Eta window should be given as min:max, got {eta_window}")
+        lo, hi = (float(v) for v in eta_window.split(":"))
+        if lo >= hi:
+            raise ValueError(f"Eta window min should be below max, got {eta_window}")
+
+
+def fit_gaussian_cores(
+    counts: np.ndarray, centers: np.ndarray, n_iter: int = 50, tol: float = 1e-9
+):
+    """
+    Binned Poisson likelihood fits of a Gaussian to every row of counts at once,
+    equivalent to TH1::Fit(gaus, "L") over the full histogram range.
+
+    The Gaussian is fitted as log(mu) = a + b*t + c*t^2 in the standardized
+    variable t = (x - mean) / rms, which makes the likelihood convex so that
+    damped Newton iterations converge for all rows simultaneously.
+    Returns the fitted mean, sigma and sigma error, zero where the fit is
+    undefined (empty rows, a single filled bin or no maximum). Unlike the
+    sigma parameter of a ROOT gaus fit, the sigma is always positive.
+    """
+    n_rows = counts.shape[0]
+    means = np.zeros(n_rows)
+    sigmas = np.zeros(n_rows)
+    errors = np.zeros(n_rows)
+
+    sumw = counts.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = (counts * centers).sum(axis=1) / sumw
+        rms = np.sqrt(
+            (counts * (centers[None, :] - mean[:, None]) ** 2).sum(axis=1) / sumw
+        )
+    ok = (sumw > 0) & (rms > 0)
+    if not ok.any():
+        return means, sigmas, errors
+
+    y = counts[ok]
+    t = (centers[None, :] - mean[ok, None]) / rms[ok, None]
+    X = np.stack([np.ones_like(t), t, t**2], axis=-1)
+
+    def nll(theta):
+        eta = np.minimum(np.einsum("nkp,np->nk", X, theta), 700.0)
+        return (np.exp(eta) - y * eta).sum(axis=1)
+
+    def derivatives(theta):
+        mu = np.exp(np.minimum(np.einsum("nkp,np->nk", X, theta), 700.0))
+        grad = np.einsum("nkp,nk->np", X, mu - y)
+        hess = np.einsum("nkp,nk,nkq->npq", X, mu, X)
+        return grad, hess
+
+    theta = np.zeros((y.shape[0], 3))
+    theta[:, 0] = np.log(np.maximum(y.max(axis=1), 1e-300))
+    theta[:, 2] = -0.5
+
+    f0 = nll(theta)
+    for _ in range(n_iter):
+        grad, hess = derivatives(theta)
+        step = np.linalg.solve(hess + 1e-12 * np.eye(3), grad[..., None])[..., 0]
+
+        # Halve the step wherever it does not decrease the likelihood
+        scale = np.ones(len(theta))
+        for _ in range(20):
+            f1 = nll(theta - scale[:, None] * step)
+            worse = ~(f1 <= f0)
+            if not worse.any():
+                break
+            scale = np.where(worse, 0.5 * scale, scale)
+        accept = f1 <= f0
+        theta = np.where(accept[:, None], theta - scale[:, None] * step, theta)
+        f0 = np.where(accept, f1, f0)
+
+        if np.max(np.abs(scale[:, None] * step)) < tol:
+            break
+
+    _, hess = derivatives(theta)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cov = np.linalg.pinv(hess)
+        b, c = theta[:, 1], theta[:, 2]
+        fmean = mean[ok] - rms[ok] * b / (2.0 * c)
+        fsigma = rms[ok] * np.sqrt(-0.5 / c)
+        ferror = rms[ok] * (-2.0 * c) ** -1.5 * np.sqrt(cov[:, 2, 2])
+
+    good = (c < 0) & np.isfinite(fsigma) & np.isfinite(ferror)
+    means[np.flatnonzero(ok)[good]] = fmean[good]
+    sigmas[np.flatnonzero(ok)[good]] = fsigma[good]
+    errors[np.flatnonzero(ok)[good]] = ferror[good]
+    return means, sigmas, errors
+
+
+def fit_resolutions_batch(h):
+    """
+    Fit the z-projections of all (x, y) bins of a TH3 in one vectorized pass.
+    Returns the resolutions and their errors as arrays indexed as [x, y].
+    """
+    values, _ = th3_to_numpy(h)
+    nx, ny, nz = values.shape
+    _, sigmas, errors = fit_gaussian_cores(
+        values.reshape(nx * ny, nz), axis_centers(h.GetZaxis())
+    )
+    return sigmas.reshape(nx, ny), errors.reshape(nx, ny)
 
 
-def produce_resolutions(file: str, trigger_list: List[str], output_path: str):
+def report_fit_agreement(resolutions, fsigmas, ferrors, name):
+    """
+    Print how well the batch fits agree with the ROOT fits in resolutions.
+    """
+    nx, ny = fsigmas.shape
+    root_sigmas = np.array(
+        [
+            [resolutions.GetBinContent(i, j) for j in range(1, ny + 1)]
+            for i in range(1, nx + 1)
+        ]
+    )
+    root_errors = np.array(
+        [
+            [resolutions.GetBinError(i, j) for j in range(1, ny + 1)]
+            for i in range(1, nx + 1)
+        ]
+    )
+
+    filled = (root_sigmas != 0) | (fsigmas != 0)
+    if not filled.any():
+        print(f"{name}: no fitted bins to compare")
+        return
+
+    diff = np.abs(root_sigmas - fsigmas)[filled]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rel = diff / root_sigmas[filled]
+        pull = diff / np.hypot(root_errors, ferrors)[filled]
+    print(
+        f"{name}: {filled.sum()} bins, max |diff| {diff.max():.3g}, "
+        f"median rel. diff {np.nanmedian(rel):.3g}, "
+        f"{np.mean(rel < 0.01):.1%} within 1%, "
+        f"{np.mean(pull < 0.1):.1%} within 0.1 sigma"
+    )
+
+
+def open_files(file: str, output_file: Optional[str] = None):
+    """
+    Open the input file, in UPDATE mode unless the derived objects go to a
+    separate (sidecar) output file. Returns the input and output TFiles.
+    """
+    if output_file:
+        return ROOT.TFile.Open(file, "READ"), ROOT.TFile(output_file, "UPDATE")
+    file = ROOT.TFile(file, "UPDATE")
+    return file, file
+
+
+def produce_resolutions(
+    file: str,
+    trigger_list: List[str],
+    output_path: str,
+    engine: str = "root",
+    compare: bool = False,
+    output_file: Optional[str] = None,
+):
     """
     Resolution producer for dijet_rdf.
     """
 
     bins = get_bins()
 
-    file = ROOT.TFile(file, "UPDATE")
+    file, out = open_files(file, output_file)
     if len(trigger_list) == 0:
         print("No triggers provided. Using all triggers in the file.")
         trigger_keys = file.GetListOfKeys()
@@ -99,8 +315,8 @@ def produce_resolutions(file: str, trigger_list: List[str], output_path: str):
             path = f"{trg}/{system}/{method}/"
             resolution_path = f"{trg}/{system}/Resolutions"
 
-            if not file.GetDirectory(resolution_path):
-                file.mkdir(resolution_path)
+            if not out.GetDirectory(resolution_path):
+                out.mkdir(resolution_path)
 
             h = file.Get(path + histogram)
             if not h:
@@ -127,45 +343,41 @@ def produce_resolutions(file: str, trigger_list: List[str], output_path: str):
                 h.GetYaxis().GetXmin(),
                 h.GetYaxis().GetXmax(),
             )
-            projections = ROOT.TH2D(
-                "projections_"
-                + histogram.replace("VsA", "")
-                .replace("VsEta", "")
-                .replace(f"_{method}_{system}", ""),
-                h.GetTitle(),
-                bins["pt"]["n"],
-                bins["pt"]["bins"],
-                bins["pt"]["n"],
-                bins["pt"]["bins"],
-            )
 
-            # TH3.FitSlicesZ?
-            for i in range(1, h.GetNbinsX() + 1):
-                for j in range(1, h.GetNbinsY() + 1):
-                    # Fit to the asymmetry in the bin
-                    proj = h.ProjectionZ(f"proj_{i}_{j}", i, i, j, j)
-                    # Find the mean
-                    mean = proj.GetMean()
-                    # Find the sigma
-                    sigma = 0
-                    for k in range(1, proj.GetNbinsX() + 1):
-                        sigma += (proj.GetBinContent(k) - mean) ** 2
-                    sigma = proj.GetRMS()
-
-                    if sigma > 0:
-                        gaussian = ROOT.TF1(
-                            "my_gaus", "gaus", mean - sigma, mean + sigma
-                        )
-                        proj.Fit(gaussian, "Q L N")
-                        fsigma = gaussian.GetParameter(2)
-                        resolutions.SetBinContent(i, j, fsigma)
-                        resolutions.SetBinError(i, j, gaussian.GetParError(2))
-                    else:
-                        resolutions.SetBinContent(i, j, 0)
-                        resolutions.SetBinError(i, j, 0)
-                    # Save the projection
-                    for k in range(1, proj.GetNbinsX() + 1):
-                        projections.SetBinContent(i, k, proj.GetBinContent(k))
+            if engine == "batch" and not compare:
+                fsigmas, ferrors = fit_resolutions_batch(h)
+                for i in range(1, h.GetNbinsX() + 1):
+                    for j in range(1, h.GetNbinsY() + 1):
+                        resolutions.SetBinContent(i, j, fsigmas[i - 1, j - 1])
+                        resolutions.SetBinError(i, j, ferrors[i - 1, j - 1])
+            else:
+                # TH3.FitSlicesZ?
+                for i in range(1, h.GetNbinsX() + 1):
+                    for j in range(1, h.GetNbinsY() + 1):
+                        # Fit to the asymmetry in the bin
+                        proj = h.ProjectionZ(f"proj_{i}_{j}", i, i, j, j)
+                        # Find the mean
+                        mean = proj.GetMean()
+                        # Find the sigma
+                        sigma = proj.GetRMS()
+
+                        if sigma > 0:
+                            gaussian = ROOT.TF1(
+                                "my_gaus", "gaus", mean - sigma, mean + sigma
+                            )
+                            proj.Fit(gaussian, "Q L N")
+                            # gaus is symmetric in sigma, which can come
+                            # out negative
+                            fsigma = abs(gaussian.GetParameter(2))
+                            resolutions.SetBinContent(i, j, fsigma)
+                            resolutions.SetBinError(i, j, gaussian.GetParError(2))
+                        else:
+                            resolutions.SetBinContent(i, j, 0)
+                            resolutions.SetBinError(i, j, 0)
+
+            if compare:
+                fsigmas, ferrors = fit_resolutions_batch(h)
+                report_fit_agreement(resolutions, fsigmas, ferrors, path + histogram)
 
             resolutions.SetName(
                 method
@@ -176,64 +388,201 @@ def produce_resolutions(file: str, trigger_list: List[str], output_path: str):
             )
 
             # Save
-            file.cd(resolution_path)
+            out.cd(resolution_path)
             # h2.Write()
             resolutions.Write()
-            file.cd()
+            out.cd()
+
+    if out is not file:
+        out.Close()
+    file.Close()
+
+
+def eta_window_suffix(eta_window):
+    """
+    Name suffix for a projected eta window, empty for the default |eta| < 2.5.
+    """
+    if tuple(eta_window) == (-2.5, 2.5):
+        return ""
+    lo, hi = (f"{v:g}".replace("-", "m").replace(".", "p") for v in eta_window)
+    return f"_eta{lo}to{hi}"
+
+
+def check_eta_windows(axis, eta_windows):
+    """
+    Raise if an eta window overlaps no bins of the axis. TAxis::SetRangeUser
+    would silently fall back to the full axis for such a window.
+    """
+    edges = axis_edges(axis)
+    for lo, hi in eta_windows:
+        if not np.any((edges[1:] > lo) & (edges[:-1] < hi)):
+            raise ValueError(
+                f"Eta window {lo:g}:{hi:g} does not overlap the eta axis "
+                f"[{edges[0]:g}, {edges[-1]:g}]"
+            )
+
+
+def project_responses_root(h, histogram, eta_windows):
+    profiles = []
+    for eta_window in eta_windows:
+        # Get the projection w.r.t. y-axis
+        h.GetYaxis().SetRangeUser(*eta_window)
+        if h.InheritsFrom("TProfile2D"):
+            # Profile-with-moments input (see ProfileMoments2D in histograms),
+            # the response axis is already reduced to per-cell sums
+            h3 = h.ProfileX(
+                f"{histogram}{eta_window_suffix(eta_window)}_pfx",
+                h.GetYaxis().GetFirst(),
+                h.GetYaxis().GetLast(),
+            )
+        else:
+            h2 = h.Project3D("zx")
+
+            # Profile
+            h3 = h2.ProfileX(f"{histogram}{eta_window_suffix(eta_window)}_pfx")
+        profiles.append(h3)
+    return profiles
+
 
+def window_bins(edges, lo, hi):
+    """
+    Bins (including under- and overflow) selected by TAxis::SetRangeUser(lo,
+    hi) on an axis with the given edges. A window reaching past the axis
+    includes the flow bin on that side.
+    """
+    bins = np.zeros(len(edges) + 1, dtype=bool)
+    bins[1:-1] = (edges[1:] > lo) & (edges[:-1] < hi)
+    bins[0] = lo < edges[0]
+    bins[-1] = hi > edges[-1]
+    return bins
 
-def produce_responses(file: str, trigger_list: List[str], output_path: str):
+
+def project_responses_numpy(h, histogram, eta_windows):
+    """
+    Same profiles as project_responses_root for a TH3, computed for all eta
+    windows in one vectorized pass over the bin contents.
+
+    The flow bins are handled as in ROOT: Project3D integrates the eta flow
+    bins only when a window reaches past the eta axis, the pT flow bins fill
+    the flow bins of the profile, and ProfileX sums the response bins 1 to
+    n only, without the response under- and overflow.
+    """
+    values, variances = th3_to_numpy(h, flow=True)
+    values = values[:, :, 1:-1]
+    variances = variances[:, :, 1:-1]
+    y_edges = axis_edges(h.GetYaxis())
+    x_edges = axis_edges(h.GetXaxis())
+    x_axis = h.GetXaxis()
+    x_centers = np.array([x_axis.GetBinCenter(i) for i in range(x_axis.GetNbins() + 2)])
+    z_centers = axis_centers(h.GetZaxis())
+
+    windows = np.array(
+        [window_bins(y_edges, lo, hi) for lo, hi in eta_windows], dtype=float
+    )
+
+    # Project3D("zx") for every window, then ProfileX of the projections
+    c = np.einsum("xyz,wy->wxz", values, windows)
+    e2 = np.einsum("xyz,wy->wxz", variances, windows)
+    nonzero = c != 0
+
+    sumw = c.sum(axis=2)
+    sumwy = (c * z_centers).sum(axis=2)
+    sumwy2 = (c * z_centers**2).sum(axis=2)
+    binsumw2 = np.where(nonzero, e2, 0.0).sum(axis=2)
+
+    # The statistics of a TProfile count the in-range pT bins only
+    inner = slice(1, -1)
+    stats = np.stack(
+        [
+            sumw[:, inner].sum(axis=1),
+            (c[:, inner] ** 2).sum(axis=(1, 2)),
+            (sumw * x_centers)[:, inner].sum(axis=1),
+            (sumw * x_centers**2)[:, inner].sum(axis=1),
+            sumwy[:, inner].sum(axis=1),
+            sumwy2[:, inner].sum(axis=1),
+        ],
+        axis=1,
+    )
+    entries = nonzero.sum(axis=(1, 2))
+
+    return [
+        profile_from_sums(
+            f"{histogram}{eta_window_suffix(eta_window)}_pfx",
+            h.GetTitle(),
+            x_edges,
+            sumw[w],
+            sumwy[w],
+            sumwy2[w],
+            binsumw2[w],
+            stats[w],
+            entries[w],
+        )
+        for w, eta_window in enumerate(eta_windows)
+    ]
+
+
+def produce_responses(
+    file: str,
+    trigger_list: List[str],
+    output_path: str,
+    engine: str = "root",
+    eta_windows: List[Tuple[float, float]] = ((-2.5, 2.5),),
+    output_file: Optional[str] = None,
+):
     """
     Response producer for dijet_rdf.
     """
 
     bins = get_bins()
 
-    file = ROOT.TFile(file, "UPDATE")
+    file, out = open_files(file, output_file)
     if len(trigger_list) == 0:
         print("No triggers provided. Using all triggers in the file.")
         trigger_keys = file.GetListOfKeys()
         trigger_list = [tkey.GetName() for tkey in trigger_keys]
 
     for trg in trigger_list:
+        responses = {}
         for system, method, histogram in response_histos:
             path = f"{trg}/{system}/{method}/"
             response_path = f"{trg}/{system}/Responses"
 
-            if not file.GetDirectory(response_path):
-                file.mkdir(response_path)
-
             h = file.Get(path + histogram)
             if not h:
                 print(f"Could not find {path + histogram}")
                 continue
-            # Get the projection w.r.t. y-axis
-            h.GetYaxis().SetRangeUser(-2.5, 2.5)
-            h2 = h.Project3D("zx")
 
-            # Profile
-            h3 = h2.ProfileX()
-            h3.SetName(
-                method
-                + "_projected_response_"
-                + histogram.replace("VsResponse", "")
-                .replace("VsEta", "")
-                .replace(f"_{method}_{system}", "")
-            )
-
-            # Save
-            file.cd(response_path)
-            # h2.Write()
-            h3.Write()
-            file.cd()
+            check_eta_windows(h.GetYaxis(), eta_windows)
+            if engine == "numpy" and h.InheritsFrom("TH3"):
+                profiles = project_responses_numpy(h, histogram, eta_windows)
+            else:
+                profiles = project_responses_root(h, histogram, eta_windows)
+
+            for eta_window, h3 in zip(eta_windows, profiles):
+                h3.SetName(
+                    method
+                    + "_projected_response_"
+                    + histogram.replace("VsResponse", "")
+                    .replace("VsEta", "")
+                    .replace(f"_{method}_{system}", "")
+                    + eta_window_suffix(eta_window)
+                )
+                responses.setdefault(response_path, []).append(h3)
+
+        # Save all responses of the trigger in one go
+        for response_path, profiles in responses.items():
+            if not out.GetDirectory(response_path):
+                out.mkdir(response_path)
+            out.cd(response_path)
+            for h3 in profiles:
+                h3.Write()
+            out.cd()
 
         for system, method, histogram in derived_histos:
             path = f"{trg}/{system}/{method}/"
             response_path = f"{trg}/{system}/Responses"
-            if not file.GetDirectory(path):
-                file.mkdir(path)
-            if not file.GetDirectory(response_path):
-                file.mkdir(response_path)
+            if not out.GetDirectory(response_path):
+                out.mkdir(response_path)
 
             h = file.Get(path + histogram)
             # Get the projection w.r.t. y-axis
@@ -266,8 +615,54 @@ def produce_responses(file: str, trigger_list: List[str], output_path: str):
             )
 
             # Save
-            file.cd(response_path)
+            out.cd(response_path)
             h3.Write()
+            out.cd()
+
+    if out is not file:
+        out.Close()
+    file.Close()
+
+
+def sidecar_path(file: str, output_path: str) -> str:
+    """
+    Path of the sidecar file holding the objects derived from file.
+    """
+    name = os.path.basename(file).replace(".root", "_derived.root")
+    return os.path.join(output_path or os.path.dirname(file), name)
+
+
+def process_file(file: str, trigger_list, output_path: str, options: dict):
+    """
+    Produce responses and resolutions for a single file.
+    Returns the file and the time it took to process it.
+    """
+    ROOT.gROOT.SetBatch(True)
+    start = time.time()
+
+    output_file = None
+    if options["sidecar"]:
+        output_file = sidecar_path(file, output_path)
+        if os.path.exists(output_file):
+            os.remove(output_file)
+
+    produce_responses(
+        file,
+        trigger_list,
+        output_path,
+        engine=options["response_engine"],
+        eta_windows=options["eta_windows"],
+        output_file=output_file,
+    )
+    produce_resolutions(
+        file,
+        trigger_list,
+        output_path,
+        engine=options["fit_engine"],
+        compare=options["compare_fits"],
+        output_file=output_file,
+    )
+    return file, time.time() - start
 
 
 def run(state):
@@ -296,6 +691,39 @@ def run(state):
         config_file = args.config
         config = read_config_file(config_file)
 
-    for file in files:
-        produce_responses(file, trigger_list, output_path)
-        produce_resolutions(file, trigger_list, output_path)
+    eta_windows = [
+        tuple(float(v) for v in eta_window.split(":"))
+        for eta_window in args.eta_windows.split(",")
+    ]
+
+    options = {
+        "response_engine": args.response_engine,
+        "eta_windows": eta_windows,
+        "fit_engine": args.fit_engine,
+        "compare_fits": args.compare_fits,
+        "sidecar": args.sidecar,
+    }
+
+    start = time.time()
+    if args.workers > 1:
+        # Each file is handled by its own ROOT session in a separate process
+        with ProcessPoolExecutor(
+            max_workers=args.workers, mp_context=mp.get_context("spawn")
+        ) as executor:
+            futures = [
+                executor.submit(process_file, file, trigger_list, output_path, options)
+                for file in files
+            ]
+            for future in as_completed(futures):
+                file, elapsed = future.result()
+                print(f"{file} processed in {elapsed:.2f} s")
+    else:
+        for file in files:
+            file, elapsed = process_file(file, trigger_list, output_path, options)
+            print(f"{file} processed in {elapsed:.2f} s")
+
+    elapsed = time.time() - start
+    print(
+        f"Processed {len(files)} files in {elapsed:.2f} s "
+        f"({len(files) / elapsed:.2f} files/s)"
+    )
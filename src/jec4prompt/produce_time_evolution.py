@@ -3,7 +3,23 @@ import time
 
 import numpy as np
 import ROOT
-from jec4prompt.utils.processing_utils import file_read_lines, get_bins, read_config_file
+from jec4prompt.utils.processing_utils import (
+    file_read_lines,
+    get_bins,
+    read_config_file,
+)
+from jec4prompt.utils.summary_store import (
+    add_file,
+    add_lumi_csv,
+    book_summary,
+    file_in_store,
+    mean_and_error,
+    open_store,
+    read_blocks,
+    read_summaries,
+    read_summary,
+    set_ls_block,
+)
 
 
 def update_state(state):
@@ -19,9 +35,7 @@ def add_produce_time_evolution_parser(state):
         help="Produce time \
             evolution for given input files",
     )
-    time_evolution_files = time_evolution_parser.add_mutually_exclusive_group(
-        required=True
-    )
+    time_evolution_files = time_evolution_parser.add_mutually_exclusive_group()
     time_evolution_files.add_argument(
         "--filelist",
         type=str,
@@ -71,10 +85,62 @@ def add_produce_time_evolution_parser(state):
         help="Path to the histogram \
             config file.",
     )
+    time_evolution_parser.add_argument(
+        "--max_concurrent",
+        type=int,
+        default=0,
+        help="Maximum number of files whose \
+            event loops are run concurrently (0 = all files at once).",
+    )
+    time_evolution_parser.add_argument(
+        "--summary_store",
+        type=str,
+        help="Path to an SQLite store of per-run \
+            summaries. Input files not yet in the store are added to it, and \
+            the time evolution is built from the whole store.",
+    )
+    time_evolution_parser.add_argument(
+        "--lumi_csv",
+        type=str,
+        help="brilcalc lumi csv with the \
+            luminosity of each run, used for the summary store.",
+    )
+    time_evolution_parser.add_argument(
+        "--lumi_per_bin",
+        type=float,
+        help="Target integrated luminosity \
+            (in fb^-1) per time evolution bin. The events are summarized per \
+            run and merged into bins afterwards (one bin per input file if \
+            not given and no summary store is used).",
+    )
+    time_evolution_parser.add_argument(
+        "--ls_block",
+        type=int,
+        default=0,
+        help="Number of lumisections per block \
+            in the summary store (0 = one block per run). Files can only be \
+            added to a store with the block size it was built with.",
+    )
+    time_evolution_parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Time the event loops of the input \
+            files run one after the other with GetValue against running them \
+            concurrently with RunGraphs, without writing any output.",
+    )
 
 
 def validate_args(args):
-    pass
+    if args.max_concurrent < 0:
+        raise ValueError("--max_concurrent must be non-negative")
+    if not (args.filelist or args.filepaths or args.summary_store):
+        raise ValueError("No file list or summary store provided")
+    if args.lumi_per_bin is not None and args.lumi_per_bin <= 0:
+        raise ValueError("--lumi_per_bin must be positive")
+    if args.ls_block < 0:
+        raise ValueError("--ls_block must be non-negative")
+    if args.benchmark and (args.summary_store or args.lumi_per_bin):
+        raise ValueError("--benchmark applies only to the per-file time evolution")
 
 
 def data_hists(rdf, hist_config, bins):
@@ -147,13 +213,60 @@ def lumi_data(rdf, hist_config, triggers):
     return ld
 
 
-def produce_time_evolution(lds, hist_config, bins, logging):
-    handles = []
-    for ld in lds:
-        for hist in hist_config:
-            handles.append(ld[hist])
-    ROOT.RDF.RunGraphs(handles)
+def run_lumi_data(lds, max_concurrent, logging):
+    """
+    Run the event loops of all booked per-file results concurrently, at most
+    max_concurrent files at a time (all of them if max_concurrent is 0).
+    """
+    batch_size = max_concurrent if max_concurrent > 0 else max(len(lds), 1)
+    start = time.time()
+    for i in range(0, len(lds), batch_size):
+        handles = []
+        for ld in lds[i : i + batch_size]:
+            handles.extend(ld.values())
+        ROOT.RDF.RunGraphs(handles)
+        logging.info(f"{min(i + batch_size, len(lds))}/{len(lds)} files processed")
+
+    elapsed = time.time() - start
+    logging.info(
+        f"Ran {len(lds)} event loops in {elapsed:.1f} s "
+        f"({len(lds) / max(elapsed, 1e-9):.2f} files/s, "
+        f"{ROOT.GetThreadPoolSize()} threads)"
+    )
 
+
+def benchmark_event_loops(files, hist_config, triggers, max_concurrent, logging):
+    """
+    Time the per-file event loops run one after the other, as a GetValue on
+    each file's results does, and run concurrently by run_lumi_data, each on
+    freshly booked graphs. Returns the (sequential, concurrent) times in s.
+    """
+    timings = []
+    for concurrent in (False, True):
+        lds = [
+            lumi_data(ROOT.RDataFrame("Events", file), hist_config, triggers)
+            for file in files
+        ]
+        start = time.time()
+        if concurrent:
+            run_lumi_data(lds, max_concurrent, logging)
+        else:
+            for ld in lds:
+                for result in ld.values():
+                    result.GetValue()
+        timings.append(time.time() - start)
+
+    sequential, concurrent = timings
+    logging.info(
+        f"{len(files)} files: {sequential:.2f} s with GetValue, "
+        f"{concurrent:.2f} s with RunGraphs "
+        f"(speed-up {sequential / max(concurrent, 1e-9):.2f}x, "
+        f"{ROOT.GetThreadPoolSize()} threads)"
+    )
+    return sequential, concurrent
+
+
+def produce_time_evolution(lds, hist_config, bins, logging):
     clumi = 0.0
     lumi = 0.0
     lumi_bins = [0.0]
@@ -202,6 +315,122 @@ def produce_time_evolution(lds, hist_config, bins, logging):
     return hists
 
 
+def lumi_bin_groups(lumi, lumi_per_bin=None):
+    """
+    Assign consecutive blocks to luminosity bins. A bin is closed once it
+    holds at least lumi_per_bin (or any luminosity if lumi_per_bin is not
+    set); blocks without luminosity join the following bin, or the last one.
+    """
+    groups = np.zeros(len(lumi), dtype=int)
+    current = 0
+    acc = 0.0
+    for i, block_lumi in enumerate(lumi):
+        groups[i] = current
+        acc += block_lumi
+        if acc > 0 and (not lumi_per_bin or acc >= lumi_per_bin):
+            current += 1
+            acc = 0.0
+    if acc == 0 and current > 0:
+        groups[groups == current] = current - 1
+
+    return groups
+
+
+def time_evolution_from_store(store, hist_config, logging, lumi_per_bin=None):
+    """
+    Build the time evolution histograms from a summary store by merging the
+    per-run (or lumisection block) sums into luminosity bins, with one bin
+    per run if lumi_per_bin is not set. No event loop is needed.
+    """
+    start = time.time()
+    blocks = read_blocks(store)
+    if len(blocks["run"]) == 0:
+        raise ValueError("The summary store is empty")
+
+    groups = lumi_bin_groups(blocks["lumi"], lumi_per_bin)
+    n_bins = groups[-1] + 1
+    starts = np.flatnonzero(np.diff(groups, prepend=-1))
+    lumi_bins = np.concatenate(
+        [[0.0], np.cumsum(np.bincount(groups, blocks["lumi"], n_bins))]
+    )
+    min_runs = np.minimum.reduceat(blocks["run"], starts)
+    max_runs = np.maximum.reduceat(blocks["run"], starts)
+
+    hs = {}
+    hs["min_runs"] = ROOT.TH1D("min_runs", "min_runs", n_bins, lumi_bins)
+    hs["max_runs"] = ROOT.TH1D("max_runs", "max_runs", n_bins, lumi_bins)
+    for i in range(n_bins):
+        hs["min_runs"].SetBinContent(i + 1, min_runs[i])
+        hs["max_runs"].SetBinContent(i + 1, max_runs[i])
+
+    for hist in hist_config:
+        if hist_config[hist]["type"] == "Histo1D":
+            continue
+        name = hist_config[hist]["name"]
+        title = f"{hist};Cumulative luminosity (fb^{{-1}});<Response>"
+        hs[hist] = ROOT.TH1D(f"{name}_int_lumi", title, n_bins, lumi_bins)
+
+        sums = read_summaries(store, hist)
+        means, errors = mean_and_error(
+            *[
+                np.bincount(groups, sums[field], n_bins)
+                for field in ["sumw", "sumw2", "sumwy", "sumwy2"]
+            ]
+        )
+        for i in range(n_bins):
+            hs[hist].SetBinContent(i + 1, means[i])
+            hs[hist].SetBinError(i + 1, errors[i])
+
+    logging.info(
+        f"Built time evolution of {len(blocks['run'])} blocks in {n_bins} bins "
+        f"(took {time.time() - start:.3f} s)"
+    )
+    return list(hs.values()), int(min_runs[0]), int(max_runs[-1])
+
+
+def update_store(store, files, hist_config, triggers, args, logging):
+    if args.lumi_csv:
+        add_lumi_csv(store, args.lumi_csv)
+
+    new_files = [file for file in files if not file_in_store(store, file)]
+    logging.info(
+        f"Adding {len(new_files)} new files to the summary store "
+        f"({len(files) - len(new_files)} already stored)"
+    )
+
+    if len(new_files) > 0:
+        set_ls_block(store, args.ls_block)
+
+    # Book all files first and run their event loops together
+    rdfs, booked = [], []
+    for file in new_files:
+        rdf = ROOT.RDataFrame("Events", file)
+        rdfs.append(rdf)
+        booked.append(book_summary(rdf, hist_config, triggers, args.ls_block))
+    if len(booked) > 0:
+        run_lumi_data(booked, args.max_concurrent, logging)
+
+    for file, summary in zip(new_files, booked):
+        add_file(
+            store, file, *read_summary(summary, hist_config, triggers, args.ls_block)
+        )
+
+
+def write_time_evolution(hs, min_run, max_run, args, logging):
+    logging.info(f"Group run range: [{min_run}, {max_run}]")
+    if args.data_tag:
+        output_path = (
+            f"{args.out}/J4PTimeEvolution_runs{min_run}to{max_run}_{args.data_tag}.root"
+        )
+    else:
+        output_path = f"{args.out}/J4PTimeEvolution_runs{min_run}to{max_run}.root"
+
+    output_file = ROOT.TFile.Open(f"{output_path}", "RECREATE")
+    for h in hs:
+        h.Write()
+    output_file.Close()
+
+
 def run(state):
     args = state.args
     logging = state.logger
@@ -220,8 +449,6 @@ def run(state):
         paths = [p.strip() for p in args.filepaths.split(",")]
         for path in paths:
             files.extend(file_read_lines(path, find_ROOT=True))
-    else:
-        raise ValueError("No file list provided")
 
     with open(args.triggerfile, "r") as f:
         triggers = json.load(f)[args.channel]
@@ -233,28 +460,35 @@ def run(state):
     hist_config = dict(read_config_file(args.hist_config))
     del hist_config["DEFAULT"]
 
-    chain_data = ROOT.TChain("Events")
-    chain_runs = ROOT.TChain("Runs")
+    if args.benchmark:
+        benchmark_event_loops(
+            files, hist_config, triggers, args.max_concurrent, logging
+        )
+        return
 
+    if args.summary_store or args.lumi_per_bin:
+        store = open_store(args.summary_store or ":memory:")
+        update_store(store, files, hist_config, triggers, args, logging)
+        hs, min_run, max_run = time_evolution_from_store(
+            store, hist_config, logging, args.lumi_per_bin
+        )
+        store.close()
+
+        write_time_evolution(hs, min_run, max_run, args, logging)
+        return
+
+    start_booking = time.time()
     lds = []
     for file in files:
         rdf = ROOT.RDataFrame("Events", file)
 
         ld = lumi_data(rdf, hist_config, triggers)
         lds.append(ld)
+    logging.info(f"Booked {len(lds)} files in {time.time() - start_booking:.1f} s")
+
+    run_lumi_data(lds, args.max_concurrent, logging)
 
     min_run = int(min([ld["min_run"].GetValue() for ld in lds]))
     max_run = int(max([ld["max_run"].GetValue() for ld in lds]))
-    logging.info(f"Group run range: [{min_run}, {max_run}]")
-    if args.data_tag:
-        output_path = (
-            f"{args.out}/J4PTimeEvolution_runs{min_run}to{max_run}_{args.data_tag}.root"
-        )
-    else:
-        output_path = f"{args.out}/J4PTimeEvolution_runs{min_run}to{max_run}.root"
-
-    output_file = ROOT.TFile.Open(f"{output_path}", "RECREATE")
     hs = produce_time_evolution(lds, hist_config, bins, logging)
-    for h in hs:
-        h.Write()
-    output_file.Close()
+    write_time_evolution(hs, min_run, max_run, args, logging)
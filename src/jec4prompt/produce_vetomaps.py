@@ -1,8 +1,22 @@
+import gzip
+import json
+import os
+import time
 from typing import List
 
 import numpy as np
 import ROOT
-from jec4prompt.utils.processing_utils import file_read_lines, get_bins, read_config_file
+from jec4prompt.utils.histogram_utils import (
+    axis_edges,
+    th2_from_numpy,
+    th2_to_numpy,
+)
+from jec4prompt.utils.processing_utils import (
+    file_key,
+    file_read_lines,
+    get_bins,
+    read_config_file,
+)
 
 hist_info = (
     ("standard", "PFComposition", "PFComposition_EtaVsPhiVsProfileNEF_selected"),
@@ -26,7 +40,7 @@ def add_vetomaps_parser(subparsers):
         help="Produce VetoMaps for files \
             produced by JEC4PROMPT analysis",
     )
-    vetomaps_files = vetomaps_parser.add_mutually_exclusive_group(required=True)
+    vetomaps_files = vetomaps_parser.add_mutually_exclusive_group()
     vetomaps_files.add_argument(
         "--filelist",
         type=str,
@@ -58,10 +72,39 @@ def add_vetomaps_parser(subparsers):
     vetomaps_parser.add_argument(
         "--config", type=str, default="", help="Path to config file"
     )
+    vetomaps_parser.add_argument(
+        "--engine",
+        type=str,
+        default="root",
+        choices=["root", "numpy"],
+        help="Veto map derivation engine: \
+            per-bin ROOT loops or vectorized numpy arrays",
+    )
+    vetomaps_parser.add_argument(
+        "--accumulator",
+        type=str,
+        help="Path to a .npz accumulator file. \
+            Input files are folded into it and the veto maps are derived from \
+            everything accumulated so far into <out>/J4PVetoMaps.root",
+    )
+    vetomaps_parser.add_argument(
+        "--export_correctionlib",
+        action="store_true",
+        help="Also export the veto maps \
+            as a gzipped correctionlib JSON and memory-mappable bitmap \
+            sidecars (.vmap) for skim",
+    )
+    vetomaps_parser.add_argument(
+        "--compare_engines",
+        action="store_true",
+        help="Run both engines, report their \
+            timing and check that the veto maps match bin for bin",
+    )
 
 
 def validate_args(args):
-    pass
+    if not (args.filelist or args.filepaths or args.accumulator):
+        raise ValueError("--filelist or --filepaths is required without --accumulator")
 
 
 def produce_vetomap_old(input_file: str, trigger_list: List[str], output_path: str):
@@ -491,7 +534,523 @@ def produce_vetomap(input_file: str, trigger_list: List[str], output_path: str):
         file.cd()
 
 
-def run(args):
+def _sequential_sum(a: np.ndarray, axis: int = -1) -> np.ndarray:
+    # Sum in bin order like TH1::Integral so that thresholds match bin for bin
+    return np.cumsum(a, axis=axis).take(-1, axis=axis)
+
+
+def derive_vetomaps(values: np.ndarray, errors: np.ndarray, db_values: np.ndarray):
+    """
+    Vectorized version of the veto map algorithm in produce_vetomap.
+
+    values and errors hold the input method histograms indexed as
+    [method, eta, phi] and db_values the DB asymmetry map as [eta, phi].
+    Returns a dict with the veto maps, the deltas and the values filled into
+    the spread of deltas.
+    """
+    n_methods, n_eta, n_phi = values.shape
+
+    # Normalize eta strips to area and average over the methods
+    area = _sequential_sum(values)[..., None]
+    safe_area = np.where(area != 0, area, 1.0)
+    norm_values = np.where(area != 0, values / safe_area, values)
+    norm_errors = np.where(area != 0, np.abs(errors / safe_area), errors)
+    sum_values = np.zeros((n_eta, n_phi))
+    sum_errors = np.zeros((n_eta, n_phi))
+    for m in range(n_methods):
+        sum_values = sum_values + norm_values[m]
+        sum_errors = sum_errors + norm_errors[m]
+    sum_values = sum_values * (1.0 / n_methods)
+    sum_errors = sum_errors * (1.0 / n_methods)
+
+    # Middle bin(s) of each eta strip and the spread around it
+    if n_phi % 2 == 0:
+        median = (sum_values[:, n_phi // 2 - 1] + sum_values[:, n_phi // 2]) / 2
+    else:
+        median = sum_values[:, n_phi // 2 - 1]
+    sigma = np.sqrt(_sequential_sum((sum_values - median[:, None]) ** 2) / n_phi)
+
+    strip_ok = (sigma != 0)[:, None]
+    median_ok = (median != 0)[:, None]
+    safe_median = np.where(median_ok, median[:, None], 1.0)
+    safe_sigma = np.where(strip_ok, sigma[:, None], 1.0)
+    selected = (
+        strip_ok & median_ok & (sum_errors != 0) & (sum_errors / safe_median < 0.5)
+    )
+
+    delta = np.where(selected, (sum_values - median[:, None]) / safe_sigma, 0.0)
+    outside3 = np.abs(delta) > 3
+    maps = {
+        "veto_map_loose": selected & ~((delta < 5) & (delta > -5)),
+        "veto_map_medium": selected & ~((delta < 3) & (delta > -3)),
+        "veto_map_tight": selected & ~((delta < 1) & (delta > -1)),
+        "veto_map_hot": selected & (db_values > 0) & outside3,
+        "veto_map_cold": selected & (db_values < 0) & outside3,
+    }
+    maps = {name: vmap.astype(float) for name, vmap in maps.items()}
+    maps["veto_map_hotandcold"] = maps["veto_map_hot"] + maps["veto_map_cold"]
+    maps["deltas"] = delta
+
+    # Strips with a zero median fill zeros into the spread of deltas
+    n_zero_fills = int(np.sum(strip_ok[:, 0] & ~median_ok[:, 0])) * n_phi
+    maps["spread_values"] = np.concatenate([delta[selected], np.zeros(n_zero_fills)])
+    return maps
+
+
+def write_vetomaps(file, trg: str, maps: dict, DB_map):
+    """
+    Write veto maps derived with derive_vetomaps to trg/standard/VetoMap.
+    """
+    bins = get_bins()
+
+    titles = {
+        "veto_map_loose": "Veto map loose",
+        "veto_map_medium": "Veto map medium",
+        "veto_map_tight": "Veto map tight",
+        "veto_map_hot": "Veto map hot",
+        "veto_map_cold": "Veto map cold",
+        "veto_map_hotandcold": "Veto map hot and cold",
+    }
+    hists = [
+        th2_from_numpy(
+            name, title, bins["eta"]["bins"], bins["phi"]["bins"], maps[name]
+        )
+        for name, title in titles.items()
+    ]
+    spread_of_deltas = ROOT.TH1D("spread_of_deltas", "Spread of deltas", 100, -3, 3)
+    if len(maps["spread_values"]) > 0:
+        spread_of_deltas.FillN(
+            len(maps["spread_values"]),
+            maps["spread_values"],
+            np.ones(len(maps["spread_values"])),
+        )
+    deltas = th2_from_numpy(
+        "deltas", "Deltas", bins["eta"]["bins"], bins["phi"]["bins"], maps["deltas"]
+    )
+
+    # Write the veto maps to the file
+    if not file.GetDirectory(trg):
+        file.mkdir(trg)
+    if not file.GetDirectory(trg + "/standard/VetoMap"):
+        file.mkdir(trg + "/standard/VetoMap")
+    file.cd(trg + "/standard/VetoMap")
+    for h in hists:
+        h.Write()
+    spread_of_deltas.Write()
+    DB_map.Write()
+    deltas.Write()
+    file.cd()
+
+
+def produce_vetomap_numpy(
+    input_file: str, trigger_list: List[str], output_path: str, write: bool = True
+):
+    """
+    VetoMap producer for dijet_rdf using the numpy engine. Produces the same
+    objects as produce_vetomap.
+    """
+
+    bins = get_bins()
+
+    file = ROOT.TFile(input_file, "UPDATE" if write else "READ")
+    if len(trigger_list) == 0:
+        print("No triggers provided. Using all triggers in the file.")
+        trigger_keys = file.GetListOfKeys()
+        trigger_list = [tkey.GetName() for tkey in trigger_keys]
+
+    results = {}
+    for trg in trigger_list:
+        values = []
+        errors = []
+        DB_map = ROOT.TH2D(
+            "DB_map",
+            "DB map",
+            bins["eta"]["n"],
+            bins["eta"]["bins"],
+            bins["phi"]["n"],
+            bins["phi"]["bins"],
+        )
+        for system, method, hname in hist_info:
+            obj_path = f"{trg}/{system}/{method}/{hname}"
+            obj = file.Get(obj_path)
+            assert obj, f"Object not found at {obj_path}"
+            assert obj.InheritsFrom(
+                "TH2D"
+            ), f"Object at {obj_path} is not a TH2D or derived class"
+
+            h2 = obj.ProjectionXY() if obj.InheritsFrom("TProfile2D") else obj
+            if hname == "DB_dijet_EtaprobeVsPhiprobeVsAsymmetry":
+                DB_map = h2.Clone("DB_map")
+
+            h2_values, h2_variances = th2_to_numpy(h2)
+            values.append(h2_values)
+            errors.append(np.sqrt(h2_variances))
+
+        db_values, _ = th2_to_numpy(DB_map)
+        maps = derive_vetomaps(np.array(values), np.array(errors), db_values)
+        results[trg] = maps
+
+        if write:
+            write_vetomaps(file, trg, maps, DB_map)
+
+    file.Close()
+    return results
+
+
+def compare_vetomap_engines(input_file: str, trigger_list: List[str], output_path: str):
+    """
+    Run both veto map engines on input_file, report their timing and check
+    that the veto maps written by produce_vetomap match the numpy ones.
+    """
+    start = time.time()
+    produce_vetomap(input_file, trigger_list, output_path)
+    root_time = time.time() - start
+
+    start = time.time()
+    results = produce_vetomap_numpy(input_file, trigger_list, output_path, write=False)
+    numpy_time = time.time() - start
+    print(
+        f"{input_file}: ROOT engine {root_time:.2f} s, numpy engine "
+        f"{numpy_time:.2f} s (x{root_time / max(numpy_time, 1e-9):.1f})"
+    )
+
+    file = ROOT.TFile.Open(input_file, "READ")
+    n_mismatched = 0
+    for trg, maps in results.items():
+        for name in (
+            "veto_map_loose",
+            "veto_map_medium",
+            "veto_map_tight",
+            "veto_map_hot",
+            "veto_map_cold",
+            "veto_map_hotandcold",
+        ):
+            h = file.Get(f"{trg}/standard/VetoMap/{name}")
+            values, _ = th2_to_numpy(h)
+            mismatched = int(np.sum(values != maps[name]))
+            n_mismatched += mismatched
+            if mismatched > 0:
+                print(f"{trg}/{name}: {mismatched} bins differ")
+    file.Close()
+
+    if n_mismatched == 0:
+        print(f"{input_file}: veto maps match bin for bin")
+    return n_mismatched
+
+
+def load_accumulator(path: str) -> dict:
+    """
+    Load the veto map accumulator state from path, or return an empty state
+    if the file does not exist yet.
+    """
+    acc = {"files": [], "sums": {}}
+    if not os.path.exists(path):
+        return acc
+
+    with np.load(path) as data:
+        acc["files"] = [str(f) for f in data["files"]]
+        for key in data.files:
+            if key == "files":
+                continue
+            trg, hname, field = key.split(":")
+            acc["sums"].setdefault((trg, hname), {})[field] = data[key]
+    return acc
+
+
+def save_accumulator(path: str, acc: dict):
+    arrays = {"files": np.array(acc["files"], dtype=str)}
+    for (trg, hname), sums in acc["sums"].items():
+        for field, value in sums.items():
+            arrays[f"{trg}:{hname}:{field}"] = value
+
+    # Write to a temporary file first so an interrupted run keeps the old state
+    tmp_path = path + ".tmp.npz"
+    np.savez_compressed(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def accumulate_vetomap_inputs(input_file: str, trigger_list: List[str], acc: dict):
+    """
+    Fold the per-bin sums of the hist_info inputs of input_file into the
+    accumulator. Profiles keep the sum of weights, the weighted sums of the
+    values and their squares, and the sum of squared weights per bin;
+    histograms keep the sum of weights and the sum of squared weights. The
+    file is recorded by its file_key.
+    """
+    file = ROOT.TFile.Open(input_file, "READ")
+    if len(trigger_list) == 0:
+        trigger_list = [tkey.GetName() for tkey in file.GetListOfKeys()]
+
+    for trg in trigger_list:
+        for system, method, hname in hist_info:
+            obj_path = f"{trg}/{system}/{method}/{hname}"
+            obj = file.Get(obj_path)
+            assert obj, f"Object not found at {obj_path}"
+
+            if obj.InheritsFrom("TProfile2D"):
+                sumwy, sumwy2 = th2_to_numpy(obj)
+                nx, ny = sumwy.shape
+                sumw = np.array(
+                    [
+                        [obj.GetBinEntries(obj.GetBin(i, j)) for j in range(1, ny + 1)]
+                        for i in range(1, nx + 1)
+                    ]
+                )
+                binsumw2 = np.frombuffer(
+                    obj.GetBinSumw2().GetArray(),
+                    dtype=np.float64,
+                    count=obj.GetNcells(),
+                )
+                binsumw2 = binsumw2.reshape(ny + 2, nx + 2).T[1:-1, 1:-1]
+                sums = {
+                    "sumw": sumw,
+                    "sumwy": sumwy,
+                    "sumwy2": sumwy2,
+                    "binsumw2": binsumw2,
+                }
+            else:
+                sumw, sumw2 = th2_to_numpy(obj)
+                sums = {"sumw": sumw, "sumw2": sumw2}
+
+            current = acc["sums"].setdefault((trg, hname), {})
+            for field, value in sums.items():
+                current[field] = current.get(field, 0.0) + value
+
+    file.Close()
+    acc["files"].append(file_key(input_file))
+
+
+def _accumulated_values(sums: dict):
+    """
+    Bin contents and errors of the method histogram described by sums, as
+    given by TProfile2D::ProjectionXY for profiles.
+    """
+    if "sumwy" not in sums:
+        return sums["sumw"], np.sqrt(sums["sumw2"])
+
+    sumw = sums["sumw"]
+    filled = sumw != 0
+    safe_sumw = np.where(filled, sumw, 1.0)
+    mean = np.where(filled, sums["sumwy"] / safe_sumw, 0.0)
+    spread = np.sqrt(np.abs(sums["sumwy2"] / safe_sumw - mean**2))
+    binsumw2 = np.where(sums["binsumw2"] != 0, sums["binsumw2"], 1.0)
+    neff = np.where(sums["binsumw2"] != 0, sumw**2 / binsumw2, sumw)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        error = np.where(filled & (neff > 0), spread / np.sqrt(neff), 0.0)
+    return mean, error
+
+
+def vetomaps_from_accumulator(acc: dict, output_file: str):
+    """
+    Derive the veto maps of every trigger in the accumulator and write them
+    to output_file.
+    """
+    bins = get_bins()
+    triggers = sorted({trg for trg, _ in acc["sums"]})
+
+    file = ROOT.TFile(output_file, "RECREATE")
+    results = {}
+    for trg in triggers:
+        values = []
+        errors = []
+        for _, _, hname in hist_info:
+            value, error = _accumulated_values(acc["sums"][(trg, hname)])
+            values.append(value)
+            errors.append(error)
+            if hname == "DB_dijet_EtaprobeVsPhiprobeVsAsymmetry":
+                db_values, db_errors = value, error
+
+        maps = derive_vetomaps(np.array(values), np.array(errors), db_values)
+        DB_map = th2_from_numpy(
+            "DB_map",
+            "DB map",
+            bins["eta"]["bins"],
+            bins["phi"]["bins"],
+            db_values,
+            db_errors,
+        )
+        write_vetomaps(file, trg, maps, DB_map)
+        results[trg] = maps
+
+    file.Close()
+    return results
+
+
+def produce_vetomaps_incremental(
+    files: List[str], trigger_list: List[str], output_path: str, accumulator: str
+):
+    """
+    Fold new input files into the accumulator at path accumulator and derive
+    the veto maps for everything accumulated so far.
+    """
+    acc = load_accumulator(accumulator)
+    for file in files:
+        if file_key(file) in acc["files"]:
+            print(f"{file} already accumulated, skipping")
+            continue
+        start = time.time()
+        accumulate_vetomap_inputs(file, trigger_list, acc)
+        print(f"Accumulated {file} in {time.time() - start:.2f} s")
+    save_accumulator(accumulator, acc)
+
+    if len(acc["sums"]) == 0:
+        print("Accumulator is empty, no veto maps produced")
+        return
+
+    start = time.time()
+    output_file = os.path.join(output_path, "J4PVetoMaps.root")
+    vetomaps_from_accumulator(acc, output_file)
+    print(
+        f"Veto maps for {len(acc['files'])} files written to {output_file} "
+        f"(took {(time.time() - start) * 1000:.1f} ms)"
+    )
+
+
+# Veto map types in the exported files, "jetvetomap" is the default type
+# evaluated by skim
+export_types = {
+    "jetvetomap": "veto_map_medium",
+    "jetvetomap_loose": "veto_map_loose",
+    "jetvetomap_medium": "veto_map_medium",
+    "jetvetomap_tight": "veto_map_tight",
+    "jetvetomap_hot": "veto_map_hot",
+    "jetvetomap_cold": "veto_map_cold",
+    "jetvetomap_hotandcold": "veto_map_hotandcold",
+}
+bitmap_magic = b"J4PVMAP1"
+bitmap_name_length = 32
+
+
+def write_vetomap_bitmap(path: str, eta_edges, phi_edges, maps: dict):
+    """
+    Write veto maps to a binary sidecar that can be memory-mapped directly.
+
+    Layout (little-endian): the magic "J4PVMAP1", int32 n_eta, n_phi, n_maps
+    and a reserved int32, float64 eta and phi bin edges, n_maps null-padded
+    32 byte map names, followed by one bit per (eta, phi) bin for each map
+    (phi varying fastest, most significant bit first).
+    """
+    names = list(maps)
+    with open(path, "wb") as f:
+        f.write(bitmap_magic)
+        f.write(
+            np.array(
+                [len(eta_edges) - 1, len(phi_edges) - 1, len(names), 0], dtype="<i4"
+            ).tobytes()
+        )
+        f.write(np.asarray(eta_edges, dtype="<f8").tobytes())
+        f.write(np.asarray(phi_edges, dtype="<f8").tobytes())
+        for name in names:
+            f.write(name.encode().ljust(bitmap_name_length, b"\0"))
+        for name in names:
+            f.write(np.packbits(maps[name].ravel() > 0).tobytes())
+
+
+def read_vetomap_bitmap(path: str) -> dict:
+    """
+    Memory-map a sidecar written by write_vetomap_bitmap. Returns the eta and
+    phi edges and the veto maps as boolean arrays indexed as [eta, phi].
+    """
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    assert bytes(data[:8]) == bitmap_magic, f"{path} is not a veto map bitmap"
+    n_eta, n_phi, n_maps, _ = data[8:24].view("<i4")
+    offset = 24
+    eta_edges = data[offset : offset + 8 * (n_eta + 1)].view("<f8")
+    offset += 8 * (n_eta + 1)
+    phi_edges = data[offset : offset + 8 * (n_phi + 1)].view("<f8")
+    offset += 8 * (n_phi + 1)
+    names = []
+    for _ in range(n_maps):
+        name = bytes(data[offset : offset + bitmap_name_length])
+        names.append(name.rstrip(b"\0").decode())
+        offset += bitmap_name_length
+
+    map_bytes = (n_eta * n_phi + 7) // 8
+    maps = {}
+    for name in names:
+        bits = np.unpackbits(data[offset : offset + map_bytes])
+        maps[name] = bits[: n_eta * n_phi].reshape(n_eta, n_phi).astype(bool)
+        offset += map_bytes
+    return {"eta_edges": eta_edges, "phi_edges": phi_edges, "maps": maps}
+
+
+def export_vetomaps(root_file: str, output_path: str):
+    """
+    Export the veto maps in root_file to a gzipped correctionlib JSON with one
+    correction per trigger, and to one bitmap sidecar per trigger.
+    """
+    file = ROOT.TFile.Open(root_file, "READ")
+    stem = os.path.basename(root_file).replace(".root", "")
+
+    corrections = []
+    for tkey in file.GetListOfKeys():
+        trg = tkey.GetName()
+        if not file.GetDirectory(f"{trg}/standard/VetoMap"):
+            continue
+
+        maps = {}
+        for vtype, hname in export_types.items():
+            h = file.Get(f"{trg}/standard/VetoMap/{hname}")
+            values, _ = th2_to_numpy(h)
+            maps[vtype] = values
+        eta_edges = axis_edges(h.GetXaxis())
+        phi_edges = axis_edges(h.GetYaxis())
+
+        corrections.append(
+            {
+                "name": trg,
+                "version": 1,
+                "description": f"Jet veto maps for {trg} derived by JEC4PROMPT",
+                "inputs": [
+                    {"name": "type", "type": "string", "description": "Veto map type"},
+                    {"name": "eta", "type": "real", "description": "Jet eta"},
+                    {"name": "phi", "type": "real", "description": "Jet phi"},
+                ],
+                "output": {"name": "vetomap", "type": "real"},
+                "data": {
+                    "nodetype": "category",
+                    "input": "type",
+                    "content": [
+                        {
+                            "key": vtype,
+                            "value": {
+                                "nodetype": "multibinning",
+                                "inputs": ["eta", "phi"],
+                                "edges": [eta_edges.tolist(), phi_edges.tolist()],
+                                "content": values.ravel().tolist(),
+                                "flow": "clamp",
+                            },
+                        }
+                        for vtype, values in maps.items()
+                    ],
+                },
+            }
+        )
+
+        bitmap_path = os.path.join(output_path, f"{stem}_{trg}.vmap")
+        write_vetomap_bitmap(bitmap_path, eta_edges, phi_edges, maps)
+        print(f"Veto map bitmap for {trg} written to {bitmap_path}")
+    file.Close()
+
+    json_path = os.path.join(output_path, f"{stem}_vetomaps.json.gz")
+    with gzip.open(json_path, "wt") as f:
+        json.dump(
+            {
+                "schema_version": 2,
+                "description": f"Jet veto maps derived from {root_file}",
+                "corrections": corrections,
+            },
+            f,
+        )
+    print(
+        f"Veto maps written to {json_path}, use it as vetomap_path with "
+        f"vetomap_set one of {[c['name'] for c in corrections]} "
+        "(or vetomap_bitmap for the .vmap sidecars) in the correction JSON"
+    )
+
+
+def run(state):
+    args = state.args
     trigger_list: List[str] = []
     files: List[str] = []
 
@@ -507,7 +1066,7 @@ def run(args):
         paths = [p.strip() for p in args.filepaths.split(",")]
         for path in paths:
             files.extend(file_read_lines(path, find_ROOT=True))
-    else:
+    elif not args.accumulator:
         raise ValueError("No file list provided")
 
     output_path = args.out
@@ -516,5 +1075,19 @@ def run(args):
         config_file = args.config
         config = read_config_file(config_file)
 
+    if args.accumulator:
+        produce_vetomaps_incremental(files, trigger_list, output_path, args.accumulator)
+        if args.export_correctionlib:
+            export_vetomaps(os.path.join(output_path, "J4PVetoMaps.root"), output_path)
+        return
+
     for file in files:
-        produce_vetomap(file, trigger_list, output_path)
+        if args.compare_engines:
+            compare_vetomap_engines(file, trigger_list, output_path)
+        elif args.engine == "numpy":
+            produce_vetomap_numpy(file, trigger_list, output_path)
+        else:
+            produce_vetomap(file, trigger_list, output_path)
+
+        if args.export_correctionlib:
+            export_vetomaps(file, output_path or os.path.dirname(file))
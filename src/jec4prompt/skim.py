@@ -8,11 +8,21 @@ import numpy as np
 import pandas as pd
 import ROOT
 from jec4prompt.selections.JEC import jet_columns, run_JEC
+from jec4prompt.utils.file_cache import add_cache_args, open_cache, validate_cache_args
+from jec4prompt.utils.heartbeat import Heartbeat
+from jec4prompt.utils.input_check import (
+    add_check_args,
+    check_inputs,
+    validate_check_args,
+)
 from jec4prompt.utils.processing_utils import file_read_lines
 from jec4prompt.utils.skimming_utils import (
     correct_jets,
+    count_events,
+    entry_list,
     filter_json,
     find_vetojets,
+    find_vetojets_bitmap,
     get_Flags,
     sort_jets,
 )
@@ -135,6 +145,12 @@ def add_skim_parser(state):
         "--nsteps", type=int, help="Number of steps input files are grouped into."
     )
     skim_parser.add_argument("--step", type=int, help="Step to be processed.")
+    skim_parser.add_argument(
+        "--plan",
+        type=str,
+        help="Path to a step plan .json file \
+            produced by plan_skim. The files of --step are taken from the plan.",
+    )
     skim_parser.add_argument(
         "--progress_bar", action="store_true", help="Show progress bar"
     )
@@ -183,6 +199,20 @@ def add_skim_parser(state):
             (run_min and run_max separated by a comma)",
     )
     skim_parser.add_argument("--mc_tag", type=str, help="MC tag of the given MC files")
+    skim_parser.add_argument(
+        "--heartbeat",
+        type=str,
+        help="Path to a .json file updated during \
+            the event loop with the events processed, events/s and current file",
+    )
+    skim_parser.add_argument(
+        "--heartbeat_interval",
+        type=float,
+        default=30.0,
+        help="Seconds between heartbeats",
+    )
+    add_cache_args(skim_parser)
+    add_check_args(skim_parser)
 
 
 def validate_args(args):
@@ -190,13 +220,20 @@ def validate_args(args):
         raise ValueError("is_mc not set but mc_tag given")
     if args.is_mc and args.run_range:
         raise ValueError("run_range and is_mc both set")
-    if (args.step is not None and args.nsteps is None) or (
+    if args.plan:
+        if args.step is None:
+            raise ValueError("step should be given with plan")
+    elif (args.step is not None and args.nsteps is None) or (
         args.nsteps is not None and args.step is None
     ):
         raise ValueError("nsteps and step should be passed together")
     if args.step is not None and args.nsteps is not None:
         if args.step > args.nsteps:
             raise ValueError("step should be less than nsteps")
+    if args.heartbeat_interval <= 0:
+        raise ValueError("heartbeat_interval should be positive")
+    validate_cache_args(args)
+    validate_check_args(args)
 
 
 def run(state):
@@ -216,7 +253,14 @@ def run(state):
     else:
         files = [s.strip() for s in args.filelist.split(",")]
 
-    if args.nsteps is not None and args.step is not None:
+    entry_ranges = {}
+    if args.plan:
+        with open(args.plan) as f:
+            plan = json.load(f)
+        if args.step >= plan["nsteps"]:
+            raise ValueError(f"step should be less than {plan['nsteps']}")
+        files, entry_ranges = plan_step_inputs(plan, args.step)
+    elif args.nsteps is not None and args.step is not None:
         n = args.nsteps
         i = args.step
         files = files[i::n]
@@ -229,32 +273,95 @@ def run(state):
     if not os.path.exists(args.out):
         os.makedirs(args.out)
 
-    skim(files, triggers, state)
+    skim(files, triggers, state, entry_ranges)
+
+
+def plan_step_inputs(plan, step):
+    """
+    Files of a step of a plan_skim plan and the entry ranges of its split
+    files.
+    """
+    files, entry_ranges = [], {}
+    for item in plan["steps"][step]:
+        if item["file"] not in files:
+            files.append(item["file"])
+        if "first" in item:
+            entry_ranges.setdefault(item["file"], []).append(
+                (item["first"], item["last"])
+            )
+    return files, entry_ranges
+
+
+def carries_runs(file, entry_ranges):
+    # Only the entry range starting at 0 of a split file carries its Runs tree
+    return file not in entry_ranges or min(entry_ranges[file])[0] == 0
+
 
+def merge_parts(output_path, parts):
+    """
+    hadd the snapshot parts into output_path.root and remove them.
+    """
+    subprocess.run(["hadd", "-f", output_path + ".root", *parts], check=True)
+    for part in parts:
+        os.remove(part)
 
-def skim(files, triggers, state):
+
+def skim(files, triggers, state, entry_ranges=None):
     args = state.args
     logger = state.logger
     step = args.step
+    entry_ranges = entry_ranges or {}
 
     # Load the files
     events_chain = ROOT.TChain("Events")
     runs_chain = ROOT.TChain("Runs")
 
+    paths = {
+        file: file if args.is_local else f"{args.redirector}{file}" for file in files
+    }
+    if args.check_inputs:
+        report_path = os.path.join(
+            args.out, "input_check" + (f"_{step}" if step is not None else "") + ".json"
+        )
+        files = check_inputs(files, paths, args, report_path, logger)
+        if len(files) == 0:
+            raise ValueError("No input files left after the input check")
+        paths = {file: paths[file] for file in files}
+
+    cache = None if args.is_local else open_cache(args, logger)
+    if cache is not None:
+        paths = dict(zip(files, cache.resolve(list(paths.values()))))
+        cache.close()
+
+    chain_ranges = {}
+    inputs = {}
     for file in files:
+        path = paths[file]
+        inputs[path] = file
+        add_runs = carries_runs(file, entry_ranges)
+        if file in entry_ranges:
+            chain_ranges[path] = entry_ranges[file]
         if not args.is_local:
             try:
-                events_chain.Add(f"{args.redirector}{file}")
-                runs_chain.Add(f"{args.redirector}{file}")
+                events_chain.Add(path)
+                if add_runs:
+                    runs_chain.Add(path)
             except Exception as e:
                 logger.warning(f"Skipping problematic run: {e}")
         else:
-            events_chain.Add(file)
-            runs_chain.Add(file)
+            events_chain.Add(path)
+            if add_runs:
+                runs_chain.Add(path)
+
+    if len(chain_ranges) > 0:
+        events_chain.SetEntryList(entry_list(events_chain, chain_ranges))
 
     events_rdf = ROOT.RDataFrame(events_chain)
     runs_rdf = ROOT.RDataFrame(runs_chain)
 
+    if args.heartbeat:
+        events_rdf, n_events, current_file = count_events(events_rdf)
+
     if args.progress_bar:
         ROOT.RDF.Experimental.AddProgressBar(events_rdf)
 
@@ -307,7 +414,13 @@ def skim(files, triggers, state):
             events_rdf = sort_jets(events_rdf, jet_columns)
 
         # Vetomaps
-        if "vetomap_path" and "vetomap_set" in correction_info:
+        if "vetomap_bitmap" in correction_info:
+            events_rdf = find_vetojets_bitmap(
+                events_rdf,
+                correction_info["vetomap_bitmap"],
+                correction_info.get("vetomap_type", "jetvetomap"),
+            )
+        elif "vetomap_path" and "vetomap_set" in correction_info:
             events_rdf = find_vetojets(
                 events_rdf,
                 correction_info["vetomap_path"],
@@ -474,105 +587,123 @@ def skim(files, triggers, state):
     events_ss = events_rdf.Snapshot(
         "Events", output_path + "_events.root", columns, options=ss_options
     )
-    runs_ss = runs_rdf.Snapshot("Runs", output_path + "_runs.root", options=ss_options)
+    handles = [events_ss]
+    parts = [output_path + "_events.root"]
+    # The Runs tree of a split file is written by the step with its first range
+    if runs_chain.GetNtrees() > 0:
+        handles.append(
+            runs_rdf.Snapshot("Runs", output_path + "_runs.root", options=ss_options)
+        )
+        parts.append(output_path + "_runs.root")
     # Get a report of the processing and process the snapshot
     report = events_rdf.Report()
-    ROOT.RDF.RunGraphs([events_ss, runs_ss, report])
-    snapshot_time = time.time() - start
-    if snapshot_time < 1:
-        logger.info(
-            f"snapshot finished in {snapshot_time*1000:.2f} ms for {output_path}.root"
-        )
-    elif snapshot_time < 60:
-        logger.info(
-            f"snapshot finished in {snapshot_time:.2f} s for {output_path}.root"
-        )
-    else:
-        minutes, seconds = divmod(snapshot_time, 60)
-        logger.info(
-            f"snapshot finished in {int(minutes)} min {seconds:.2f} s for {output_path}.root"
-        )
+    handles.append(report)
+    heartbeat = None
+    if args.heartbeat:
+        # Let the heartbeat thread run during the event loop
+        ROOT.RDF.RunGraphs.__release_gil__ = True
+        heartbeat = Heartbeat(
+            args.heartbeat,
+            files,
+            n_events,
+            lambda: inputs.get(current_file(), ""),
+            args.heartbeat_interval,
+            step,
+        ).start()
+    try:
+        ROOT.RDF.RunGraphs(handles)
+        snapshot_time = time.time() - start
+        if snapshot_time < 1:
+            logger.info(
+                f"snapshot finished in {snapshot_time*1000:.2f} ms for {output_path}.root"
+            )
+        elif snapshot_time < 60:
+            logger.info(
+                f"snapshot finished in {snapshot_time:.2f} s for {output_path}.root"
+            )
+        else:
+            minutes, seconds = divmod(snapshot_time, 60)
+            logger.info(
+                f"snapshot finished in {int(minutes)} min {seconds:.2f} s for {output_path}.root"
+            )
 
-    start = time.time()
-    subprocess.run(
-        [
-            "hadd",
-            "-f",
-            output_path + ".root",
-            output_path + "_events.root",
-            output_path + "_runs.root",
-        ]
-    )
-    hadd_time = time.time() - start
-    if hadd_time < 1:
-        logger.info(f"hadd finished in {hadd_time*1000:.2f} ms for {output_path}.root")
-    elif hadd_time < 60:
-        logger.info(f"hadd finished in {hadd_time:.2f} s for {output_path}.root")
-    else:
-        minutes, seconds = divmod(hadd_time, 60)
-        logger.info(
-            f"hadd finished in {int(minutes)} min {seconds:.2f} s for {output_path}.root"
-        )
+        start = time.time()
+        merge_parts(output_path, parts)
+        hadd_time = time.time() - start
+        if hadd_time < 1:
+            logger.info(
+                f"hadd finished in {hadd_time*1000:.2f} ms for {output_path}.root"
+            )
+        elif hadd_time < 60:
+            logger.info(f"hadd finished in {hadd_time:.2f} s for {output_path}.root")
+        else:
+            minutes, seconds = divmod(hadd_time, 60)
+            logger.info(
+                f"hadd finished in {int(minutes)} min {seconds:.2f} s for {output_path}.root"
+            )
 
-    # Remove the temporary files
-    os.remove(output_path + "_events.root")
-    os.remove(output_path + "_runs.root")
-
-    logger.info(output_path + ".root")
-
-    begin = report.begin()
-    end = report.end()
-    allEntries = 0 if begin == end else begin.__deref__().GetAll()
-
-    # Collect the cuts
-    it = begin
-    cuts = []
-    while it != end:
-        ci = it.__deref__()
-        cuts.append(
-            {
-                ci.GetName(): {
-                    "pass": ci.GetPass(),
-                    "all": ci.GetAll(),
-                    "eff": ci.GetEff(),
-                    "cumulativeEff": (
-                        100.0 * float(ci.GetPass()) / float(allEntries)
-                        if allEntries > 0
-                        else 0.0
-                    ),
+        logger.info(output_path + ".root")
+
+        begin = report.begin()
+        end = report.end()
+        allEntries = 0 if begin == end else begin.__deref__().GetAll()
+
+        # Collect the cuts
+        it = begin
+        cuts = []
+        while it != end:
+            ci = it.__deref__()
+            cuts.append(
+                {
+                    ci.GetName(): {
+                        "pass": ci.GetPass(),
+                        "all": ci.GetAll(),
+                        "eff": ci.GetEff(),
+                        "cumulativeEff": (
+                            100.0 * float(ci.GetPass()) / float(allEntries)
+                            if allEntries > 0
+                            else 0.0
+                        ),
+                    }
                 }
-            }
-        )
+            )
 
-        it.__preinc__()
-
-    # Create four histograms with alphanumeric bins
-    pass_hist = ROOT.TH1D("pass", "pass", len(cuts), 0, len(cuts))
-    pass_hist.SetCanExtend(ROOT.TH1.kAllAxes)
-    all_hist = ROOT.TH1D("all", "all", len(cuts), 0, len(cuts))
-    all_hist.SetCanExtend(ROOT.TH1.kAllAxes)
-    eff_hist = ROOT.TH1D("eff", "eff", len(cuts), 0, len(cuts))
-    eff_hist.SetCanExtend(ROOT.TH1.kAllAxes)
-    cumu_eff_hist = ROOT.TH1D("cumu_eff", "cumu_eff", len(cuts), 0, len(cuts))
-    cumu_eff_hist.SetCanExtend(ROOT.TH1.kAllAxes)
-
-    for _, cut in enumerate(cuts):
-        # print(i, cut)
-        for key, value in cut.items():
-            pass_hist.Fill(key, value["pass"])
-            all_hist.Fill(key, value["all"])
-            eff_hist.Fill(key, value["eff"])
-            cumu_eff_hist.Fill(key, value["cumulativeEff"])
-
-    pass_hist.SetError(np.zeros(len(cuts), dtype=np.float64))
-    all_hist.SetError(np.zeros(len(cuts), dtype=np.float64))
-    eff_hist.SetError(np.zeros(len(cuts), dtype=np.float64))
-    cumu_eff_hist.SetError(np.zeros(len(cuts), dtype=np.float64))
-
-    # Save the histograms to test.root
-    f = ROOT.TFile(output_path + ".root", "UPDATE")
-    pass_hist.Write()
-    all_hist.Write()
-    eff_hist.Write()
-    cumu_eff_hist.Write()
-    f.Close()
+            it.__preinc__()
+
+        # Create four histograms with alphanumeric bins
+        pass_hist = ROOT.TH1D("pass", "pass", len(cuts), 0, len(cuts))
+        pass_hist.SetCanExtend(ROOT.TH1.kAllAxes)
+        all_hist = ROOT.TH1D("all", "all", len(cuts), 0, len(cuts))
+        all_hist.SetCanExtend(ROOT.TH1.kAllAxes)
+        eff_hist = ROOT.TH1D("eff", "eff", len(cuts), 0, len(cuts))
+        eff_hist.SetCanExtend(ROOT.TH1.kAllAxes)
+        cumu_eff_hist = ROOT.TH1D("cumu_eff", "cumu_eff", len(cuts), 0, len(cuts))
+        cumu_eff_hist.SetCanExtend(ROOT.TH1.kAllAxes)
+
+        for _, cut in enumerate(cuts):
+            # print(i, cut)
+            for key, value in cut.items():
+                pass_hist.Fill(key, value["pass"])
+                all_hist.Fill(key, value["all"])
+                eff_hist.Fill(key, value["eff"])
+                cumu_eff_hist.Fill(key, value["cumulativeEff"])
+
+        pass_hist.SetError(np.zeros(len(cuts), dtype=np.float64))
+        all_hist.SetError(np.zeros(len(cuts), dtype=np.float64))
+        eff_hist.SetError(np.zeros(len(cuts), dtype=np.float64))
+        cumu_eff_hist.SetError(np.zeros(len(cuts), dtype=np.float64))
+
+        # Save the histograms to test.root
+        f = ROOT.TFile(output_path + ".root", "UPDATE")
+        pass_hist.Write()
+        all_hist.Write()
+        eff_hist.Write()
+        cumu_eff_hist.Write()
+        f.Close()
+    except BaseException:
+        if heartbeat is not None:
+            heartbeat.stop(status="failed")
+        raise
+
+    if heartbeat is not None:
+        heartbeat.stop(output=output_path + ".root")
@@ -0,0 +1,127 @@
+import time
+from typing import Callable, List
+
+import ROOT
+
+backends = ["local", "dask"]
+
+
+def add_backend_args(parser):
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="local",
+        choices=backends,
+        help="local: RDataFrame on a TChain \
+            (multithreaded with --nThreads). dask: distributed RDataFrame on a \
+            Dask cluster.",
+    )
+    parser.add_argument(
+        "--npartitions",
+        type=int,
+        help="Number of partitions the input \
+            is split into with the dask backend (default: chosen by ROOT)",
+    )
+    parser.add_argument(
+        "--dask_workers",
+        type=int,
+        default=4,
+        help="Number of worker processes of \
+            the local Dask cluster",
+    )
+    parser.add_argument(
+        "--dask_scheduler",
+        type=str,
+        help="Address of an existing Dask \
+            scheduler to connect to instead of starting a local cluster",
+    )
+
+
+def validate_backend_args(args):
+    if args.npartitions is not None and args.npartitions < 1:
+        raise ValueError("npartitions should be at least 1")
+    if args.dask_workers < 1:
+        raise ValueError("dask_workers should be at least 1")
+
+
+def dask_client(workers=4, scheduler=None):
+    """
+    Client of a Dask scheduler at the given address, or of a local cluster
+    with one single-threaded worker process per worker.
+    """
+    from dask.distributed import Client, LocalCluster
+
+    if scheduler is not None:
+        return Client(scheduler)
+    cluster = LocalCluster(
+        n_workers=workers, threads_per_worker=1, processes=True, memory_limit=0
+    )
+    return Client(cluster)
+
+
+def make_rdataframe(tree: str, files: List[str], args, client=None):
+    """
+    RDataFrame over the tree of the files on the backend selected by args.
+    Returns the RDataFrame and the TChain or Dask client it depends on, which
+    has to be kept alive until the event loop has run.
+    """
+    if getattr(args, "backend", "local") == "local":
+        chain = ROOT.TChain(tree)
+        for file in files:
+            chain.Add(file)
+        return ROOT.RDataFrame(chain), chain
+
+    if client is None:
+        client = dask_client(args.dask_workers, args.dask_scheduler)
+    RDataFrame = ROOT.RDF.Experimental.Distributed.Dask.RDataFrame
+    if args.npartitions:
+        rdf = RDataFrame(tree, files, npartitions=args.npartitions, daskclient=client)
+    else:
+        rdf = RDataFrame(tree, files, daskclient=client)
+    return rdf, client
+
+
+def close_backend(handle):
+    """
+    Shut down the Dask client (and its local cluster) returned by
+    make_rdataframe. Does nothing for the local backend.
+    """
+    if hasattr(handle, "cluster") and hasattr(handle, "close"):
+        cluster = handle.cluster
+        handle.close()
+        if cluster is not None:
+            cluster.close()
+
+
+def scaling_benchmark(
+    task: Callable, files: List[str], args, max_workers: int, logger
+) -> List[tuple]:
+    """
+    Run task(files, args, client) on local Dask clusters of 1, 2, 4, ...,
+    max_workers workers and log the time and speed-up of each. Returns a list
+    of (workers, seconds) pairs.
+    """
+    counts = []
+    n = 1
+    while n < max_workers:
+        counts.append(n)
+        n *= 2
+    counts.append(max_workers)
+
+    timings = []
+    for workers in counts:
+        client = dask_client(workers)
+        # Wait for the workers so that the startup is not timed
+        client.wait_for_workers(workers)
+        start = time.time()
+        task(files, args, client)
+        elapsed = time.time() - start
+        close_backend(client)
+        timings.append((workers, elapsed))
+        logger.info(
+            f"{workers} worker(s): {elapsed:.2f} s "
+            f"({len(files) / max(elapsed, 1e-9):.1f} files/s, "
+            f"speed-up {timings[0][1] / max(elapsed, 1e-9):.2f}x)"
+        )
+
+    return timings
@@ -0,0 +1,267 @@
+import hashlib
+import os
+import shutil
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import ROOT
+
+
+def add_cache_args(parser):
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        help="Directory for local copies of \
+            remote input files. Cached files are read instead of the remote \
+            ones on later runs.",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        default=100.0,
+        help="Size budget of the input file \
+            cache in GB. The least recently used files are evicted first.",
+    )
+    parser.add_argument(
+        "--prefetch_workers",
+        type=int,
+        default=4,
+        help="Number of input files copied \
+            to the cache in parallel",
+    )
+
+
+def validate_cache_args(args):
+    if args.cache_size <= 0:
+        raise ValueError("cache_size should be positive")
+    if args.prefetch_workers < 1:
+        raise ValueError("prefetch_workers should be at least 1")
+
+
+def is_remote(file):
+    return "://" in file and not file.startswith("file://")
+
+
+def file_size(file):
+    if not is_remote(file):
+        return os.path.getsize(file.removeprefix("file://"))
+    tfile = ROOT.TFile.Open(file)
+    if not tfile or tfile.IsZombie():
+        raise OSError(f"Could not open {file}")
+    size = tfile.GetSize()
+    tfile.Close()
+    return size
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def copy_file(src, dst):
+    if not is_remote(src):
+        shutil.copyfile(src.removeprefix("file://"), dst)
+    elif not ROOT.TFile.Cp(src, dst, False):
+        raise OSError(f"Could not copy {src}")
+
+
+class FileCache:
+    """
+    Local copies of input files in a directory with a size budget and least
+    recently used eviction. Files are copied by a background thread pool, so
+    later files are fetched while earlier ones are processed. The cache state
+    is the directory itself (modification time as last use), so processes
+    can share it: each process pins the files it uses with a
+    <file>.pin.<host>.<pid> marker, and pinned files are not evicted until
+    the process closes the cache or exits.
+    """
+
+    def __init__(self, cache_dir, max_bytes, workers=4, logger=None):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.logger = logger
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures: Dict[str, object] = {}
+        self.lock = threading.Lock()
+        self.pins = set()
+        self.reserved = 0
+        self.hits = 0
+        self.copied = 0
+        self.copied_bytes = 0
+
+        # Let the remote file opening and copying run outside of the GIL
+        ROOT.EnableThreadSafety()
+        ROOT.TFile.Open.__release_gil__ = True
+        ROOT.TFile.Cp.__release_gil__ = True
+
+    def local_path(self, file):
+        digest = hashlib.sha256(file.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{digest}_{os.path.basename(file)}")
+
+    def pin_path(self, path):
+        return f"{path}.pin.{socket.gethostname()}.{os.getpid()}"
+
+    def pin(self, path):
+        pin = self.pin_path(path)
+        open(pin, "a").close()
+        self.pins.add(pin)
+
+    def pinned_paths(self):
+        """
+        Cached files pinned by any process. Pins of exited processes on this
+        host are removed.
+        """
+        host = socket.gethostname()
+        pinned = set()
+        for entry in os.scandir(self.cache_dir):
+            path, sep, owner = entry.path.rpartition(".pin.")
+            if not sep:
+                continue
+            owner_host, _, pid = owner.rpartition(".")
+            if owner_host == host and pid.isdigit() and not process_alive(int(pid)):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+                continue
+            pinned.add(path)
+        return pinned
+
+    def cached_entries(self):
+        return [
+            entry
+            for entry in os.scandir(self.cache_dir)
+            if entry.is_file()
+            and not entry.name.endswith(".part")
+            and ".pin." not in entry.name
+        ]
+
+    def used_bytes(self):
+        return sum(entry.stat().st_size for entry in self.cached_entries())
+
+    def reserve(self, size):
+        """
+        Evict unpinned files, least recently used first, until size bytes
+        fit in the budget. Returns False if they do not fit.
+        """
+        if size > self.max_bytes:
+            return False
+        with self.lock:
+            pinned = self.pinned_paths()
+            entries = sorted(
+                (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                for entry in self.cached_entries()
+                if entry.path not in pinned
+            )
+            used = self.used_bytes() + self.reserved
+            for _, entry_size, path in entries:
+                if used + size <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                used -= entry_size
+            if used + size > self.max_bytes:
+                return False
+            self.reserved += size
+            return True
+
+    def fetch(self, file):
+        """
+        Path of the cached copy of file, copying it first if needed. Falls
+        back to the original path if the file can not be cached.
+        """
+        path = self.local_path(file)
+        if os.path.exists(path):
+            os.utime(path)
+            with self.lock:
+                self.hits += 1
+            return path
+
+        try:
+            size = file_size(file)
+        except OSError as e:
+            self.warn(f"Not caching {file}: {e}")
+            return file
+        if not self.reserve(size):
+            self.warn(f"Not caching {file}: it does not fit in the cache")
+            return file
+
+        part = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            copy_file(file, part)
+            os.replace(part, path)
+        except OSError as e:
+            self.warn(f"Not caching {file}: {e}")
+            if os.path.exists(part):
+                os.remove(part)
+            return file
+        finally:
+            with self.lock:
+                self.reserved -= size
+
+        with self.lock:
+            self.copied += 1
+            self.copied_bytes += size
+        return path
+
+    def prefetch(self, files: List[str]):
+        """
+        Start copying the files in the background, in the given order.
+        """
+        for file in files:
+            if file in self.futures:
+                continue
+            self.pin(self.local_path(file))
+            self.futures[file] = self.executor.submit(self.fetch, file)
+
+    def get(self, file):
+        """
+        Local path of file, waiting for its prefetch if it was started.
+        """
+        if file not in self.futures:
+            self.prefetch([file])
+        return self.futures[file].result()
+
+    def resolve(self, files: List[str]) -> List[str]:
+        self.prefetch(files)
+        return [self.get(file) for file in files]
+
+    def warn(self, message):
+        if self.logger is not None:
+            self.logger.warning(message)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for pin in self.pins:
+            try:
+                os.remove(pin)
+            except FileNotFoundError:
+                pass
+        self.pins.clear()
+        if self.logger is not None:
+            self.logger.info(
+                f"Input cache: {self.hits} hits, {self.copied} files copied "
+                f"({self.copied_bytes / 1e9:.2f} GB)"
+            )
+
+
+def open_cache(args, logger=None):
+    """
+    FileCache configured by the cache arguments, or None if no cache_dir is
+    set.
+    """
+    if not getattr(args, "cache_dir", None):
+        return None
+    return FileCache(
+        args.cache_dir, args.cache_size * 1e9, args.prefetch_workers, logger
+    )
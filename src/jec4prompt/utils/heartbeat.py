@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+
+def read_heartbeat(path) -> Optional[Dict]:
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return None
+
+
+def write_heartbeat(path, heartbeat: Dict):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(heartbeat, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+
+class Heartbeat:
+    """
+    Background thread writing the progress of a step to a .json file every
+    interval seconds: the events processed so far, the event rate over the
+    last interval and since the start, and the file being read.
+    """
+
+    def __init__(
+        self,
+        path,
+        files: List[str],
+        events: Callable[[], int],
+        current_file: Callable[[], str],
+        interval: float = 30.0,
+        step=None,
+    ):
+        self.path = path
+        self.files = files
+        self.events = events
+        self.current_file = current_file
+        self.interval = interval
+        self.step = step
+        self.start_time = time.time()
+        self.last = (self.start_time, 0)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def heartbeat(self, status="running", **extra):
+        now = time.time()
+        events = self.events()
+        last_time, last_events = self.last
+        self.last = (now, events)
+        elapsed = now - self.start_time
+        file = self.current_file()
+        heartbeat = {
+            "step": self.step,
+            "status": status,
+            "time": now,
+            "interval": self.interval,
+            "elapsed": elapsed,
+            "events": events,
+            "events_per_s": (events - last_events) / max(now - last_time, 1e-9),
+            "mean_events_per_s": events / max(elapsed, 1e-9),
+            "file": file,
+            "file_index": self.files.index(file) if file in self.files else None,
+            "files": self.files,
+        }
+        heartbeat.update(extra)
+        write_heartbeat(self.path, heartbeat)
+
+    def loop(self):
+        self.heartbeat()
+        while not self.stopped.wait(self.interval):
+            self.heartbeat()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self, status="done", **extra):
+        self.stopped.set()
+        self.thread.join()
+        self.heartbeat(status, **extra)
+
+
+def step_rate(heartbeat: Dict, now: float) -> float:
+    """
+    Current event rate of a step. Steps whose heartbeat has not been updated
+    for three intervals count as stalled.
+    """
+    if heartbeat["status"] != "running":
+        return heartbeat["mean_events_per_s"]
+    if now - heartbeat["time"] > 3 * heartbeat["interval"]:
+        return 0.0
+    return heartbeat["events_per_s"]
+
+
+def find_stragglers(
+    heartbeats: Dict[str, Dict], factor: float, grace: float, now=None
+) -> List[str]:
+    """
+    Steps running for longer than grace seconds with an event rate below
+    factor times the median rate of all steps with a heartbeat.
+    """
+    now = time.time() if now is None else now
+    rates = {step: step_rate(hb, now) for step, hb in heartbeats.items()}
+    if len(rates) < 3:
+        return []
+    ordered = sorted(rates.values())
+    median = ordered[len(ordered) // 2]
+    if len(ordered) % 2 == 0:
+        median = (median + ordered[len(ordered) // 2 - 1]) / 2
+
+    return [
+        step
+        for step, hb in heartbeats.items()
+        if hb["status"] == "running"
+        and hb["elapsed"] + now - hb["time"] > grace
+        and rates[step] < factor * median
+    ]
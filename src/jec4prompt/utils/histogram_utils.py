@@ -0,0 +1,111 @@
+import numpy as np
+import ROOT
+
+
+def th3_to_numpy(h, flow: bool = False):
+    """
+    Copy the bin contents and squared errors of a TH3 into numpy arrays indexed
+    as [x, y, z]. Under- and overflow bins are dropped unless flow is set.
+    """
+    nx, ny, nz = h.GetNbinsX(), h.GetNbinsY(), h.GetNbinsZ()
+    shape = (nz + 2, ny + 2, nx + 2)
+    n_cells = h.GetNcells()
+
+    values = np.frombuffer(h.GetArray(), dtype=np.float64, count=n_cells)
+    values = values.reshape(shape).transpose(2, 1, 0).copy()
+    if h.GetSumw2N() > 0:
+        variances = np.frombuffer(
+            h.GetSumw2().GetArray(), dtype=np.float64, count=n_cells
+        )
+        variances = variances.reshape(shape).transpose(2, 1, 0).copy()
+    else:
+        variances = values.copy()
+
+    if not flow:
+        values = values[1:-1, 1:-1, 1:-1]
+        variances = variances[1:-1, 1:-1, 1:-1]
+
+    return values, variances
+
+
+def th2_to_numpy(h, flow: bool = False):
+    """
+    Copy the bin contents and squared errors of a TH2 into numpy arrays indexed
+    as [x, y]. Under- and overflow bins are dropped unless flow is set.
+    """
+    nx, ny = h.GetNbinsX(), h.GetNbinsY()
+    shape = (ny + 2, nx + 2)
+    n_cells = h.GetNcells()
+
+    values = np.frombuffer(h.GetArray(), dtype=np.float64, count=n_cells)
+    values = values.reshape(shape).transpose(1, 0).copy()
+    if h.GetSumw2N() > 0:
+        variances = np.frombuffer(
+            h.GetSumw2().GetArray(), dtype=np.float64, count=n_cells
+        )
+        variances = variances.reshape(shape).transpose(1, 0).copy()
+    else:
+        variances = np.abs(values)
+
+    if not flow:
+        values = values[1:-1, 1:-1]
+        variances = variances[1:-1, 1:-1]
+
+    return values, variances
+
+
+def th2_from_numpy(name, title, x_edges, y_edges, values, errors=None):
+    """
+    Create a TH2D with the given edges and in-range bin contents (and errors)
+    indexed as [x, y].
+    """
+    h = ROOT.TH2D(
+        name,
+        title,
+        len(x_edges) - 1,
+        np.asarray(x_edges, dtype=float),
+        len(y_edges) - 1,
+        np.asarray(y_edges, dtype=float),
+    )
+    content = np.zeros((len(x_edges) + 1, len(y_edges) + 1))
+    content[1:-1, 1:-1] = values
+    h.SetContent(np.ascontiguousarray(content.T).ravel())
+    if errors is not None:
+        content[1:-1, 1:-1] = errors
+        h.SetError(np.ascontiguousarray(content.T).ravel())
+    return h
+
+
+def axis_centers(axis):
+    return np.array([axis.GetBinCenter(i) for i in range(1, axis.GetNbins() + 1)])
+
+
+def axis_edges(axis):
+    return np.array(
+        [axis.GetBinLowEdge(i) for i in range(1, axis.GetNbins() + 2)], dtype=float
+    )
+
+
+def profile_from_sums(
+    name, title, x_edges, sumw, sumwy, sumwy2, binsumw2, stats, entries
+):
+    """
+    Build a TProfile directly from its per-bin sums (arrays over the in-range
+    x bins, or over all bins including under- and overflow) and global
+    statistics (as in TH1::GetStats for a TProfile).
+    """
+    prof = ROOT.TProfile(
+        name, title, len(x_edges) - 1, np.asarray(x_edges, dtype=float)
+    )
+    prof.Sumw2()
+    contents = prof.GetSumw2()
+    weights = prof.GetBinSumw2()
+    first = 0 if len(sumw) == len(x_edges) + 1 else 1
+    for i in range(len(sumw)):
+        prof.SetBinEntries(i + first, sumw[i])
+        prof.SetBinContent(i + first, sumwy[i])
+        contents.SetAt(sumwy2[i], i + first)
+        weights.SetAt(binsumw2[i], i + first)
+    prof.PutStats(np.asarray(stats, dtype=np.float64))
+    prof.SetEntries(entries)
+    return prof
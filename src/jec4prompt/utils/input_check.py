@@ -0,0 +1,221 @@
+import fcntl
+import json
+import math
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Optional
+
+import ROOT
+
+
+def add_check_args(parser):
+    parser.add_argument(
+        "--check_inputs",
+        action="store_true",
+        help="Open all input files in parallel \
+            before processing and drop the ones that can not be read",
+    )
+    parser.add_argument(
+        "--check_timeout",
+        type=float,
+        default=60.0,
+        help="Seconds allowed for checking one \
+            input file. Also sets XRD_REQUESTTIMEOUT for the XRootD requests \
+            of the whole run.",
+    )
+    parser.add_argument(
+        "--check_workers",
+        type=int,
+        default=8,
+        help="Number of input files checked \
+            in parallel",
+    )
+    parser.add_argument(
+        "--blacklist",
+        type=str,
+        help="Path to a .json file of bad input \
+            files. Failed files are added to it and skipped on later runs.",
+    )
+    parser.add_argument(
+        "--retry_blacklisted",
+        action="store_true",
+        help="Check blacklisted files again \
+            instead of skipping them",
+    )
+
+
+def validate_check_args(args):
+    if args.check_timeout <= 0:
+        raise ValueError("check_timeout should be positive")
+    if args.check_workers < 1:
+        raise ValueError("check_workers should be at least 1")
+
+
+def check_file(file) -> Optional[str]:
+    """
+    Open a file and check that its Events and Runs trees exist and have
+    entries, and that the last event can be read. Returns the reason the
+    file is bad, or None if it is fine.
+    """
+    tfile = ROOT.TFile.Open(file)
+    if not tfile or tfile.IsZombie():
+        return "could not open the file"
+
+    reason = None
+    events = tfile.Get("Events")
+    runs = tfile.Get("Runs")
+    if not events:
+        reason = "no Events tree"
+    elif not runs:
+        reason = "no Runs tree"
+    elif events.GetEntries() == 0:
+        reason = "Events tree is empty"
+    elif runs.GetEntries() == 0:
+        reason = "Runs tree is empty"
+    else:
+        # Reading the last entry of one branch catches truncated files
+        events.SetBranchStatus("*", 0)
+        events.SetBranchStatus("run", 1)
+        if events.GetEntry(events.GetEntries() - 1) <= 0:
+            reason = "could not read the last event"
+    tfile.Close()
+
+    return reason
+
+
+def check_files(paths: Dict[str, str], timeout=60.0, workers=8) -> Dict[str, str]:
+    """
+    Check the files in parallel, each given by name and the path to open.
+    Returns the reasons of the files that failed or took longer than timeout
+    seconds.
+
+    Files are reported as timed out after timeout seconds, but their threads
+    can not be stopped: they run until XRootD gives up on the request, and
+    the interpreter waits for them at exit. XRD_REQUESTTIMEOUT is set to the
+    timeout so that this bound also holds for the XRootD requests; it takes
+    effect only if no remote file was opened before in the process.
+    """
+    os.environ["XRD_REQUESTTIMEOUT"] = str(max(1, math.ceil(timeout)))
+    ROOT.EnableThreadSafety()
+    for method in (ROOT.TFile.Open, ROOT.TTree.GetEntry, ROOT.TTree.GetEntries):
+        method.__release_gil__ = True
+
+    started = {}
+
+    def timed_check(file):
+        started[file] = time.time()
+        return check_file(paths[file])
+
+    bad = {}
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = {executor.submit(timed_check, file): file for file in paths}
+    pending = set(futures)
+    while len(pending) > 0:
+        done, pending = wait(pending, timeout=1)
+        for future in done:
+            try:
+                reason = future.result()
+            except Exception as e:
+                reason = f"error: {e}"
+            if reason is not None:
+                bad[futures[future]] = reason
+        now = time.time()
+        for future in list(pending):
+            file = futures[future]
+            if file in started and now - started[file] > timeout:
+                bad[file] = f"timed out after {timeout:g} s"
+                pending.remove(future)
+    # Do not wait for the timed out checks, they end with their XRootD request
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    return bad
+
+
+def read_blacklist(path) -> Dict[str, Dict]:
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_blacklist(path, blacklist: Dict[str, Dict]):
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(blacklist, f, indent=1)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def update_blacklist(path, failed: Dict[str, Dict], recovered: List[str]):
+    """
+    Add the failed files to the blacklist and remove the recovered ones. The
+    blacklist is re-read and written under a lock, so that concurrent steps
+    sharing it do not lose each other's entries.
+    """
+    with open(f"{path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            blacklist = read_blacklist(path)
+            blacklist.update(failed)
+            for file in recovered:
+                blacklist.pop(file, None)
+            write_blacklist(path, blacklist)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def check_inputs(files: List[str], paths: Dict[str, str], args, report_path, logger):
+    """
+    Drop blacklisted files and files failing check_file from the inputs,
+    add the failures to the blacklist and write a report of the dropped
+    files. Returns the files that passed.
+    """
+    blacklist = read_blacklist(args.blacklist)
+    skipped = {}
+    if not args.retry_blacklisted:
+        skipped = {file: blacklist[file] for file in files if file in blacklist}
+
+    start = time.time()
+    to_check = {file: paths[file] for file in files if file not in skipped}
+    failed = check_files(to_check, args.check_timeout, args.check_workers)
+    logger.info(
+        f"Checked {len(to_check)} input files in {time.time() - start:.1f} s, "
+        f"{len(failed)} failed, {len(skipped)} skipped as blacklisted"
+    )
+
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    for file, reason in failed.items():
+        logger.warning(f"Dropping {file}: {reason}")
+    if args.blacklist is not None:
+        recovered = []
+        if args.retry_blacklisted:
+            recovered = [
+                file for file in to_check if file in blacklist and file not in failed
+            ]
+        update_blacklist(
+            args.blacklist,
+            {file: {"reason": reason, "time": now} for file, reason in failed.items()},
+            recovered,
+        )
+
+    with open(report_path, "w") as f:
+        json.dump(
+            {
+                "checked": len(to_check),
+                "failed": failed,
+                "blacklisted": {file: skipped[file]["reason"] for file in skipped},
+            },
+            f,
+            indent=1,
+        )
+    logger.info(f"Input check report written to {report_path}")
+
+    return [file for file in files if file not in failed and file not in skipped]
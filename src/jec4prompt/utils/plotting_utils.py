@@ -0,0 +1,57 @@
+import configparser
+import json
+import os
+import pathlib
+
+manifest_name = "plot_manifest.json"
+
+
+def subfolder_name(file_name: str) -> str:
+    return file_name.split("/")[-1].replace(".root", "").replace(".", "_")
+
+
+def read_plot_config(file: str) -> configparser.ConfigParser:
+    """
+    Plot config with the option names lowercased, as read by both backends.
+    """
+    config = configparser.ConfigParser()
+    config.read(file)
+
+    return config
+
+
+def read_manifest(output_path):
+    path = os.path.join(output_path, manifest_name)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(output_path, manifest):
+    pathlib.Path(output_path).mkdir(exist_ok=True, parents=True)
+    path = os.path.join(output_path, manifest_name)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def plot_tasks(files, plots, workers, produce_all=False):
+    """
+    Split the plotting into (file, plot sections, produce all) tasks. When
+    there are fewer files than workers, the plot sections of each file are
+    divided into groups.
+    """
+    n_groups = max(1, min(len(plots), workers // max(len(files), 1)))
+    tasks = []
+    for file in files:
+        for i in range(n_groups):
+            tasks.append((file, plots[i::n_groups], produce_all and i == 0))
+    return tasks
+
+
+def config_items(config_section):
+    """
+    Normalized (sorted, stripped) items of a plot config section for hashing.
+    """
+    return sorted((k, v.strip()) for k, v in dict(config_section).items())
@@ -1,5 +1,6 @@
 import configparser
 import json
+import os
 import subprocess
 from typing import Dict, List
 
@@ -721,3 +722,27 @@ def read_trigger_config(config_file: str) -> Dict:
             triggers[section] = "(" + config[section]["filter"] + " && " + section + ")"
 
     return triggers
+
+
+def file_key(file: str) -> str:
+    """
+    Cache key of a file. Local files are identified by path, size and mtime,
+    remote files by their path only.
+    """
+    if os.path.exists(file):
+        stat = os.stat(file)
+        return f"{file}:{stat.st_size}:{stat.st_mtime_ns}"
+    return file
+
+
+def read_json_cache(path) -> Dict:
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json_cache(path, cache: Dict):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(cache, f, indent=1)
+    os.replace(f"{path}.tmp", path)
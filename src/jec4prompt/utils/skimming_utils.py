@@ -214,6 +214,197 @@ ROOT::VecOps::RVec<bool> get_veto( const ROOT::VecOps::RVec<float>& eta,
     return rdf
 
 
+def find_vetojets_bitmap(
+    rdf, bitmap_path, vtype="jetvetomap", vcols=("Jet_eta", "Jet_phi")
+):
+    """
+    Same as find_vetojets, but the veto map is memory-mapped from a bitmap
+    sidecar written by produce_vetomaps --export_correctionlib.
+    """
+    ROOT.gInterpreter.Declare(
+        """
+#ifndef VETO_BITMAP
+#define VETO_BITMAP
+
+#include <algorithm>
+#include <cstdint>
+#include <cstring>
+#include <fcntl.h>
+#include <stdexcept>
+#include <string>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+struct VetoBitmap {
+    const unsigned char* base = nullptr;
+    size_t size = 0;
+    int32_t n_eta = 0;
+    int32_t n_phi = 0;
+    const double* eta_edges = nullptr;
+    const double* phi_edges = nullptr;
+    const unsigned char* bits = nullptr;
+
+    void close() {
+        if (base != nullptr) munmap(const_cast<unsigned char*>(base), size);
+        base = nullptr;
+        size = 0;
+        n_eta = n_phi = 0;
+        eta_edges = phi_edges = nullptr;
+        bits = nullptr;
+    }
+
+    void open(const std::string& path, const std::string& type) {
+        // Drop the previous bitmap so that no stale map is used
+        close();
+        int fd = ::open(path.c_str(), O_RDONLY);
+        if (fd < 0) throw std::runtime_error("Cannot open veto map bitmap " + path);
+        struct stat st;
+        fstat(fd, &st);
+        size = st.st_size;
+        void* addr = mmap(nullptr, size, PROT_READ, MAP_PRIVATE, fd, 0);
+        ::close(fd);
+        if (addr == MAP_FAILED) throw std::runtime_error("Cannot mmap " + path);
+        base = static_cast<const unsigned char*>(addr);
+        if (std::memcmp(base, "J4PVMAP1", 8) != 0)
+            throw std::runtime_error(path + " is not a veto map bitmap");
+
+        int32_t header[4];
+        std::memcpy(header, base + 8, sizeof(header));
+        n_eta = header[0];
+        n_phi = header[1];
+        eta_edges = reinterpret_cast<const double*>(base + 24);
+        phi_edges = eta_edges + n_eta + 1;
+
+        const char* names = reinterpret_cast<const char*>(phi_edges + n_phi + 1);
+        const unsigned char* maps = reinterpret_cast<const unsigned char*>(names + 32 * header[2]);
+        size_t map_bytes = (size_t(n_eta) * n_phi + 7) / 8;
+        for (int i = 0; i < header[2]; i++) {
+            if (type == std::string(names + 32 * i, strnlen(names + 32 * i, 32))) {
+                bits = maps + i * map_bytes;
+            }
+        }
+        if (bits == nullptr) throw std::runtime_error("No veto map " + type + " in " + path);
+    }
+
+    static int find_bin(const double* edges, int n, double x) {
+        int bin = std::upper_bound(edges, edges + n + 1, x) - edges - 1;
+        return std::min(std::max(bin, 0), n - 1);
+    }
+
+    bool vetoed(float eta, float phi) const {
+        size_t idx = size_t(find_bin(eta_edges, n_eta, eta)) * n_phi + find_bin(phi_edges, n_phi, phi);
+        return (bits[idx >> 3] >> (7 - (idx & 7))) & 1;
+    }
+};
+
+VetoBitmap veto_bitmap;
+
+ROOT::VecOps::RVec<bool> get_veto_bitmap( const ROOT::VecOps::RVec<float>& eta,
+                                          const ROOT::VecOps::RVec<float>& phi) {
+    ROOT::VecOps::RVec<bool> veto_flags;
+
+    for (size_t i = 0; i < eta.size(); i++) {
+        if (abs(eta[i]) > 5.131 || abs(phi[i]) > 3.14159) {
+            veto_flags.push_back(true);
+            continue;
+        }
+        veto_flags.push_back(veto_bitmap.vetoed(eta[i], phi[i]));
+    }
+
+    return veto_flags;
+}
+#endif
+"""
+    )
+    ROOT.veto_bitmap.open(bitmap_path, vtype)
+
+    rdf = rdf.Define("Jet_vetoed", f"get_veto_bitmap({','.join(vcols)})")
+
+    return rdf
+
+
+def count_events(rdf):
+    """
+    Count the events read by the event loop and track the file being read,
+    for the heartbeats of a step. Returns the RDataFrame and functions giving
+    the current count and file.
+    """
+    ROOT.gInterpreter.Declare(
+        """
+#ifndef J4P_HEARTBEAT
+#define J4P_HEARTBEAT
+
+#include <atomic>
+#include <mutex>
+#include <string>
+
+namespace j4p_heartbeat {
+std::atomic<unsigned long long> n_events{0};
+std::mutex file_mutex;
+std::string file;
+
+int set_file(const ROOT::RDF::RSampleInfo& info) {
+    std::lock_guard<std::mutex> lock(file_mutex);
+    file = info.AsString();
+    return 0;
+}
+
+bool count(int) {
+    n_events.fetch_add(1, std::memory_order_relaxed);
+    return true;
+}
+
+unsigned long long events() { return n_events.load(std::memory_order_relaxed); }
+
+std::string current_file() {
+    std::lock_guard<std::mutex> lock(file_mutex);
+    return file;
+}
+}
+#endif
+"""
+    )
+
+    rdf = rdf.DefinePerSample(
+        "heartbeat_sample_temp", "j4p_heartbeat::set_file(rdfsampleinfo_)"
+    ).Filter("j4p_heartbeat::count(heartbeat_sample_temp)")
+
+    def events():
+        return int(ROOT.j4p_heartbeat.events())
+
+    def current_file():
+        # RSampleInfo::AsString gives file/tree
+        return str(ROOT.j4p_heartbeat.current_file()).rsplit("/", 1)[0]
+
+    return rdf, events, current_file
+
+
+def entry_list(chain, ranges):
+    """
+    Entry list selecting the given lists of (first, last) entry ranges of
+    the files of a chain, and all entries of the other files.
+    """
+    n_entries = chain.GetEntries()
+    offsets = [chain.GetTreeOffset()[i] for i in range(chain.GetNtrees())]
+    offsets.append(n_entries)
+
+    elist = ROOT.TEntryList("step_entries", "step_entries")
+    for i, element in enumerate(chain.GetListOfFiles()):
+        file_name = element.GetTitle()
+        file_ranges = ranges.get(file_name, [(0, offsets[i + 1] - offsets[i])])
+        sublist = ROOT.TEntryList("", "", element.GetName(), file_name)
+        for first, last in file_ranges:
+            if hasattr(sublist, "EnterRange"):
+                sublist.EnterRange(first, last)
+            else:
+                for entry in range(first, last):
+                    sublist.Enter(entry)
+        elist.Add(sublist)
+
+    return elist
+
+
 def filter_json(rdf, filter_json, logger):
     ROOT.gInterpreter.Declare(
         """
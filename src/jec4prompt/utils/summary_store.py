@@ -0,0 +1,400 @@
+import os
+import sqlite3
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+import ROOT
+
+schema = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime INTEGER,
+    lumi REAL
+);
+CREATE TABLE IF NOT EXISTS file_lumisections (
+    file TEXT,
+    run INTEGER,
+    luminosityBlock INTEGER,
+    ls_block INTEGER,
+    PRIMARY KEY (file, run, luminosityBlock)
+);
+CREATE TABLE IF NOT EXISTS file_summaries (
+    file TEXT,
+    run INTEGER,
+    ls_block INTEGER,
+    trigger TEXT,
+    observable TEXT,
+    sumw REAL,
+    sumw2 REAL,
+    sumwy REAL,
+    sumwy2 REAL,
+    entries INTEGER,
+    PRIMARY KEY (file, run, ls_block, trigger, observable)
+);
+CREATE TABLE IF NOT EXISTS csv_runs (
+    run INTEGER PRIMARY KEY,
+    lumi REAL
+);
+CREATE VIEW IF NOT EXISTS lumisections AS
+SELECT DISTINCT run, luminosityBlock, ls_block FROM file_lumisections;
+CREATE VIEW IF NOT EXISTS summaries AS
+SELECT run, ls_block, trigger, observable, SUM(sumw) AS sumw, SUM(sumw2) AS sumw2,
+    SUM(sumwy) AS sumwy, SUM(sumwy2) AS sumwy2, SUM(entries) AS entries
+FROM file_summaries GROUP BY run, ls_block, trigger, observable;
+CREATE VIEW IF NOT EXISTS runs AS
+SELECT r.run, COALESCE(c.lumi, r.lumi) AS lumi, c.lumi IS NOT NULL AS from_csv
+FROM (
+    SELECT l.run, SUM(f.lumi * l.n_ls / t.n_ls) AS lumi
+    FROM (SELECT file, run, COUNT(*) AS n_ls FROM file_lumisections
+        GROUP BY file, run) AS l
+    JOIN (SELECT file, COUNT(*) AS n_ls FROM file_lumisections GROUP BY file) AS t
+        ON t.file = l.file
+    JOIN files AS f ON f.path = l.file
+    GROUP BY l.run
+) AS r
+LEFT JOIN csv_runs AS c ON c.run = r.run;
+"""
+
+all_triggers = "all"
+
+summary_code = """
+#ifndef J4P_SUMMARY
+#define J4P_SUMMARY
+
+#include <map>
+#include <set>
+#include <utility>
+#include <vector>
+
+namespace j4p_summary {
+struct Row {
+    long long run;
+    long long ls;
+    double w;
+    ROOT::RVec<bool> triggers;
+    ROOT::RVec<double> y;
+    ROOT::RVec<bool> cuts;
+};
+
+// sumw, sumw2, sumwy, sumwy2 and entries per (trigger, observable) for each
+// (run, ls block), and the lumisections seen
+struct Sums {
+    int ls_block_size = 0;
+    std::map<std::pair<long long, long long>, std::vector<double>> blocks;
+    std::set<std::pair<long long, long long>> lumisections;
+};
+
+Row make_row(long long run, long long ls, double w, ROOT::RVec<bool> triggers,
+             ROOT::RVec<double> y, ROOT::RVec<bool> cuts) {
+    return Row{run, ls, w, std::move(triggers), std::move(y), std::move(cuts)};
+}
+
+void aggregate(Sums& sums, const Row& row) {
+    sums.lumisections.emplace(row.run, row.ls);
+    long long block = sums.ls_block_size > 0 ? row.ls / sums.ls_block_size : 0;
+    auto& s = sums.blocks[{row.run, block}];
+    const size_t n_obs = row.y.size();
+    if (s.empty()) s.assign(5 * row.triggers.size() * n_obs, 0.0);
+    for (size_t j = 0; j < row.triggers.size(); j++) {
+        if (!row.triggers[j]) continue;
+        for (size_t k = 0; k < n_obs; k++) {
+            if (!row.cuts[k]) continue;
+            double* v = &s[5 * (j * n_obs + k)];
+            v[0] += row.w;
+            v[1] += row.w * row.w;
+            v[2] += row.w * row.y[k];
+            v[3] += row.w * row.y[k] * row.y[k];
+            v[4] += 1;
+        }
+    }
+}
+
+void merge(std::vector<Sums>& all) {
+    auto& out = all[0];
+    for (size_t i = 1; i < all.size(); i++) {
+        out.lumisections.insert(all[i].lumisections.begin(), all[i].lumisections.end());
+        for (const auto& [key, v] : all[i].blocks) {
+            auto& s = out.blocks[key];
+            if (s.empty()) {
+                s = v;
+            } else {
+                for (size_t n = 0; n < v.size(); n++) s[n] += v[n];
+            }
+        }
+    }
+}
+
+ROOT::RDF::RResultPtr<Sums> book(ROOT::RDF::RNode rdf, int ls_block_size) {
+    Sums identity;
+    identity.ls_block_size = ls_block_size;
+    return rdf.Aggregate(aggregate, merge, "summary_row_temp", identity);
+}
+
+// One row of run, block and the sums per block
+std::vector<double> flatten_blocks(const Sums& sums) {
+    std::vector<double> out;
+    for (const auto& [key, v] : sums.blocks) {
+        out.push_back(key.first);
+        out.push_back(key.second);
+        out.insert(out.end(), v.begin(), v.end());
+    }
+    return out;
+}
+
+std::vector<long long> flatten_lumisections(const Sums& sums) {
+    std::vector<long long> out;
+    for (const auto& [run, ls] : sums.lumisections) {
+        out.push_back(run);
+        out.push_back(ls);
+    }
+    return out;
+}
+}
+#endif
+"""
+
+
+def open_store(path):
+    store = sqlite3.connect(path)
+    store.executescript(schema)
+    return store
+
+
+def set_ls_block(store, ls_block_size):
+    """
+    Record the lumisection block size of the store, or check that it matches
+    the one the store was built with. Blocks of different sizes can not be
+    merged, so appending with another size is an error.
+    """
+    row = store.execute("SELECT value FROM meta WHERE key = 'ls_block'").fetchone()
+    if row is None:
+        with store:
+            store.execute(
+                "INSERT INTO meta VALUES ('ls_block', ?)", (str(ls_block_size),)
+            )
+    elif int(row[0]) != ls_block_size:
+        raise ValueError(
+            f"The summary store was built with --ls_block {row[0]}, "
+            f"can not add files with --ls_block {ls_block_size}"
+        )
+
+
+def file_in_store(store, file):
+    if not os.path.exists(file):
+        row = store.execute("SELECT 1 FROM files WHERE path = ?", (file,)).fetchone()
+        return row is not None
+    stat = os.stat(file)
+    row = store.execute(
+        "SELECT 1 FROM files WHERE path = ? AND size = ? AND mtime = ?",
+        (file, stat.st_size, stat.st_mtime_ns),
+    ).fetchone()
+    return row is not None
+
+
+def summary_selections(hist_config, triggers):
+    """
+    Trigger selections (their OR first) and Profile1D observables summarized
+    for the store.
+    """
+    selections = {all_triggers: " || ".join(triggers) if len(triggers) > 0 else "1"}
+    for trigger in triggers:
+        selections[trigger] = triggers[trigger]
+    observables = {
+        hist: hist_config[hist]
+        for hist in hist_config
+        if hist_config[hist]["type"] != "Histo1D"
+    }
+    return selections, observables
+
+
+def book_summary(rdf, hist_config, triggers, ls_block_size=0):
+    """
+    Book the weighted sums of every Profile1D observable in hist_config per
+    run and lumisection block, for each trigger and for the OR of all
+    triggers, and the luminosity of the file. The sums are aggregated in the
+    event loop, so memory scales with the number of blocks, not of events.
+    """
+    ROOT.gInterpreter.Declare(summary_code)
+    selections, observables = summary_selections(hist_config, triggers)
+
+    trg_columns, y_columns, cut_columns = [], [], []
+    for j, selection in enumerate(selections.values()):
+        rdf = rdf.Define(f"summary_trg{j}_temp", f"(bool)({selection})")
+        trg_columns.append(f"summary_trg{j}_temp")
+    for k, hist in enumerate(observables):
+        cut = observables[hist].get("cut") or "1"
+        rdf = rdf.Define(
+            f"summary_y{k}_temp", f"(double)({observables[hist]['y_val']})"
+        )
+        rdf = rdf.Define(f"summary_cut{k}_temp", f"(bool)({cut})")
+        y_columns.append(f"summary_y{k}_temp")
+        cut_columns.append(f"summary_cut{k}_temp")
+
+    rdf = rdf.Define(
+        "summary_row_temp",
+        "j4p_summary::make_row(run, luminosityBlock, weight, "
+        f"ROOT::RVec<bool>{{{', '.join(trg_columns)}}}, "
+        f"ROOT::RVec<double>{{{', '.join(y_columns)}}}, "
+        f"ROOT::RVec<bool>{{{', '.join(cut_columns)}}})",
+    )
+
+    return {
+        "summary": ROOT.j4p_summary.book(ROOT.RDF.AsRNode(rdf), ls_block_size),
+        "int_lumi": rdf.Mean("int_lumi"),
+    }
+
+
+def vector_to_numpy(vec, dtype):
+    if vec.size() == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.frombuffer(vec.data(), dtype=dtype, count=vec.size()).copy()
+
+
+def read_summary(booked, hist_config, triggers, ls_block_size=0):
+    """
+    Read the results of book_summary after the event loop. Returns the
+    summary rows, the lumisections seen and the file luminosity.
+    """
+    selections, observables = summary_selections(hist_config, triggers)
+    sums = booked["summary"].GetValue()
+
+    width = 2 + 5 * len(selections) * len(observables)
+    blocks = vector_to_numpy(ROOT.j4p_summary.flatten_blocks(sums), np.float64).reshape(
+        -1, width
+    )
+    values = blocks[:, 2:].reshape(-1, len(selections), len(observables), 5)
+
+    names = (list(selections), list(observables))
+    summaries = [
+        (
+            int(blocks[i, 0]),
+            int(blocks[i, 1]),
+            names[0][j],
+            names[1][k],
+            *(float(v) for v in values[i, j, k, :4]),
+            int(values[i, j, k, 4]),
+        )
+        for i, j, k in zip(*np.nonzero(values[..., 4] > 0))
+    ]
+
+    ls = vector_to_numpy(ROOT.j4p_summary.flatten_lumisections(sums), np.int64).reshape(
+        -1, 2
+    )
+    ls_block = ls[:, 1] // ls_block_size if ls_block_size > 0 else 0 * ls[:, 1]
+    lumisections = np.column_stack([ls, ls_block]).tolist()
+
+    return summaries, lumisections, float(booked["int_lumi"].GetValue())
+
+
+def add_file(store, file, summaries, lumisections, int_lumi):
+    """
+    Replace the contribution of a skim file to the store. The rows of each
+    file are kept apart, so a changed file does not count twice; the per-run
+    totals are views summing over the files.
+    """
+    if os.path.exists(file):
+        stat = os.stat(file)
+        size, mtime = stat.st_size, stat.st_mtime_ns
+    else:
+        size, mtime = None, None
+
+    with store:
+        store.execute("DELETE FROM file_summaries WHERE file = ?", (file,))
+        store.execute("DELETE FROM file_lumisections WHERE file = ?", (file,))
+        store.executemany(
+            "INSERT INTO file_summaries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(file, *row) for row in summaries],
+        )
+        store.executemany(
+            "INSERT INTO file_lumisections VALUES (?, ?, ?, ?)",
+            [(file, *ls) for ls in lumisections],
+        )
+        store.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+            (file, size, mtime, int_lumi),
+        )
+
+
+def add_lumi_csv(store, path):
+    """
+    Set the run luminosities from a brilcalc lumi csv (as written by skim).
+    """
+    df = pd.read_csv(
+        path,
+        comment="#",
+        names=[
+            "run:fill",
+            "time",
+            "nls",
+            "ncms",
+            "delivered(/fb)",
+            "recorded(/fb)",
+        ],
+    )
+    runs = df["run:fill"].str.split(":").str[0].astype(int)
+    with store:
+        store.executemany(
+            "INSERT OR REPLACE INTO csv_runs VALUES (?, ?)",
+            zip(runs.tolist(), df["recorded(/fb)"].astype(float).tolist()),
+        )
+
+
+blocks_query = """
+SELECT b.run, b.ls_block, r.lumi * b.n_ls / t.n_ls AS lumi
+FROM (SELECT run, ls_block, COUNT(*) AS n_ls FROM lumisections
+    GROUP BY run, ls_block) AS b
+JOIN runs AS r ON r.run = b.run
+JOIN (SELECT run, COUNT(*) AS n_ls FROM lumisections GROUP BY run) AS t
+    ON t.run = b.run
+"""
+
+
+def read_blocks(store) -> Dict[str, np.ndarray]:
+    """
+    Read the runs and lumisection blocks in the store ordered by run and
+    block. The luminosity of a run is shared between its blocks in proportion
+    to the number of lumisections in each block.
+    """
+    rows = store.execute(f"{blocks_query} ORDER BY b.run, b.ls_block").fetchall()
+    values = np.array(rows, dtype=np.float64).reshape(-1, 3)
+    return {"run": values[:, 0], "ls_block": values[:, 1], "lumi": values[:, 2]}
+
+
+def read_summaries(store, observable, trigger=all_triggers) -> Dict[str, np.ndarray]:
+    """
+    Read the summaries of an observable aligned with read_blocks, with zeros
+    for blocks without entries.
+    """
+    rows = store.execute(
+        f"""
+        SELECT COALESCE(s.sumw, 0), COALESCE(s.sumw2, 0), COALESCE(s.sumwy, 0),
+            COALESCE(s.sumwy2, 0), COALESCE(s.entries, 0)
+        FROM ({blocks_query}) AS b
+        LEFT JOIN summaries AS s
+            ON s.run = b.run AND s.ls_block = b.ls_block
+            AND s.observable = ? AND s.trigger = ?
+        ORDER BY b.run, b.ls_block
+        """,
+        (observable, trigger),
+    ).fetchall()
+    fields = ["sumw", "sumw2", "sumwy", "sumwy2", "entries"]
+    values = np.array(rows, dtype=np.float64).reshape(-1, len(fields))
+    return {field: values[:, i] for i, field in enumerate(fields)}
+
+
+def mean_and_error(sumw, sumw2, sumwy, sumwy2):
+    """
+    Weighted mean and its error as in TStatistic::GetMean and GetMeanErr.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(sumw != 0, sumwy / sumw, 0.0)
+        var = np.where(sumw != 0, sumwy2 / sumw - mean * mean, 0.0)
+        neff = np.where(sumw2 != 0, sumw * sumw / sumw2, 0.0)
+        error = np.where(neff > 0, np.sqrt(np.clip(var, 0, None) / neff), 0.0)
+    return mean, error
@@ -0,0 +1,289 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import textwrap
+from types import SimpleNamespace
+
+import pytest
+from jec4prompt import batch
+from jec4prompt.utils.heartbeat import find_stragglers, step_rate
+
+
+def make_heartbeat(status="running", rate=100.0, time=1000.0, elapsed=600.0):
+    return {
+        "status": status,
+        "time": time,
+        "interval": 30.0,
+        "elapsed": elapsed,
+        "events_per_s": rate,
+        "mean_events_per_s": 2 * rate,
+    }
+
+
+def parse_batch_args(argv):
+    parser = argparse.ArgumentParser()
+    batch.add_batch_parser(parser.add_subparsers(dest="subparser_name"))
+    args = parser.parse_args(["batch", *argv])
+    batch.validate_args(args)
+    return args
+
+
+def test_step_rate():
+    assert step_rate(make_heartbeat(), now=1010.0) == 100.0
+    # Finished steps count with their mean rate
+    assert step_rate(make_heartbeat("done"), now=5000.0) == 200.0
+    # No heartbeat for more than three intervals
+    assert step_rate(make_heartbeat(), now=1091.0) == 0.0
+
+
+def test_find_stragglers():
+    heartbeats = {
+        "0": make_heartbeat(rate=100.0),
+        "1": make_heartbeat(rate=90.0),
+        "2": make_heartbeat(rate=10.0),
+        "3": make_heartbeat(rate=5.0, elapsed=10.0),
+        "4": make_heartbeat("done", rate=50.0),
+    }
+    # Median of 5, 10, 90, 100 and 100 is 90; step 3 is within its grace
+    assert find_stragglers(heartbeats, 0.5, 300.0, now=1000.0) == ["2"]
+    assert find_stragglers(heartbeats, 0.05, 300.0, now=1000.0) == []
+    # Stalled steps are stragglers too, and lower the median to 10
+    heartbeats["1"]["time"] = 800.0
+    assert find_stragglers(heartbeats, 0.5, 300.0, now=1000.0) == ["1"]
+    # Too few steps for a median
+    assert find_stragglers(dict(list(heartbeats.items())[:2]), 0.5, 0.0, 1000.0) == []
+
+
+def test_strip_inputs():
+    command = ["skim", "--filepaths", "a.txt", "--out", "out", "--filelist=x,y"]
+    assert batch.strip_inputs(command) == ["skim", "--out", "out"]
+    assert batch.strip_inputs(["skim", "-fp", "a.txt", "--is_local"]) == [
+        "skim",
+        "--is_local",
+    ]
+
+
+def test_resplit_commands(tmp_path):
+    args = parse_batch_args(
+        [
+            "--nsteps",
+            "4",
+            "--heartbeat_dir",
+            str(tmp_path / "heartbeats"),
+            "--straggler_factor",
+            "0.2",
+            "--resplit",
+            "3",
+            "--log_dir",
+            str(tmp_path / "logs"),
+            "--",
+            "skim",
+            "--filelist",
+            "a.root,b.root",
+            "--out",
+            "out",
+        ]
+    )
+    commands = batch.resplit_commands(args, "2", ["a.root", "b.root"])
+
+    # Not more steps than files
+    assert list(commands) == ["2.0", "2.1"]
+    filepaths = str(tmp_path / "logs" / "step_2_files.txt")
+    with open(filepaths) as f:
+        assert f.read().split() == ["a.root", "b.root"]
+    for i, command in enumerate(commands.values()):
+        assert command[:3] == [sys.executable, "-m", "jec4prompt.main"]
+        assert command[3:] == [
+            "skim",
+            "--out",
+            "out",
+            "--filepaths",
+            filepaths,
+            "--out",
+            os.path.join("out", "resplit_2"),
+            "--nsteps",
+            "2",
+            "--step",
+            str(i),
+        ]
+
+
+# Stand-in for the skim command: reads files at 1000 events/s, except for the
+# files named slow*.root outside of resplit steps, which take 30 s at 1 event/s
+stand_in_main = """
+import argparse
+import json
+import os
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument("command")
+parser.add_argument("--filepaths")
+parser.add_argument("--out")
+parser.add_argument("--nsteps", type=int)
+parser.add_argument("--step", type=int)
+parser.add_argument("--heartbeat")
+args = parser.parse_args()
+
+with open(args.filepaths) as f:
+    files = f.read().split()[args.step :: args.nsteps]
+resplit = os.path.basename(args.out).startswith("resplit_")
+start = time.time()
+events = 0
+
+
+def heartbeat(status, file, rate, **extra):
+    now = time.time()
+    heartbeat = {
+        "step": args.step,
+        "status": status,
+        "time": now,
+        "interval": 0.1,
+        "elapsed": now - start,
+        "events": events,
+        "events_per_s": rate,
+        "mean_events_per_s": events / max(now - start, 1e-9),
+        "file": file,
+        "files": files,
+        **extra,
+    }
+    with open(args.heartbeat + ".tmp", "w") as f:
+        json.dump(heartbeat, f)
+    os.replace(args.heartbeat + ".tmp", args.heartbeat)
+
+
+for file in files:
+    slow = os.path.basename(file).startswith("slow") and not resplit
+    for _ in range(300 if slow else 3):
+        heartbeat("running", file, 1.0 if slow else 1000.0)
+        time.sleep(0.1)
+        events += 1 if slow else 100
+
+os.makedirs(args.out, exist_ok=True)
+output = os.path.join(args.out, f"step_{args.step}.txt")
+with open(output, "w") as f:
+    f.write("\\n".join(files) + "\\n")
+heartbeat("done", "", 1000.0, output=output)
+"""
+
+
+def test_batch_resplits_slow_step(tmp_path, monkeypatch):
+    stand_in = tmp_path / "stand_in" / "jec4prompt"
+    stand_in.mkdir(parents=True)
+    (stand_in / "__init__.py").write_text("")
+    (stand_in / "main.py").write_text(textwrap.dedent(stand_in_main))
+    monkeypatch.setenv("PYTHONPATH", str(tmp_path / "stand_in"))
+
+    files = [str(tmp_path / f"file{i}.root") for i in range(6)]
+    files[3] = str(tmp_path / "slow.root")
+    (tmp_path / "files.txt").write_text("\n".join(files) + "\n")
+
+    merged = []
+    monkeypatch.setattr(
+        batch.subprocess, "run", lambda command, check: merged.extend(command[3:])
+    )
+
+    out = str(tmp_path / "out")
+    args = parse_batch_args(
+        [
+            "--nsteps",
+            "3",
+            "--concurrency",
+            "3",
+            "--heartbeat_dir",
+            str(tmp_path / "heartbeats"),
+            "--straggler_factor",
+            "0.5",
+            "--straggler_grace",
+            "0",
+            "--log_dir",
+            str(tmp_path / "logs"),
+            "--state_file",
+            str(tmp_path / "batch_state.json"),
+            "--merge",
+            str(tmp_path / "merged.root"),
+            "--",
+            "skim",
+            "--filepaths",
+            str(tmp_path / "files.txt"),
+            "--out",
+            out,
+        ]
+    )
+    batch.run(SimpleNamespace(args=args, logger=logging.getLogger("test_batch")))
+
+    with open(tmp_path / "batch_state.json") as f:
+        batch_state = json.load(f)
+    statuses = {job: job_state["status"] for job, job_state in batch_state.items()}
+    assert statuses == {
+        "0": "resplit",
+        "1": "done",
+        "2": "done",
+        "0.0": "done",
+        "0.1": "done",
+    }
+
+    # Every file ends up in exactly one merged output
+    processed = []
+    for output in merged:
+        with open(output) as f:
+            processed.extend(f.read().split())
+    assert sorted(processed) == sorted(files)
+    assert sum("resplit_0" in output for output in merged) == 2
+
+
+@pytest.mark.parametrize("heartbeat", [False, True])
+def test_stopped_step_without_heartbeat(tmp_path, monkeypatch, heartbeat):
+    args = parse_batch_args(
+        [
+            "--nsteps",
+            "1",
+            "--heartbeat_dir",
+            str(tmp_path / "heartbeats"),
+            "--straggler_factor",
+            "0.5",
+            "--log_dir",
+            str(tmp_path / "logs"),
+            "--state_file",
+            str(tmp_path / "batch_state.json"),
+            "--retries",
+            "0",
+            "--",
+            "skim",
+            "--filelist",
+            "a.root,b.root",
+            "--out",
+            "out",
+        ]
+    )
+
+    submitted = []
+
+    def fake_run_step(args, job, command, processes, stopped):
+        submitted.append(job)
+        if "." in job:
+            return job, 0, 1, 1.0
+        # Stopped as a straggler, with or without a heartbeat written
+        stopped.add(job)
+        if heartbeat:
+            os.makedirs(args.heartbeat_dir, exist_ok=True)
+            with open(batch.heartbeat_path(args, job), "w") as f:
+                json.dump({**make_heartbeat(), "files": ["a.root", "b.root"]}, f)
+        return job, -15, 1, 1.0
+
+    monkeypatch.setattr(batch, "run_step", fake_run_step)
+    monkeypatch.setattr(
+        batch,
+        "resplit_commands",
+        lambda args, job, files: {f"{job}.0": ["resplit", *files]},
+    )
+    state = SimpleNamespace(args=args, logger=logging.getLogger("test_batch"))
+    if heartbeat:
+        batch.run(state)
+        assert submitted == ["0", "0.0"]
+    else:
+        with pytest.raises(RuntimeError, match=r"Steps \['0'\] failed"):
+            batch.run(state)
+        assert submitted == ["0"]
@@ -0,0 +1,107 @@
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+from jec4prompt.utils import file_cache
+from jec4prompt.utils.file_cache import FileCache
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    """
+    Three 100 byte input files as file:// paths.
+    """
+    os.makedirs(tmp_path / "inputs")
+    files = {}
+    for name in ("a", "b", "c"):
+        path = tmp_path / "inputs" / f"{name}.root"
+        path.write_bytes(name.encode() * 100)
+        files[name] = f"file://{path}"
+    return files
+
+
+def cached_names(cache):
+    return sorted(entry.name.split("_", 1)[1] for entry in cache.cached_entries())
+
+
+def test_copy_and_hit(tmp_path, inputs):
+    cache = FileCache(str(tmp_path / "cache"), 1000)
+    path = cache.get(inputs["a"])
+    cache.close()
+    assert path == cache.local_path(inputs["a"])
+    with open(path, "rb") as f:
+        assert f.read() == b"a" * 100
+    assert (cache.copied, cache.copied_bytes, cache.hits) == (1, 100, 0)
+
+    cache = FileCache(str(tmp_path / "cache"), 1000)
+    assert cache.resolve([inputs["a"]]) == [path]
+    cache.close()
+    assert (cache.copied, cache.hits) == (0, 1)
+    # Pins are removed on close
+    assert sorted(os.listdir(tmp_path / "cache")) == [os.path.basename(path)]
+
+
+def test_lru_eviction(tmp_path, inputs):
+    cache_dir = str(tmp_path / "cache")
+    for name in ("a", "b"):
+        cache = FileCache(cache_dir, 250)
+        cache.get(inputs[name])
+        cache.close()
+    # b was used last, then a is used again
+    os.utime(FileCache(cache_dir, 250).local_path(inputs["a"]), (2e9, 2e9))
+
+    cache = FileCache(cache_dir, 250)
+    cache.get(inputs["c"])
+    cache.close()
+    assert cached_names(cache) == ["a.root", "c.root"]
+    assert cache.used_bytes() == 200
+
+
+def test_pinned_files_are_not_evicted(tmp_path, inputs):
+    cache_dir = str(tmp_path / "cache")
+    first = FileCache(cache_dir, 250)
+    first.resolve([inputs["a"], inputs["b"]])
+
+    # The files of a running process stay cached, so c does not fit
+    second = FileCache(cache_dir, 250)
+    assert second.get(inputs["c"]) == inputs["c"]
+    second.close()
+    assert cached_names(second) == ["a.root", "b.root"]
+
+    # Pins of processes that exited are ignored and removed
+    first.close()
+    os.utime(first.local_path(inputs["a"]), (1e9, 1e9))
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    pin = f"{first.local_path(inputs['a'])}.pin.{socket.gethostname()}.{exited.pid}"
+    open(pin, "a").close()
+
+    third = FileCache(cache_dir, 250)
+    assert third.get(inputs["c"]) == third.local_path(inputs["c"])
+    third.close()
+    assert not os.path.exists(pin)
+    assert cached_names(third) == ["b.root", "c.root"]
+
+
+def test_too_large_falls_back(tmp_path, inputs):
+    cache = FileCache(str(tmp_path / "cache"), 50)
+    assert cache.get(inputs["a"]) == inputs["a"]
+    cache.close()
+    assert cached_names(cache) == []
+    assert cache.copied == 0
+
+
+def test_failed_copy_is_cleaned_up(tmp_path, inputs, monkeypatch):
+    def broken_copy(src, dst):
+        with open(dst, "wb") as f:
+            f.write(b"partial")
+        raise OSError("connection lost")
+
+    monkeypatch.setattr(file_cache, "copy_file", broken_copy)
+    cache = FileCache(str(tmp_path / "cache"), 1000)
+    assert cache.get(inputs["a"]) == inputs["a"]
+    cache.close()
+    assert os.listdir(tmp_path / "cache") == []
+    assert cache.reserved == 0
@@ -0,0 +1,80 @@
+from array import array
+
+import pytest
+import ROOT
+from jec4prompt.find_range import file_run_range, find_run_range_metadata
+
+
+def write_file(path, trees):
+    """
+    Write trees of int columns, given as {tree: {column: values}}.
+    """
+    tfile = ROOT.TFile.Open(str(path), "RECREATE")
+    for name, columns in trees.items():
+        tree = ROOT.TTree(name, name)
+        buffers = {column: array("i", [0]) for column in columns}
+        for column, buffer in buffers.items():
+            tree.Branch(column, buffer, f"{column}/I")
+        for values in zip(*columns.values()):
+            for column, value in zip(columns, values):
+                buffers[column][0] = value
+            tree.Fill()
+        tree.Write()
+    tfile.Close()
+    return str(path)
+
+
+@pytest.fixture
+def nanoaod(tmp_path):
+    return write_file(
+        tmp_path / "nanoaod.root",
+        {"Events": {"run": [100, 100, 104]}, "Runs": {"run": [100, 101, 104]}},
+    )
+
+
+def skim_file(path, runs, min_run, max_run):
+    # Skims keep the unfiltered Runs tree of their inputs
+    return write_file(
+        path,
+        {
+            "Events": {
+                "run": runs,
+                "min_run": [min_run] * len(runs),
+                "max_run": [max_run] * len(runs),
+            },
+            "Runs": {"run": [90, 100, 120]},
+        },
+    )
+
+
+def test_nanoaod_run_range(nanoaod):
+    assert file_run_range(nanoaod) == (100, 104)
+
+
+@pytest.mark.parametrize("min_run, max_run", [(95, 110), (0, 1)])
+def test_skim_run_range(tmp_path, min_run, max_run):
+    # The events left after a run range filter, not the requested range, the
+    # placeholders or the Runs tree
+    skim = skim_file(tmp_path / "skim.root", [102, 101, 103], min_run, max_run)
+    assert file_run_range(skim) == (101, 103)
+
+
+def test_empty_skim_and_unknown_files(tmp_path, nanoaod):
+    empty = skim_file(tmp_path / "empty.root", [], 95, 110)
+    assert file_run_range(empty) == ()
+
+    unknown = write_file(tmp_path / "unknown.root", {"Events": {"run": [1]}})
+    assert file_run_range(unknown) is None
+    with pytest.raises(ValueError, match="use --method scan"):
+        find_run_range_metadata([unknown], workers=1)
+
+
+def test_metadata_run_range(tmp_path, nanoaod):
+    skim = skim_file(tmp_path / "skim.root", [102, 105], 95, 110)
+    empty = skim_file(tmp_path / "empty.root", [], 95, 110)
+    cache = str(tmp_path / "cache.json")
+
+    files = [nanoaod, skim, empty]
+    assert find_run_range_metadata(files, 2, cache) == (100, 105)
+    # Read back from the cache
+    assert find_run_range_metadata(files, 2, cache) == (100, 105)
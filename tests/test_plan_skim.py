@@ -0,0 +1,92 @@
+import os
+
+import pytest
+from jec4prompt import skim
+from jec4prompt.plan_skim import load_spread, plan_steps
+
+
+def make_infos(entries):
+    return {file: {"entries": n, "bytes": 1000 * n} for file, n in entries.items()}
+
+
+def test_plan_steps_largest_first():
+    infos = make_infos({"a": 10, "b": 6, "c": 5, "d": 4})
+    steps, loads = plan_steps(infos, 2)
+
+    assert [[item["file"] for item in step] for step in steps] == [
+        ["a", "d"],
+        ["b", "c"],
+    ]
+    assert loads == [14, 11]
+    assert load_spread(loads) == pytest.approx(14 / 12.5)
+
+
+@pytest.mark.parametrize("balance", ["entries", "bytes"])
+def test_plan_steps_assigns_each_file_once(balance):
+    entries = {f"file{i}.root": (37 * i) % 101 + 1 for i in range(40)}
+    infos = make_infos(entries)
+    steps, loads = plan_steps(infos, 7, balance)
+
+    files = [item["file"] for step in steps for item in step]
+    assert sorted(files) == sorted(entries)
+    assert sum(loads) == pytest.approx(sum(info[balance] for info in infos.values()))
+    for step, load in zip(steps, loads):
+        assert load == pytest.approx(sum(infos[item["file"]][balance] for item in step))
+
+
+def test_plan_steps_splits_large_files():
+    infos = make_infos({"big": 1003, "small": 40, "empty": 0})
+    steps, loads = plan_steps(infos, 4, max_entries=300)
+
+    items = [item for step in steps for item in step]
+    ranges = sorted(
+        (item["first"], item["last"]) for item in items if item["file"] == "big"
+    )
+    assert len(ranges) == 4
+    assert ranges[0][0] == 0 and ranges[-1][1] == 1003
+    for (_, last), (first, _) in zip(ranges, ranges[1:]):
+        assert last == first
+    assert all(last - first <= 300 for first, last in ranges)
+
+    # Files below max_entries are not split
+    unsplit = [item for item in items if item["file"] != "big"]
+    assert sorted(unsplit, key=lambda item: item["file"]) == [
+        {"file": "empty"},
+        {"file": "small"},
+    ]
+    assert sum(loads) == pytest.approx(1043)
+
+
+def test_split_file_steps(tmp_path, monkeypatch):
+    infos = make_infos({"big": 1000})
+    steps, _ = plan_steps(infos, 4, max_entries=250)
+    plan = {"nsteps": 4, "steps": steps}
+
+    with_runs = []
+    for step in range(4):
+        files, entry_ranges = skim.plan_step_inputs(plan, step)
+        assert files == ["big"]
+        assert len(entry_ranges["big"]) == 1
+        if skim.carries_runs("big", entry_ranges):
+            with_runs.append(step)
+    # The Runs tree of the file is written once
+    assert len(with_runs) == 1
+
+    # A step with only later ranges of the file has no _runs.root part
+    step = next(step for step in range(4) if step not in with_runs)
+    output_path = str(tmp_path / f"J4PSkim_step{step}")
+    parts = [output_path + "_events.root"]
+    open(parts[0], "w").close()
+
+    hadd = []
+
+    def fake_run(command, check):
+        assert check
+        for part in command[3:]:
+            assert os.path.exists(part)
+        hadd.append(command)
+
+    monkeypatch.setattr(skim.subprocess, "run", fake_run)
+    skim.merge_parts(output_path, parts)
+    assert hadd == [["hadd", "-f", output_path + ".root", *parts]]
+    assert not os.path.exists(parts[0])
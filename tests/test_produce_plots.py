@@ -0,0 +1,43 @@
+import subprocess
+import sys
+
+from jec4prompt.utils.plotting_utils import read_plot_config
+
+
+def imports_root(code):
+    result = subprocess.run(
+        [sys.executable, "-c", f"{code}\nimport sys\nprint('ROOT' in sys.modules)"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.split()[-1] == "True"
+
+
+def test_mpl_backend_runs_without_root(tmp_path):
+    # The CLI with the produce_plots command and the module the spawned
+    # workers import
+    argv = [
+        "j4p-main",
+        "produce_plots",
+        "--filelist",
+        "x.root",
+        "--out",
+        str(tmp_path),
+        "--backend",
+        "mpl",
+    ]
+    assert not imports_root(
+        f"import sys\nsys.argv = {argv!r}\n"
+        "from jec4prompt.main import ProcessingState\n"
+        "ProcessingState().init_state()"
+    )
+    assert not imports_root("import jec4prompt.plotting.produce_plots_mpl")
+
+
+def test_plot_config_keys_are_lowercased(tmp_path):
+    path = tmp_path / "plots.ini"
+    path.write_text("[Response]\nhists = a, b\nXLabelSize = 0.05\n")
+    config = read_plot_config(str(path))
+    assert config.sections() == ["Response"]
+    assert dict(config["Response"]) == {"hists": "a, b", "xlabelsize": "0.05"}
@@ -0,0 +1,32 @@
+import os
+
+from jec4prompt.produce_ratio import mc_cache_key
+from jec4prompt.utils.processing_utils import get_bins
+
+hist_config = {
+    "name": "response",
+    "type": "Profile1D",
+    "x_bins": "pt",
+    "x_val": "pt",
+    "y_val": "response",
+}
+
+
+def test_mc_cache_key(tmp_path):
+    mc = tmp_path / "mc.root"
+    mc.write_bytes(b"mc")
+    bins = get_bins()
+    triggers = {"HLT_A": "HLT_A && pt > 50", "HLT_B": "HLT_B"}
+    key = mc_cache_key([str(mc)], triggers, hist_config, bins)
+
+    # Independent of the order of files and triggers
+    reordered = dict(reversed(triggers.items()))
+    assert mc_cache_key([str(mc)], reordered, hist_config, bins) == key
+
+    # Changed trigger cuts, histogram config or MC files give a new key
+    changed = {**triggers, "HLT_A": "HLT_A && pt > 60"}
+    assert mc_cache_key([str(mc)], changed, hist_config, bins) != key
+    changed = {**hist_config, "cut": "abs(eta) < 1.3"}
+    assert mc_cache_key([str(mc)], triggers, changed, bins) != key
+    os.utime(mc, ns=(0, 0))
+    assert mc_cache_key([str(mc)], triggers, hist_config, bins) != key
@@ -0,0 +1,161 @@
+import numpy as np
+import pytest
+import ROOT
+from jec4prompt.produce_responses import (
+    fit_gaussian_cores,
+    fit_resolutions_batch,
+    project_responses_numpy,
+    project_responses_root,
+)
+
+eta_edges = np.array([-5.191, -3.0, -2.5, -1.3, 0.0, 1.3, 2.5, 3.0, 5.191])
+
+
+@pytest.fixture
+def response_th3():
+    """
+    Weighted pT vs eta vs response TH3 with entries in the flow bins of all
+    axes.
+    """
+    pt_edges = np.array([15.0, 30.0, 60.0, 120.0, 300.0])
+    response_edges = np.linspace(0.0, 2.0, 41)
+    h = ROOT.TH3D(
+        "response_th3",
+        "response",
+        len(pt_edges) - 1,
+        pt_edges,
+        len(eta_edges) - 1,
+        eta_edges,
+        len(response_edges) - 1,
+        response_edges,
+    )
+    h.SetDirectory(ROOT.nullptr)
+    h.Sumw2()
+
+    rng = np.random.default_rng(3)
+    n = 20000
+    pt = rng.uniform(5.0, 400.0, n)
+    eta = rng.uniform(-6.0, 6.0, n)
+    response = rng.normal(1.0, 0.4, n)
+    weight = rng.uniform(0.5, 2.0, n)
+    for values in zip(pt, eta, response, weight):
+        h.Fill(*values)
+    return h
+
+
+@pytest.mark.parametrize(
+    "eta_window",
+    [
+        (-2.5, 2.5),
+        # Window bounds on bin edges
+        (-1.3, 0.0),
+        (0.0, 3.0),
+        # Bounds inside bins
+        (-0.7, 1.9),
+        # Past the eta axis, with its flow bins
+        (-6.0, 6.0),
+        (1.3, 10.0),
+        (-5.191, 5.191),
+    ],
+)
+def test_numpy_profiles_match_root(response_th3, eta_window):
+    numpy_profile = project_responses_numpy(response_th3, "h", [eta_window])[0]
+    root_profile = project_responses_root(response_th3, "h", [eta_window])[0]
+
+    n_bins = root_profile.GetNbinsX()
+    assert numpy_profile.GetNbinsX() == n_bins
+    for i in range(n_bins + 2):
+        assert numpy_profile.GetBinEntries(i) == pytest.approx(
+            root_profile.GetBinEntries(i), rel=1e-9, abs=1e-12
+        )
+        assert numpy_profile.GetBinContent(i) == pytest.approx(
+            root_profile.GetBinContent(i), rel=1e-9, abs=1e-12
+        )
+        assert numpy_profile.GetBinError(i) == pytest.approx(
+            root_profile.GetBinError(i), rel=1e-9, abs=1e-12
+        )
+
+
+def test_numpy_profiles_for_several_windows(response_th3):
+    windows = [(-2.5, 2.5), (-1.3, 0.0), (1.3, 10.0)]
+    profiles = project_responses_numpy(response_th3, "h", windows)
+    assert [p.GetName() for p in profiles] == [
+        "h_pfx",
+        "h_etam1p3to0_pfx",
+        "h_eta1p3to10_pfx",
+    ]
+    for window, profile in zip(windows, profiles):
+        single = project_responses_numpy(response_th3, "h", [window])[0]
+        for i in range(profile.GetNbinsX() + 2):
+            assert profile.GetBinContent(i) == single.GetBinContent(i)
+
+
+def gaussian_counts(centers, n, mu, sigma):
+    width = centers[1] - centers[0]
+    return (
+        n
+        * width
+        * np.exp(-0.5 * ((centers - mu) / sigma) ** 2)
+        / (np.sqrt(2 * np.pi) * sigma)
+    )
+
+
+def test_fit_gaussian_cores():
+    centers = np.linspace(-1.975, 1.975, 80)
+    params = [(0.0, 0.3), (0.4, 0.15), (-0.25, 0.5)]
+    counts = np.array([gaussian_counts(centers, 1e4, *p) for p in params])
+
+    # Expected counts are fitted exactly
+    means, sigmas, errors = fit_gaussian_cores(counts, centers)
+    assert means == pytest.approx([p[0] for p in params], abs=1e-6)
+    assert sigmas == pytest.approx([p[1] for p in params], rel=1e-6)
+    # sigma / sqrt(2 N) for a Gaussian sample of N events
+    assert errors == pytest.approx([p[1] / np.sqrt(2e4) for p in params], rel=0.05)
+
+    # Poisson fluctuated counts within a few standard errors
+    rng = np.random.default_rng(1)
+    means, sigmas, errors = fit_gaussian_cores(rng.poisson(counts), centers)
+    assert np.all(np.abs(sigmas - [p[1] for p in params]) < 4 * errors)
+    assert means == pytest.approx([p[0] for p in params], abs=0.02)
+
+
+def test_fit_gaussian_cores_undefined_rows():
+    centers = np.linspace(0.025, 1.975, 40)
+    counts = np.zeros((4, len(centers)))
+    # Empty, a single filled bin, two separate peaks without a Gaussian
+    # maximum and a few events
+    counts[1, 20] = 100.0
+    counts[2, [5, 30]] = 3.0
+    counts[3, [18, 20, 21, 23]] = [1.0, 2.0, 1.0, 1.0]
+
+    means, sigmas, errors = fit_gaussian_cores(counts, centers)
+    assert means[:3].tolist() == [0.0, 0.0, 0.0]
+    assert sigmas[:3].tolist() == [0.0, 0.0, 0.0]
+    assert errors[:3].tolist() == [0.0, 0.0, 0.0]
+    # Low counts still give a positive, finite fit
+    assert 0.0 < sigmas[3] < 0.5
+    assert 0.0 < errors[3] < np.inf
+    assert 0.9 < means[3] < 1.2
+
+
+def test_fit_resolutions_batch():
+    h = ROOT.TH3D("resolution_th3", "", 2, 0.0, 2.0, 3, 0.0, 3.0, 60, -1.5, 1.5)
+    h.SetDirectory(ROOT.nullptr)
+    centers = np.array([h.GetZaxis().GetBinCenter(k) for k in range(1, 61)])
+    sigmas = {}
+    for i in range(1, 3):
+        for j in range(1, 4):
+            sigmas[i, j] = 0.1 * (i + j)
+            counts = gaussian_counts(centers, 1e4, 0.0, sigmas[i, j])
+            for k, count in enumerate(counts, 1):
+                h.SetBinContent(i, j, k, count)
+    # Empty bin
+    for k in range(1, 61):
+        h.SetBinContent(2, 3, k, 0.0)
+    sigmas[2, 3] = 0.0
+
+    fsigmas, ferrors = fit_resolutions_batch(h)
+    assert fsigmas.shape == ferrors.shape == (2, 3)
+    for (i, j), sigma in sigmas.items():
+        assert fsigmas[i - 1, j - 1] == pytest.approx(sigma, rel=1e-6)
+    assert ferrors[1, 2] == 0.0
@@ -0,0 +1,233 @@
+import logging
+
+import numpy as np
+import pytest
+from jec4prompt.produce_time_evolution import (
+    lumi_bin_groups,
+    time_evolution_from_store,
+)
+from jec4prompt.utils.summary_store import (
+    add_file,
+    add_lumi_csv,
+    all_triggers,
+    file_in_store,
+    mean_and_error,
+    open_store,
+    read_blocks,
+    read_summaries,
+    set_ls_block,
+)
+
+hist_config = {"response": {"type": "Profile1D", "name": "response"}}
+
+
+def make_events(lumisections, seed, n=400):
+    """
+    Weighted responses of n events spread over the given (run, ls) pairs.
+    """
+    rng = np.random.default_rng(seed)
+    lumisections = np.array(lumisections)
+    picked = lumisections[rng.integers(0, len(lumisections), n)]
+    return {
+        "run": picked[:, 0],
+        "ls": picked[:, 1],
+        "w": rng.uniform(0.5, 2.0, n),
+        "y": rng.normal(1.0, 0.2, n) + 0.01 * (picked[:, 0] - 100),
+    }
+
+
+def summarize(events, lumisections, ls_block_size=0):
+    """
+    Summary rows and lumisections of a file as read_summary returns them.
+    """
+    lumisections = np.array(lumisections)
+    blocks = events["ls"] // ls_block_size if ls_block_size else 0 * events["ls"]
+    summaries = []
+    for run, block in sorted(set(zip(events["run"], blocks))):
+        sel = (events["run"] == run) & (blocks == block)
+        w, y = events["w"][sel], events["y"][sel]
+        summaries.append(
+            (
+                int(run),
+                int(block),
+                all_triggers,
+                "response",
+                w.sum(),
+                (w * w).sum(),
+                (w * y).sum(),
+                (w * y * y).sum(),
+                int(sel.sum()),
+            )
+        )
+    ls_blocks = (
+        lumisections[:, 1] // ls_block_size if ls_block_size else 0 * lumisections[:, 1]
+    )
+    return summaries, np.column_stack([lumisections, ls_blocks]).tolist()
+
+
+# Run 101 is split between the two files
+file_lumisections = {
+    "a.root": [(100, ls) for ls in range(1, 5)] + [(101, 1), (101, 2)],
+    "b.root": [(101, ls) for ls in range(3, 7)] + [(102, ls) for ls in range(1, 4)],
+}
+file_lumi = {"a.root": 6.0, "b.root": 7.0}
+
+
+@pytest.fixture
+def events():
+    return {
+        file: make_events(lumisections, seed)
+        for seed, (file, lumisections) in enumerate(file_lumisections.items())
+    }
+
+
+def fill_store(store, events, ls_block_size=0):
+    set_ls_block(store, ls_block_size)
+    for file, lumisections in file_lumisections.items():
+        add_file(
+            store,
+            file,
+            *summarize(events[file], lumisections, ls_block_size),
+            file_lumi[file],
+        )
+
+
+def direct_mean(events, select):
+    w = np.concatenate([e["w"][select(e)] for e in events.values()])
+    y = np.concatenate([e["y"][select(e)] for e in events.values()])
+    mean = np.average(y, weights=w)
+    neff = w.sum() ** 2 / (w * w).sum()
+    return mean, np.sqrt(np.average((y - mean) ** 2, weights=w) / neff)
+
+
+def test_mean_and_error(events):
+    e = events["a.root"]
+    w, y = e["w"], e["y"]
+    mean, error = mean_and_error(
+        np.array([w.sum(), 0.0]),
+        np.array([(w * w).sum(), 0.0]),
+        np.array([(w * y).sum(), 0.0]),
+        np.array([(w * y * y).sum(), 0.0]),
+    )
+    expected = direct_mean(events, lambda e: e is events["a.root"])
+    assert mean[0] == pytest.approx(expected[0], rel=1e-12)
+    assert error[0] == pytest.approx(expected[1], rel=1e-9)
+    # Empty bins
+    assert (mean[1], error[1]) == (0.0, 0.0)
+
+
+def test_views(events, tmp_path):
+    store = open_store(":memory:")
+    fill_store(store, events)
+
+    # The luminosity of a file is shared by its runs per lumisection
+    runs = store.execute("SELECT run, lumi, from_csv FROM runs ORDER BY run")
+    assert runs.fetchall() == [(100, 4.0, 0), (101, 6.0, 0), (102, 3.0, 0)]
+    n_ls = store.execute("SELECT COUNT(*) FROM lumisections WHERE run = 101")
+    assert n_ls.fetchone() == (6,)
+
+    # The per-run summaries sum over the files
+    summaries = read_summaries(store, "response")
+    assert summaries["entries"].tolist() == [
+        sum(((e["run"] == run).sum() for e in events.values()))
+        for run in (100, 101, 102)
+    ]
+    assert summaries["sumw"][1] == pytest.approx(
+        sum(e["w"][e["run"] == 101].sum() for e in events.values())
+    )
+    # Unknown observables and triggers are zero
+    assert not read_summaries(store, "response", "HLT_Other")["sumw"].any()
+
+    # Adding a file again replaces its rows
+    add_file(
+        store, "a.root", *summarize(events["a.root"], file_lumisections["a.root"]), 6.0
+    )
+    assert (
+        read_summaries(store, "response")["entries"].tolist()
+        == summaries["entries"].tolist()
+    )
+    assert file_in_store(store, "a.root")
+    assert not file_in_store(store, "c.root")
+
+    # Luminosities from a brilcalc csv take precedence
+    csv = tmp_path / "lumi.csv"
+    csv.write_text(
+        "#Data tag : 24v1 , Norm tag: None\n"
+        "#run:fill,time,nls,ncms,delivered(/fb),recorded(/fb)\n"
+        "101:9000,05/01/24 10:00:00,6,6,5.5,5.0\n"
+    )
+    add_lumi_csv(store, str(csv))
+    runs = store.execute("SELECT run, lumi, from_csv FROM runs ORDER BY run")
+    assert runs.fetchall() == [(100, 4.0, 0), (101, 5.0, 1), (102, 3.0, 0)]
+
+
+def test_read_blocks(events):
+    store = open_store(":memory:")
+    fill_store(store, events, ls_block_size=2)
+
+    blocks = read_blocks(store)
+    assert blocks["run"].tolist() == [100, 100, 100, 101, 101, 101, 101, 102, 102]
+    assert blocks["ls_block"].tolist() == [0, 1, 2, 0, 1, 2, 3, 0, 1]
+    # Run lumi shared in proportion to the lumisections of each block
+    assert blocks["lumi"].tolist() == pytest.approx(
+        [1.0, 2.0, 1.0, 1.0, 2.0, 2.0, 1.0, 1.0, 2.0]
+    )
+    summaries = read_summaries(store, "response")
+    assert summaries["entries"].sum() == sum(len(e["w"]) for e in events.values())
+
+
+def test_ls_block_of_store(tmp_path):
+    path = str(tmp_path / "store.sqlite")
+    store = open_store(path)
+    set_ls_block(store, 10)
+    store.close()
+
+    store = open_store(path)
+    set_ls_block(store, 10)
+    with pytest.raises(ValueError, match="built with --ls_block 10"):
+        set_ls_block(store, 0)
+
+
+@pytest.mark.parametrize(
+    "lumi, lumi_per_bin, groups",
+    [
+        ([1.0, 1.0, 1.0], None, [0, 1, 2]),
+        # Blocks without luminosity join the next bin, or the last one
+        ([0.0, 1.0, 0.0, 1.0, 0.0], None, [0, 0, 1, 1, 1]),
+        ([1.0, 1.0, 1.0, 1.0, 1.0], 2.0, [0, 0, 1, 1, 2]),
+        ([0.5, 3.0, 0.5, 0.0], 2.0, [0, 0, 1, 1]),
+        ([0.0, 0.0], None, [0, 0]),
+    ],
+)
+def test_lumi_bin_groups(lumi, lumi_per_bin, groups):
+    assert lumi_bin_groups(np.array(lumi), lumi_per_bin).tolist() == groups
+
+
+def test_time_evolution_from_store(events):
+    store = open_store(":memory:")
+    fill_store(store, events)
+    logger = logging.getLogger("test_summary_store")
+
+    hs, min_run, max_run = time_evolution_from_store(store, hist_config, logger)
+    assert (min_run, max_run) == (100, 102)
+    min_runs, max_runs, response = hs
+    assert response.GetName() == "response_int_lumi"
+
+    # One bin per run on the cumulative luminosity
+    axis = response.GetXaxis()
+    edges = [axis.GetBinLowEdge(i) for i in range(1, axis.GetNbins() + 2)]
+    assert edges == pytest.approx([0.0, 4.0, 10.0, 13.0])
+    for i, run in enumerate((100, 101, 102), 1):
+        mean, error = direct_mean(events, lambda e: e["run"] == run)
+        assert response.GetBinContent(i) == pytest.approx(mean, rel=1e-12)
+        assert response.GetBinError(i) == pytest.approx(error, rel=1e-9)
+        assert min_runs.GetBinContent(i) == max_runs.GetBinContent(i) == run
+
+    # Runs 100 and 101 merged to reach 5 fb^-1, then run 102
+    hs, _, _ = time_evolution_from_store(store, hist_config, logger, 5.0)
+    min_runs, max_runs, response = hs
+    assert response.GetNbinsX() == 2
+    mean, error = direct_mean(events, lambda e: e["run"] <= 101)
+    assert response.GetBinContent(1) == pytest.approx(mean, rel=1e-12)
+    assert response.GetBinError(1) == pytest.approx(error, rel=1e-9)
+    assert (min_runs.GetBinContent(1), max_runs.GetBinContent(1)) == (100, 101)
@@ -0,0 +1,260 @@
+import os
+import subprocess
+
+import numpy as np
+import pytest
+import ROOT
+from jec4prompt.produce_vetomaps import (
+    accumulate_vetomap_inputs,
+    derive_vetomaps,
+    hist_info,
+    load_accumulator,
+    produce_vetomap_numpy,
+    produce_vetomaps_incremental,
+    read_vetomap_bitmap,
+    save_accumulator,
+    vetomaps_from_accumulator,
+    write_vetomap_bitmap,
+)
+from jec4prompt.utils.processing_utils import file_key, get_bins
+
+
+def reference_vetomaps(values, errors, db_values):
+    """
+    Bin by bin transcription of the loops in produce_vetomap.
+    """
+    n_methods, n_eta, n_phi = values.shape
+    sum_values = np.zeros((n_eta, n_phi))
+    sum_errors = np.zeros((n_eta, n_phi))
+    for m in range(n_methods):
+        for i in range(n_eta):
+            area = 0.0
+            for j in range(n_phi):
+                area += values[m, i, j]
+            for j in range(n_phi):
+                value, error = values[m, i, j], errors[m, i, j]
+                if area != 0:
+                    value, error = value / area, abs(error / area)
+                sum_values[i, j] += value
+                sum_errors[i, j] += error
+    sum_values *= 1.0 / n_methods
+    sum_errors *= 1.0 / n_methods
+
+    names = ["loose", "medium", "tight", "hot", "cold"]
+    maps = {f"veto_map_{name}": np.zeros((n_eta, n_phi)) for name in names}
+    deltas = np.zeros((n_eta, n_phi))
+    spread = []
+    for i in range(n_eta):
+        # GetBinContent(n // 2) with 1-based bins
+        if n_phi % 2 == 0:
+            median = (sum_values[i, n_phi // 2 - 1] + sum_values[i, n_phi // 2]) / 2
+        else:
+            median = sum_values[i, n_phi // 2 - 1]
+        total = 0.0
+        for j in range(n_phi):
+            total += (sum_values[i, j] - median) ** 2
+        sigma = np.sqrt(total / n_phi)
+        if sigma == 0:
+            continue
+        for j in range(n_phi):
+            if median == 0:
+                spread.append(0.0)
+                continue
+            if sum_errors[i, j] == 0 or not sum_errors[i, j] / median < 0.5:
+                continue
+            delta = (sum_values[i, j] - median) / sigma
+            maps["veto_map_loose"][i, j] = 0 if -5 < delta < 5 else 1
+            maps["veto_map_medium"][i, j] = 0 if -3 < delta < 3 else 1
+            maps["veto_map_tight"][i, j] = 0 if -1 < delta < 1 else 1
+            maps["veto_map_cold"][i, j] = db_values[i, j] < 0 and abs(delta) > 3
+            maps["veto_map_hot"][i, j] = db_values[i, j] > 0 and abs(delta) > 3
+            spread.append(delta)
+            deltas[i, j] = delta
+
+    maps["veto_map_hotandcold"] = maps["veto_map_hot"] + maps["veto_map_cold"]
+    maps["deltas"] = deltas
+    maps["spread_values"] = np.array(spread)
+    return maps
+
+
+def make_inputs(n_phi, seed=1):
+    rng = np.random.default_rng(seed)
+    n_methods, n_eta = 5, 8
+    values = rng.uniform(0.5, 1.5, (n_methods, n_eta, n_phi))
+    errors = rng.uniform(0.0, 0.02, (n_methods, n_eta, n_phi))
+    db_values = rng.normal(0, 1, (n_eta, n_phi))
+
+    # Hot and cold outliers
+    values[:, 0, 1] *= 20
+    values[:, 1, 2] *= 1e-3
+    db_values[0, 1] = 1.0
+    db_values[1, 2] = -1.0
+    # Zero spread: a flat strip
+    values[:, 2, :] = 1.0
+    # Zero median: empty middle bin(s) of the strip
+    values[:, 3, n_phi // 2 - 1] = 0.0
+    values[:, 3, n_phi // 2] = 0.0
+    # Empty strip (zero area)
+    values[:, 4, :] = 0.0
+    # Bins without errors and with large relative errors
+    errors[:, 5, 0] = 0.0
+    errors[:, 6, 3] = 5.0
+    return values, errors, db_values
+
+
+@pytest.mark.parametrize("n_phi", [72, 9])
+def test_derive_vetomaps_matches_reference(n_phi):
+    values, errors, db_values = make_inputs(n_phi)
+    maps = derive_vetomaps(values, errors, db_values)
+    reference = reference_vetomaps(values, errors, db_values)
+
+    for name, expected in reference.items():
+        if name == "spread_values":
+            np.testing.assert_allclose(
+                np.sort(maps[name]), np.sort(expected), rtol=1e-12
+            )
+        else:
+            np.testing.assert_allclose(maps[name], expected, rtol=1e-12, err_msg=name)
+    assert not maps["deltas"][2].any()
+    # A single outlier can not pass 3 sigma with few phi bins
+    if n_phi > 10:
+        assert maps["veto_map_hot"][0, 1] == 1
+        assert maps["veto_map_cold"][1, 2] == 1
+
+
+def test_vetomap_bitmap_round_trip(tmp_path):
+    rng = np.random.default_rng(2)
+    eta_edges = np.linspace(-5.191, 5.191, 83)
+    phi_edges = np.linspace(-np.pi, np.pi, 73)
+    maps = {
+        name: (rng.uniform(size=(82, 72)) > 0.9).astype(float)
+        for name in ("jetvetomap", "jetvetomap_hot", "jetvetomap_cold")
+    }
+    path = tmp_path / "vetomap.bin"
+    write_vetomap_bitmap(str(path), eta_edges, phi_edges, maps)
+
+    bitmap = read_vetomap_bitmap(str(path))
+    np.testing.assert_array_equal(bitmap["eta_edges"], eta_edges)
+    np.testing.assert_array_equal(bitmap["phi_edges"], phi_edges)
+    assert list(bitmap["maps"]) == list(maps)
+    for name, vmap in maps.items():
+        np.testing.assert_array_equal(bitmap["maps"][name], vmap > 0)
+
+
+def test_vetomap_bitmap_odd_size(tmp_path):
+    # Number of bins not a multiple of 8
+    maps = {"jetvetomap": np.eye(3, 5)}
+    path = tmp_path / "vetomap.bin"
+    write_vetomap_bitmap(str(path), np.arange(4.0), np.arange(6.0), maps)
+    np.testing.assert_array_equal(
+        read_vetomap_bitmap(str(path))["maps"]["jetvetomap"], np.eye(3, 5) > 0
+    )
+
+
+def write_vetomap_inputs(path, seed, triggers=("HLT_A", "HLT_B")):
+    """
+    Write the hist_info inputs of produce_vetomaps, filled with weighted
+    random events, for each trigger.
+    """
+    bins = get_bins()
+    rng = np.random.default_rng(seed)
+    n = 5000
+    file = ROOT.TFile(str(path), "RECREATE")
+    for trg in triggers:
+        for system, method, hname in hist_info:
+            file.mkdir(f"{trg}/{system}/{method}", "", True)
+            file.cd(f"{trg}/{system}/{method}")
+            eta = rng.uniform(-5.0, 5.0, n)
+            phi = rng.uniform(-3.1, 3.1, n)
+            weight = rng.uniform(0.5, 2.0, n)
+            axes = (
+                bins["eta"]["n"],
+                bins["eta"]["bins"],
+                bins["phi"]["n"],
+                bins["phi"]["bins"],
+            )
+            if hname == "Inclusive_EtaVsPhi_selected":
+                h = ROOT.TH2D(hname, hname, *axes)
+                h.Sumw2()
+                h.FillN(n, eta, phi, weight)
+            else:
+                h = ROOT.TProfile2D(hname, hname, *axes)
+                h.Sumw2()
+                for values in zip(eta, phi, rng.normal(0.5, 0.2, n), weight):
+                    h.Fill(*values)
+            h.Write()
+    file.Close()
+    return str(path)
+
+
+@pytest.fixture
+def vetomap_inputs(tmp_path):
+    return [
+        write_vetomap_inputs(tmp_path / f"{name}.root", seed)
+        for seed, name in enumerate("ab")
+    ]
+
+
+def assert_maps_equal(maps, expected):
+    assert sorted(maps) == sorted(expected)
+    for trg in expected:
+        for name in ("veto_map_loose", "veto_map_hot", "veto_map_cold", "deltas"):
+            np.testing.assert_allclose(
+                maps[trg][name], expected[trg][name], rtol=1e-9, atol=1e-12
+            )
+
+
+def test_accumulator_matches_file(tmp_path, vetomap_inputs):
+    acc = {"files": [], "sums": {}}
+    accumulate_vetomap_inputs(vetomap_inputs[0], [], acc)
+    assert acc["files"] == [file_key(vetomap_inputs[0])]
+    assert sorted(acc["sums"]) == sorted(
+        (trg, hname) for trg in ("HLT_A", "HLT_B") for _, _, hname in hist_info
+    )
+
+    maps = vetomaps_from_accumulator(acc, str(tmp_path / "acc.root"))
+    expected = produce_vetomap_numpy(vetomap_inputs[0], [], "", write=False)
+    assert_maps_equal(maps, expected)
+
+
+def test_accumulating_files_matches_hadd(tmp_path, vetomap_inputs):
+    acc = {"files": [], "sums": {}}
+    for file in vetomap_inputs:
+        accumulate_vetomap_inputs(file, [], acc)
+
+    merged = str(tmp_path / "merged.root")
+    subprocess.run(["hadd", "-f", merged, *vetomap_inputs], check=True)
+    maps = vetomaps_from_accumulator(acc, str(tmp_path / "acc.root"))
+    assert_maps_equal(maps, produce_vetomap_numpy(merged, [], "", write=False))
+
+
+def test_accumulator_round_trip(tmp_path):
+    path = str(tmp_path / "acc.npz")
+    assert load_accumulator(path) == {"files": [], "sums": {}}
+
+    rng = np.random.default_rng(3)
+    acc = {"files": ["a.root:100:1", "b.root:200:2"], "sums": {}}
+    for trg in ("HLT_A", "HLT_B"):
+        for _, _, hname in hist_info:
+            fields = ["sumw", "sumw2"]
+            if "Profile" in hname:
+                fields = ["sumw", "sumwy", "sumwy2", "binsumw2"]
+            acc["sums"][(trg, hname)] = {f: rng.uniform(size=(82, 72)) for f in fields}
+    save_accumulator(path, acc)
+
+    loaded = load_accumulator(path)
+    assert loaded["files"] == acc["files"]
+    assert sorted(loaded["sums"]) == sorted(acc["sums"])
+    for key, sums in acc["sums"].items():
+        assert sorted(loaded["sums"][key]) == sorted(sums)
+        for field, value in sums.items():
+            np.testing.assert_array_equal(loaded["sums"][key][field], value)
+    assert not os.path.exists(path + ".tmp.npz")
+
+
+def test_incremental_skips_accumulated_files(tmp_path, vetomap_inputs):
+    path = str(tmp_path / "acc.npz")
+    produce_vetomaps_incremental(vetomap_inputs[:1], [], str(tmp_path), path)
+    produce_vetomaps_incremental(vetomap_inputs, [], str(tmp_path), path)
+    assert load_accumulator(path)["files"] == [file_key(f) for f in vetomap_inputs]
+    assert os.path.exists(tmp_path / "J4PVetoMaps.root")